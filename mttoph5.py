@@ -11,10 +11,19 @@ June-2019
 # =============================================================================
 # Imports
 # =============================================================================
+import datetime
 import logging
 import os
+from collections import deque, OrderedDict
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+from types import SimpleNamespace
+
+import numpy as np
+
 import ph5_tools
-from ph5.core import columns
+from ph5.core import experiment
 from mtpy.core import ts as mtts
 from mtpy.usgs import zen
 from mtpy.usgs import nims
@@ -25,9 +34,396 @@ from mtpy.usgs import nims
 PROG_VERSION = '2019.65'
 # logger = logging.getLogger(__name__)
 
+### MTTS attributes needed to rebuild a time series from its data array
+ts_header_attrs = ['station', 'component', 'channel_number', 'azimuth', 
+                   'dipole_length', 'lat', 'lon', 'elev', 'data_logger', 'fn',
+                   'sampling_rate', 'start_time_utc']
+### extensions of MT ascii files, see mtpy.core.ts.MTTS.write_ascii_file
+ascii_extensions = ['ex', 'ey', 'hx', 'hy', 'hz']
+### numeric attributes in the header of an MT ascii file
+ascii_float_attrs = ['sampling_rate', 'lat', 'lon', 'elev', 'azimuth', 
+                     'dipole_length']
+ascii_int_attrs = ['channel_number', 'n_samples']
+
+# =============================================================================
+# Functions
+# =============================================================================
+def ts_to_record(ts_obj):
+    """
+    split an MTTS object into header metadata and a contiguous numpy array
+    so it can be sent between processes without pickling pandas objects.
+    
+    :param ts_obj: MTTS object or TSHeader
+    
+    :return: (header dictionary, data array)
+    """
+    header = {attr: getattr(ts_obj, attr) for attr in ts_header_attrs}
+    data = np.ascontiguousarray(ts_obj.ts.data)
+    
+    return header, data
+
+def record_to_ts(record):
+    """
+    rebuild a time series from a record made by ts_to_record.  The data 
+    array is used as is, no pandas time index is built.
+    
+    :param tuple record: (header dictionary, data array)
+    
+    :return: TSHeader object holding the data
+    """
+    header, data = record
+    
+    return TSHeader(data=data, **header)
+
+def decode_ts_file(ts_fn):
+    """
+    decode an MT file into a list of records, one for each channel.  This 
+    is run in worker processes by MTtoPH5.iter_ts_objs.
+    
+    :param str ts_fn: full path to MT file
+    
+    :return: list of (header dictionary, data array)
+    """
+    ts_obj = MTtoPH5().load_ts_obj(ts_fn)
+    if isinstance(ts_obj, NIMSSource):
+        return list(ts_obj.iter_records())
+    if not isinstance(ts_obj, list):
+        ts_obj = [ts_obj]
+        
+    return [ts_to_record(single_ts_obj) for single_ts_obj in ts_obj]
+
+def read_ascii_header(ascii_fn):
+    """
+    read the header of an MT ascii file without reading the data.  The 
+    header lines start with # and hold key = value pairs.
+    
+    :param str ascii_fn: full path to MT ascii file
+    
+    :return: (TSHeader, number of header lines)
+    """
+    attrs = {}
+    n_header_lines = 0
+    with open(ascii_fn, 'r') as fid:
+        for line in fid:
+            if not line.startswith('#'):
+                break
+            n_header_lines += 1
+            line_list = line[1:].split('=', 1)
+            if len(line_list) == 2:
+                attrs[line_list[0].strip()] = line_list[1].strip()
+    
+    header = {'fn': ascii_fn}
+    for attr in ts_header_attrs + ['n_samples']:
+        if attr not in attrs:
+            continue
+        value = attrs[attr]
+        if attr in ascii_float_attrs:
+            value = float(value)
+        elif attr in ascii_int_attrs:
+            value = int(float(value))
+        header[attr] = value
+    start_time = header.pop('start_time_utc', None)
+    
+    return TSHeader(start_time, **header), n_header_lines
+
+def scan_ascii_dtype(ascii_fn, n_header_lines, chunk_size=2**24):
+    """
+    find the data type of an MT ascii file before any of it is written, 
+    int64 if every value is a whole number written without a decimal point
+    or exponent otherwise float64, like pandas does when the whole file is
+    read.  The file is read in chunks of bytes and no numbers are parsed, 
+    so this is fast and uses little memory.
+    
+    :param str ascii_fn: full path to MT ascii file
+    :param int n_header_lines: number of lines to skip, see 
+                               read_ascii_header
+    :param int chunk_size: number of bytes read at a time
+    
+    :return: np.int64 or np.float64
+    """
+    with open(ascii_fn, 'rb') as fid:
+        for line in islice(fid, n_header_lines):
+            pass
+        while True:
+            chunk = fid.read(chunk_size)
+            if not chunk:
+                break
+            if chunk.translate(None, b'0123456789+- \t\r\n'):
+                return np.float64
+            
+    return np.int64
+
+def iter_ascii_blocks(ascii_fn, n_header_lines, block_size=2**20, 
+                      dtype=None):
+    """
+    yield the data of an MT ascii file block_size samples at a time, so 
+    only one block is in memory.  
+    
+    :param str ascii_fn: full path to MT ascii file
+    :param int n_header_lines: number of lines to skip, see 
+                               read_ascii_header
+    :param int block_size: number of samples in a block
+    :param dtype: data type of every block, default is found with 
+                  scan_ascii_dtype before the first block is read
+    """
+    if dtype is None:
+        dtype = scan_ascii_dtype(ascii_fn, n_header_lines)
+    with open(ascii_fn, 'r') as fid:
+        for line in islice(fid, n_header_lines):
+            pass
+        while True:
+            lines = [line for line in islice(fid, block_size) 
+                     if line.strip()]
+            if not lines:
+                break
+            yield np.array(lines, dtype=dtype)
+
+def write_mini_file(ph5_path, mini_num, jobs, session_time_stamp, 
+                    receivers, settings):
+    """
+    write the data arrays and Das_t rows of one mini file.  This is run in 
+    worker processes by MTtoPH5.to_ph5_parallel.
+    
+    :param str ph5_path: directory of the PH5 files
+    :param int mini_num: mini file number
+    :param list jobs: list of (count, file or record), see 
+                      MTtoPH5.plan_parallel_jobs
+    :param session_time_stamp: time stamp of the ingest session
+    :param receivers: receiver numbers shared between processes
+    :type receivers: SharedReceiverIndex
+    :param dict settings: key words for MTtoPH5
+    
+    :return: list of rows for the master file, see MTtoPH5.write_mini_jobs
+    """
+    mt_obj = MTtoPH5(**settings)
+    mt_obj._session_time_stamp = session_time_stamp
+    ### response numbers come from the master file and are set when the rows 
+    ### are committed
+    mt_obj._response_index = {}
+    
+    mini_name = "miniPH5_{0:05}.ph5".format(mini_num)
+    mini_handle = experiment.ExperimentGroup(nickname=mini_name,
+                                             currentpath=ph5_path)
+    mini_handle.ph5open(True)
+    mini_handle.initgroup()
+    try:
+        rows_list = mt_obj.write_mini_jobs(mini_handle, mini_name, jobs, 
+                                           receivers)
+        mini_handle.ph5.flush()
+    finally:
+        mini_handle.ph5close()
+        
+    return rows_list
+
 # =============================================================================
 # Class
 # =============================================================================
+class TSHeader(object):
+    """
+    Header of a single channel time series with the attributes of an MTTS
+    object that are used to make the PH5 table entries, but without a 
+    pandas time index.  The stop time is computed from the start time, 
+    sampling rate and number of samples, so it can be finalised after the
+    data are written.
+    
+    :param start_time: time of the first sample in UTC
+    :type start_time: string or datetime
+    
+    :param sampling_rate: samples per second
+    :type sampling_rate: float
+    
+    :param n_samples: number of samples
+    :type n_samples: int
+    
+    :param data: data array, optional
+    :type data: np.ndarray
+    
+    Any other key word is set as an attribute, for example station, 
+    component, channel_number, data_logger.
+    """
+    
+    def __init__(self, start_time=None, sampling_rate=1, n_samples=0, 
+                 data=None, **kwargs):
+        self.station = None
+        self.component = None
+        self.channel_number = 1
+        self.azimuth = 0
+        self.dipole_length = 0
+        self.lat = 0
+        self.lon = 0
+        self.elev = 0
+        self.data_logger = ''
+        self.fn = ''
+        self.sampling_rate = sampling_rate
+        self.data = data
+        if data is not None and not n_samples:
+            n_samples = data.shape[0]
+        self.n_samples = n_samples
+        self._start_dt = None
+        self.start_time_utc = start_time
+        
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+            
+    @property
+    def start_time_utc(self):
+        return self._start_dt.isoformat()
+    
+    @start_time_utc.setter
+    def start_time_utc(self, start_time):
+        if start_time is None:
+            self._start_dt = None
+        elif isinstance(start_time, datetime.datetime):
+            self._start_dt = ph5_tools.check_timezone(start_time)
+        else:
+            self._start_dt = ph5_tools.parse_date_time(start_time)
+            
+    @property
+    def start_time_epoch_sec(self):
+        return self._start_dt.timestamp()
+    
+    @property
+    def _stop_dt(self):
+        if self.n_samples < 1:
+            return self._start_dt
+        return self._start_dt + datetime.timedelta(
+                        seconds=(self.n_samples - 1) / float(self.sampling_rate))
+    
+    @property
+    def stop_time_utc(self):
+        return self._stop_dt.isoformat()
+    
+    @property
+    def stop_time_epoch_sec(self):
+        return self._stop_dt.timestamp()
+    
+    @property
+    def ts(self):
+        """
+        stand in for MTTS.ts that holds the data array
+        """
+        return SimpleNamespace(data=self.data)
+    
+    def time_record(self):
+        """
+        :return: start and end time as ph5_tools.ChannelTimes
+        """
+        return ph5_tools.ChannelTimes(
+                            ph5_tools.make_time_value(self._start_dt),
+                            ph5_tools.make_time_value(self._stop_dt))
+    
+class NIMSSource(object):
+    """
+    Lazy source of the channels in a NIMS file.  The file is decoded once 
+    and each channel is copied out of the NIMS object as a contiguous numpy
+    array only when it is handed out, so only one channel is held next to 
+    the decoded file.  The NIMS object is let go once the last channel is 
+    handed out.  Iterating hands out one channel at a time as a TSHeader, 
+    once it is written and let go its memory is freed.
+    
+    :param str nims_fn: full path to NIMS file (.bin or .bnn)
+    
+    :Example: ::
+        
+        >>> source = NIMSSource(r"/home/mt/mt01.bin")
+        >>> for ts_header in source:
+        >>> ...     mt_obj.single_ts_to_ph5(ts_header)
+        >>> ...     del ts_header
+    """
+    
+    components = ['hx', 'hy', 'hz', 'ex', 'ey']
+    
+    def __init__(self, nims_fn):
+        self.fn = nims_fn
+        self._nims_obj = None
+        self._components = []
+        self.decode()
+        
+    def decode(self):
+        """
+        decode the NIMS file, the channel records are made from it as they
+        are handed out, see iter_records
+        """
+        self._nims_obj = nims.NIMS(self.fn)
+        self._components = list(self.components)
+        
+    def __len__(self):
+        return len(self._components)
+    
+    def iter_records(self):
+        """
+        yield the (header dictionary, data array) record of each channel 
+        left in the source, see ts_to_record.  Each one is removed as it is
+        handed out.
+        """
+        while self._components:
+            component = self._components.pop(0)
+            record = ts_to_record(getattr(self._nims_obj, component))
+            if not self._components:
+                self._nims_obj = None
+            yield record
+            ### let go of the channel before the next one is made
+            del record
+            
+    def __iter__(self):
+        for record in self.iter_records():
+            ts_header = record_to_ts(record)
+            del record
+            yield ts_header
+            del ts_header
+    
+class SharedReceiverIndex(object):
+    """
+    Receiver table index shared between processes through a 
+    multiprocessing Manager, so worker processes writing different mini 
+    files hand out the same receiver number for the same receiver entry.
+    New numbers follow on from the receiver table of the master file.
+    
+    :param manager: started multiprocessing.Manager
+    :param dict receiver_index: receiver_key --> row number, see 
+                                ph5_tools.generic2ph5.receiver_index
+    :param int n_receivers: number of rows in the receiver table
+    :param list columns: columns of the receiver table, see 
+                         ph5_tools.generic2ph5.receiver_columns
+    
+    .. note:: every new entry is kept with its number, so the receiver 
+              table rows can be committed even for numbers handed out by a
+              worker that failed, see new_entries.
+    """
+    
+    def __init__(self, manager, receiver_index, n_receivers, columns=None):
+        self.columns = columns
+        self.index = manager.dict(receiver_index)
+        self.entries = manager.dict()
+        self.count = manager.Value('i', n_receivers)
+        self.lock = manager.Lock()
+        
+    def get_receiver_n(self, receiver_entry):
+        """
+        get the receiver number of a receiver entry, a new number is made 
+        if the entry is not in the index.
+        
+        :param dict receiver_entry: receiver table entry
+        
+        :return: (exists, receiver number)
+        """
+        key = ph5_tools.receiver_key(receiver_entry, self.columns)
+        with self.lock:
+            n_row = self.index.get(key)
+            if n_row is not None:
+                return True, n_row
+            self.count.value += 1
+            self.index[key] = self.count.value
+            self.entries[self.count.value] = dict(receiver_entry)
+            return False, self.count.value
+        
+    def new_entries(self):
+        """
+        :return: list of (receiver number, receiver entry) of the entries 
+                 added since the index was made, in number order
+        """
+        return sorted(self.entries.items())
+    
 class MTtoPH5Error(Exception):
     """
     Exception raised when there is a problem with the request.
@@ -49,12 +445,39 @@ class MTtoPH5(ph5_tools.generic2ph5):
     :param ph5_path: full path to PH5 file minus the extension
     :type ph5_path: string
     
-    :param num_mini: number of mini files to make
+    :param num_mini: number of mini files to spread the data loggers over,
+                     each data logger is kept in one mini file and goes
+                     into the one with the fewest bytes
     :type num_mini: int
     
     :param first_mini: number of first mini file
     :type first_mini: int
     
+    :param mini_pool_size: number of mini files to keep open at once
+    :type mini_pool_size: int
+    
+    :param buffer_rows: number of entries to hold for a table before they 
+                        are written with one append, 1 writes each row as it
+                        is made
+    :type buffer_rows: int
+    
+    :param aggregate_sorts: write one sorts table entry per array and 
+                            deployment window when to_ph5 finishes instead
+                            of one per channel
+    :type aggregate_sorts: bool
+    
+    :param stats: record time, bytes and peak memory of each stage of
+                  loading, returned by to_ph5.  Can also be a 
+                  ph5_tools.IngestStats object to set memory tracking and a
+                  JSON lines log file.
+    :type stats: bool or ph5_tools.IngestStats
+    
+    :param storage_profile: HDF5 chunking and compression of the data 
+                            arrays, one of 'fast-write', 'compact' or 
+                            'random-access' (see ph5_tools.storage_profiles).
+                            None uses the PH5 defaults.
+    :type storage_profile: string or dict
+    
     .. note:: For now the organization is:
               * Experiment
                   - MT station 01 
@@ -82,16 +505,11 @@ class MTtoPH5(ph5_tools.generic2ph5):
         >>> # turn on verbose logging so we can see more info
         >>> mt_obj.verbose = True
         >>> # only do the first 5 files because that is one schedule or run
-        >>> message, index_t = mt_obj.to_ph5(fn_list[0:5])
-        >>> # now load are index table
-        >>> for entry in index_t:
-        >>>     ph5_obj.ph5_g_receivers.populateIndex_t(entry)
-        >>> 
-        >>> # the last thing we need ot do ater loading
-        >>> # all our data is to update external refeerences
-        >>> # this takes all the mini files and adds their
-        >>> # references to the master so we can find the data
-        >>> mt_obj.update_external_references(index_t)
+        >>> # the index, das, receiver, array and sorts tables are filled in
+        >>> # and the external references to the mini files are made
+        >>> stats = mt_obj.to_ph5(fn_list[0:5])
+        >>> # stages are only timed with MTtoPH5(..., stats=True)
+        >>> print(stats.total)
         >>>  
         >>> # be nice and close the file
         >>> ph5_obj.ph5close()                   
@@ -101,7 +519,12 @@ class MTtoPH5(ph5_tools.generic2ph5):
     def __init__(self, ph5_object=None,
                  ph5_path=None,
                  num_mini=1,
-                 first_mini=1):
+                 first_mini=1,
+                 mini_pool_size=4,
+                 buffer_rows=1000,
+                 aggregate_sorts=False,
+                 stats=False,
+                 storage_profile=None):
         """
         :param ph5_object: Main PH5 object to add files to
         :type ph5_object: PH5.core.experiment
@@ -114,41 +537,90 @@ class MTtoPH5(ph5_tools.generic2ph5):
         
         :param first_mini: number of first mini file
         :type first_mini: int
+        
+        :param mini_pool_size: number of mini files to keep open at once
+        :type mini_pool_size: int
+        
+        :param buffer_rows: number of entries to hold for a table before 
+                            they are written with one append
+        :type buffer_rows: int
+        
+        :param aggregate_sorts: write one sorts table entry per array and 
+                                deployment window instead of per channel
+        :type aggregate_sorts: bool
+        
+        :param stats: record time, bytes and peak memory of each stage
+        :type stats: bool or ph5_tools.IngestStats
+        
+        :param storage_profile: chunking and compression of data arrays
+        :type storage_profile: string or dict
         """
         super().__init__()
+        self.ph5_obj = ph5_object
         self.num_mini = num_mini
         self.first_mini = first_mini
+        self.mini_pool_size = mini_pool_size
+        self.table_buffer.max_rows = buffer_rows
+        self.aggregate_sorts = aggregate_sorts
+        if isinstance(stats, ph5_tools.IngestStats):
+            self.stats = stats
+        else:
+            self.stats = ph5_tools.IngestStats(enabled=stats)
+        if storage_profile is not None:
+            ph5_tools.get_storage_profile(storage_profile)
+        self.storage_profile = storage_profile
         self.logger = logging.getLogger('MTtoPH5')
         self.array_table = None
         
         self.time_t = list()
+        self.ts_outputs = list()
+        ### ascii files bigger than this are read and written in blocks
+        self.stream_min_bytes = 2**28
+        self.stream_block_size = 2**20
         
-    def make_index_t_entry(self, ts_obj):
+    def make_time_record(self, ts_obj):
+        """
+        make the start and end times of a time series once so they can be 
+        shared by all the make_*_entry methods
+        
+        :param ts_obj: MTTS object or TSHeader
+        
+        :returns: ph5_tools.ChannelTimes
+        """
+        if isinstance(ts_obj, TSHeader):
+            return ts_obj.time_record()
+        
+        index = ts_obj.ts.index
+        start = ph5_tools.TimeValue(ts_obj.start_time_utc,
+                                    int(ts_obj.start_time_epoch_sec),
+                                    index[0].microsecond,
+                                    'BOTH')
+        end = ph5_tools.TimeValue(ts_obj.stop_time_utc,
+                                  int(ts_obj.stop_time_epoch_sec),
+                                  index[-1].microsecond,
+                                  'BOTH')
+        return ph5_tools.ChannelTimes(start, end)
+        
+    def make_index_t_entry(self, ts_obj, times=None):
         """
         make a time index dictionry (index_t_entry) for a given time series.
         
         :param ts_obj: MTTS time-series object
+        :param times: start and end times from make_time_record
         :returns: dictionary of necessary values
         """
+        if times is None:
+            times = self.make_time_record(ts_obj)
         index_t_entry = {}
         # start time
-        index_t_entry['start_time/ascii_s'] = (ts_obj.start_time_utc)
-        index_t_entry['start_time/epoch_l'] = (int(ts_obj.start_time_epoch_sec))
-        index_t_entry['start_time/micro_seconds_i'] = (ts_obj.ts.index[0].microsecond)
-        index_t_entry['start_time/type_s'] = 'BOTH'
+        ph5_tools.set_time_value(index_t_entry, 'start_time', times.start)
         
         # end time
-        index_t_entry['end_time/ascii_s'] = (ts_obj.stop_time_utc)
-        index_t_entry['end_time/epoch_l'] = (int(ts_obj.stop_time_epoch_sec))
-        index_t_entry['end_time/micro_seconds_i'] = (ts_obj.ts.index[-1].microsecond)
-        index_t_entry['end_time/type_s'] = 'BOTH'
+        ph5_tools.set_time_value(index_t_entry, 'end_time', times.end)
         
         # time stamp -- when data was entered
-        time_stamp_utc = mtts.datetime.datetime.utcnow()
-        index_t_entry['time_stamp/ascii_s'] = (time_stamp_utc.isoformat())
-        index_t_entry['time_stamp/epoch_l'] = (int(time_stamp_utc.timestamp()))
-        index_t_entry['time_stamp/micro_seconds_i'] = (time_stamp_utc.microsecond)
-        index_t_entry['time_stamp/type_s'] = 'BOTH'
+        ph5_tools.set_time_value(index_t_entry, 'time_stamp',
+                                 self.session_time_stamp)
         
         index_t_entry['serial_number_s'] = ts_obj.data_logger
         index_t_entry['external_file_name_s'] = ''
@@ -178,19 +650,19 @@ class MTtoPH5(ph5_tools.generic2ph5):
         
         return receiver_t_entry
         
-    def make_das_entry(self, ts_obj):
+    def make_das_entry(self, ts_obj, times=None):
         """
         Make a metadata array for a given mtts object
         
         :param ts_obj: MTTS object
+        :param times: start and end times from make_time_record
         :return: dictionary of das information
         """
+        if times is None:
+            times = self.make_time_record(ts_obj)
         das_entry = {}
         # start time information
-        das_entry['time/ascii_s'] = ts_obj.start_time_utc
-        das_entry['time/epoch_l'] = int(ts_obj.start_time_epoch_sec)
-        das_entry['time/micro_seconds_i'] = ts_obj.ts.index[0].microsecond
-        das_entry['time/type_s'] = 'BOTH'
+        ph5_tools.set_time_value(das_entry, 'time', times.start)
         
         das_entry['sample_rate_i'] = ts_obj.sampling_rate
         das_entry['sample_rate_multiplier_i'] = 1
@@ -208,7 +680,7 @@ class MTtoPH5(ph5_tools.generic2ph5):
         
         return das_entry
     
-    def make_array_entry(self, ts_obj):
+    def make_array_entry(self, ts_obj, times=None):
         """
         Make an array entry that will go into the sorts group of the main 
         Experiment object.
@@ -260,8 +732,12 @@ class MTtoPH5(ph5_tools.generic2ph5):
                model_s [string 64] - model 
                manufacturer_s [string 64] - manufacturer
                notes_s [string 1024] - notes on sensor
-        
+               
+        :param ts_obj: MTTS object
+        :param times: start and end times from make_time_record
         """
+        if times is None:
+            times = self.make_time_record(ts_obj)
         array_entry = {}
         array_entry['id_s'] = ts_obj.station
         array_entry['channel_number_i'] = ts_obj.channel_number
@@ -287,14 +763,8 @@ class MTtoPH5(ph5_tools.generic2ph5):
         array_entry['location/Y/units_s'] = 'degrees'
         array_entry['location/Z/value_d'] = ts_obj.elev
         array_entry['location/Z/units_s'] = 'meters'
-        array_entry['deploy_time/ascii_s'] = ts_obj.start_time_utc
-        array_entry['deploy_time/epoch_l'] = int(ts_obj.start_time_epoch_sec)
-        array_entry['deploy_time/micro_seconds_i'] = ts_obj.ts.index[0].microsecond
-        array_entry['deploy_time/type_s'] = 'BOTH'
-        array_entry['pickup_time/ascii_s'] = ts_obj.stop_time_utc
-        array_entry['pickup_time/epoch_l'] = int(ts_obj.stop_time_epoch_sec)
-        array_entry['pickup_time/micro_seconds_i'] = ts_obj.ts.index[-1].microsecond
-        array_entry['pickup_time/type_s'] = 'BOTH'
+        ph5_tools.set_time_value(array_entry, 'deploy_time', times.start)
+        ph5_tools.set_time_value(array_entry, 'pickup_time', times.end)
         array_entry['das/serial_number_s'] = ts_obj.data_logger
         array_entry['das/model_s'] = ts_obj.data_logger 
         array_entry['das/manufacturer_s'] = 'NAROD'
@@ -306,7 +776,7 @@ class MTtoPH5(ph5_tools.generic2ph5):
         
         return array_entry
     
-    def make_sorts_entry(self, ts_obj):
+    def make_sorts_entry(self, ts_obj, times=None):
         """
         Make a sorts entry
         
@@ -330,33 +800,32 @@ class MTtoPH5(ph5_tools.generic2ph5):
                epoch_l [int 64] - epoch seconds
                micro_seconds_i [int 32] - microseconds
                type_s [string 8] - Epoch, UTC, Both
+               
+        :param ts_obj: MTTS object
+        :param times: start and end times from make_time_record
         """
-        
+        if times is None:
+            times = self.make_time_record(ts_obj)
         sorts_entry = {}
         sorts_entry['event_id_s'] = ''
         sorts_entry['array_name_s'] = '001'
         sorts_entry['array_t_name_s'] = 'Array_t_001'
         sorts_entry['description_s'] = 'Magnetotelluric array'
-        sorts_entry['start_time/ascii_s'] = ts_obj.start_time_utc
-        sorts_entry['start_time/epoch_l'] = int(ts_obj.start_time_epoch_sec)
-        sorts_entry['start_time/micro_seconds_i'] = ts_obj.ts.index[0].microsecond
-        sorts_entry['start_time/type_s'] = 'BOTH'
-        sorts_entry['end_time/ascii_s'] = (ts_obj.stop_time_utc)
-        sorts_entry['end_time/epoch_l'] = (int(ts_obj.stop_time_epoch_sec))
-        sorts_entry['end_time/micro_seconds_i'] = (ts_obj.ts.index[-1].microsecond)
-        sorts_entry['end_time/type_s'] = 'BOTH'
-
-        time_stamp_utc = mtts.datetime.datetime.utcnow()
-        sorts_entry['time_stamp/ascii_s'] = (time_stamp_utc.isoformat())
-        sorts_entry['time_stamp/epoch_l'] = (int(time_stamp_utc.timestamp()))
-        sorts_entry['time_stamp/micro_seconds_i'] = (time_stamp_utc.microsecond)
-        sorts_entry['time_stamp/type_s'] = 'BOTH'
+        ph5_tools.set_time_value(sorts_entry, 'start_time', times.start)
+        ph5_tools.set_time_value(sorts_entry, 'end_time', times.end)
+        ph5_tools.set_time_value(sorts_entry, 'time_stamp', 
+                                 self.session_time_stamp)
         
         return sorts_entry
     
     def load_ts_obj(self, ts_fn):
         """
         load an MT file
+        
+        :param ts_fn: full path to MT file or MTTS object
+        
+        :return: MTTS object, or a NIMSSource for NIMS files that hands out
+                 one channel at a time
         """
         if isinstance(ts_fn, str):
             ext = os.path.splitext(ts_fn)[-1][1:].lower()
@@ -365,15 +834,13 @@ class MTtoPH5(ph5_tools.generic2ph5):
                 z3d_obj = zen.Zen3D(ts_fn)
                 z3d_obj.read_z3d()
                 ts_obj = z3d_obj.ts_obj
-            elif ext in ['ex', 'ey', 'hx', 'hy', 'hz']:
+            elif ext in ascii_extensions:
                 self.logger.info('Opening ascii file {0}'.format(ts_fn))
                 ts_obj = mtts.MTTS()
                 ts_obj.read_file(ts_fn)
             elif ext in  ['bnn', 'bin']:
                 self.logger.info('Opening NIMS file {0}'.format(ts_fn))
-                nims_obj = nims.NIMS(ts_fn)
-                ts_obj = [nims_obj.hx, nims_obj.hy, nims_obj.hz, nims_obj.ex, 
-                          nims_obj.ey]
+                ts_obj = NIMSSource(ts_fn)
                 
         elif isinstance(ts_fn, mtts.MTTS):
             ts_obj = ts_fn
@@ -383,6 +850,110 @@ class MTtoPH5(ph5_tools.generic2ph5):
             
         return ts_obj
     
+    def read_data_logger(self, ts_fn):
+        """
+        read the data logger serial number of an MT file from its header 
+        without reading the data.
+        
+        :param ts_fn: full path to MT file or MTTS object
+        
+        :return: data logger serial number with - replaced by _
+        """
+        if isinstance(ts_fn, str):
+            ext = os.path.splitext(ts_fn)[-1][1:].lower()
+            if ext == 'z3d':
+                z3d_obj = zen.Zen3D(ts_fn)
+                z3d_obj.read_all_info()
+                data_logger = z3d_obj.header.data_logger
+            elif ext in ascii_extensions:
+                ts_obj = mtts.MTTS()
+                ts_obj.read_ascii_header(ts_fn)
+                data_logger = ts_obj.data_logger
+            elif ext in  ['bnn', 'bin']:
+                nims_header = nims.NIMSHeader(ts_fn)
+                nims_header.read_header()
+                data_logger = nims_header.box_id
+            else:
+                raise mtts.MTTSError("Do not understand {0}".format(ts_fn))
+        else:
+            data_logger = ts_fn.data_logger
+            
+        return str(data_logger).replace('-', '_')
+    
+    def use_stream(self, ts_fn):
+        """
+        check if a file is read and written in blocks instead of being 
+        loaded whole.  Only MT ascii files bigger than stream_min_bytes are,
+        there is no block reader for Z3D or NIMS files so they are always 
+        loaded whole.
+        
+        :param ts_fn: full path to MT file or MTTS object
+        
+        :return: True if the file is streamed, see stream_file_to_ph5
+        """
+        if not isinstance(ts_fn, str):
+            return False
+        ext = os.path.splitext(ts_fn)[-1][1:].lower()
+        return (ext in ascii_extensions and 
+                os.path.getsize(ts_fn) >= self.stream_min_bytes)
+        
+    def stream_file_to_ph5(self, ts_fn, count=1):
+        """
+        load an MT ascii file into ph5 block by block, see 
+        stream_ts_to_ph5
+        
+        :param str ts_fn: full path to MT ascii file
+        :param int count: first data array number to try
+        
+        :return: data array number used
+        """
+        self.logger.info('Streaming ascii file {0}'.format(ts_fn))
+        ts_header, n_header_lines = read_ascii_header(ts_fn)
+        blocks = iter_ascii_blocks(ts_fn, n_header_lines, 
+                                   self.stream_block_size)
+        
+        return self.stream_ts_to_ph5(ts_header, blocks, count,
+                                     expected_rows=ts_header.n_samples)
+    
+    def iter_ts_objs(self, ts_list, workers=None):
+        """
+        yield the time series object(s) for each item of ts_list in order.
+        
+        If workers is more than 1 files are decoded in a pool of worker 
+        processes, which hand back numpy arrays and header metadata that 
+        are wrapped in TSHeader objects here.  At most 2 * workers files are 
+        decoded ahead of the one being yielded.
+        
+        :param ts_list: list of filenames (full path) or ts objects
+        :param int workers: number of decoding processes
+        """
+        if not workers or workers < 2:
+            for fn in ts_list:
+                yield self.load_ts_obj(fn)
+            return
+        
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            ts_iter = iter(ts_list)
+            while True:
+                while len(pending) < 2 * workers:
+                    try:
+                        fn = next(ts_iter)
+                    except StopIteration:
+                        break
+                    if isinstance(fn, str):
+                        pending.append((fn, executor.submit(decode_ts_file, fn)))
+                    else:
+                        pending.append((fn, None))
+                if not pending:
+                    break
+                fn, future = pending.popleft()
+                if future is None:
+                    yield self.load_ts_obj(fn)
+                else:
+                    self.logger.info('Decoded {0}'.format(fn))
+                    yield [record_to_ts(record) for record in future.result()]
+            
     def get_current_das(self, ph5_object, data_logger):
         """
         get the current DAS table from a PH5 object
@@ -394,100 +965,646 @@ class MTtoPH5(ph5_tools.generic2ph5):
             
         return das_table
     
+    def open_das_mini(self, data_logger, n_bytes=0):
+        """
+        get the mini file a data logger goes into and set its das group as
+        the current one.
+        
+        :param str data_logger: data logger serial number
+        :param int n_bytes: projected bytes of the data to be written
+        
+        :return: mini PH5 object, mini file name, mini number
+        """
+        current_mini = self.get_current_mini_num(data_logger, n_bytes=n_bytes)
+        mini_handle, mini_name = self.get_mini(current_mini)
+        
+        current_das_table_mini = self.get_current_das(mini_handle,
+                                                      data_logger)
+        mini_handle.ph5_g_receivers.setcurrent(current_das_table_mini)
+        
+        return mini_handle, mini_name, current_mini
+    
     def single_ts_to_ph5(self, ts_obj, count=1):
         """
         load a single time series into ph5
         """
         ts_obj.data_logger = ts_obj.data_logger.replace('-', '_')
         ts_obj.sampling_rate = int(ts_obj.sampling_rate)
-        ### start populating das table and data arrays
-        index_t_entry = self.make_index_t_entry(ts_obj)
-        das_t_entry = self.make_das_entry(ts_obj)
-        receiver_t_entry = self.make_receiver_entry(ts_obj)
-        array_t_entry = self.make_array_entry(ts_obj)
-        sorts_t_entry = self.make_sorts_entry(ts_obj)
-        
-        receiver_exists, receiver_count = self.get_receiver_n(receiver_t_entry)
-        
-        ### add receiver entry number
-        das_t_entry['receiver_table_n_i'] = receiver_count
-        das_t_entry['response_table_n_i'] = count
-        array_t_entry['receiver_table_n_i'] = receiver_count
+        response_n = count
         
         ### get the current mini file
-        current_mini = self.get_current_mini_num(ts_obj.data_logger)
-        mini_handle, mini_name = self.open_mini(current_mini)
-        
-        current_das_table_mini = self.get_current_das(mini_handle,
-                                                      ts_obj.data_logger)
-        mini_handle.ph5_g_receivers.setcurrent(current_das_table_mini)
+        mini_handle, mini_name, current_mini = self.open_das_mini(
+                                                    ts_obj.data_logger,
+                                                    ts_obj.ts.data.nbytes)
         
         ### make name for array data going into mini file
-        while True:
-            next_ = '{0:05}'.format(count)
-            das_t_entry['array_name_data_a'] = "Data_a_{0}".format(next_)
-            node = mini_handle.ph5_g_receivers.find_trace_ref(das_t_entry['array_name_data_a'])
-            if not node:
-                break
-            count = count + 1
-            continue
+        count, array_name = self.next_array_name(mini_handle, count)
+        self.ts_outputs.append({'das': ts_obj.data_logger,
+                                'array': array_name,
+                                'mini': mini_name})
         
         ### make a new array
-        mini_handle.ph5_g_receivers.newarray(das_t_entry['array_name_data_a'],
-                                             ts_obj.ts.data,
-                                             dtype=ts_obj.ts.data.dtype,
-                                             description=None)
+        with self.stats.stage('write_array', ts_obj.ts.data.nbytes):
+            ph5_tools.write_array(mini_handle, array_name, ts_obj.ts.data,
+                                  profile=self.storage_profile,
+                                  sampling_rate=ts_obj.sampling_rate)
+        self.update_mini_catalog(current_mini, ts_obj.data_logger,
+                                 ts_obj.ts.data.nbytes)
+        
+        self.populate_ts_tables(ts_obj, mini_handle, mini_name, array_name,
+                                response_n)
+        
+        return count
+    
+    def raw_to_ph5(self, data, start_time, sampling_rate, count=1, 
+                   **kwargs):
+        """
+        load a single channel held in a numpy array into ph5 without making
+        an MTTS object.  A C-contiguous array is handed to the HDF5 writer 
+        as is, no pandas index is built and the buffer is not copied.
+        
+        :param np.ndarray data: contiguous data array
+        :param start_time: time of the first sample in UTC
+        :type start_time: string or datetime
+        :param float sampling_rate: samples per second
+        :param int count: first data array number to try
+        
+        Any other key word is a TSHeader attribute, for example station, 
+        component, channel_number, data_logger.
+        
+        :return: data array number used
+        
+        :Example: ::
+            
+            >>> data = np.fromfile('ex.int32', dtype=np.int32)
+            >>> mt_obj.raw_to_ph5(data, '2020-01-01T00:00:00', 4096,
+            >>> ...               station='mt01', component='ex',
+            >>> ...               channel_number=4, data_logger='ZEN_024')
+        """
+        buffer = np.ascontiguousarray(data)
+        if not np.shares_memory(buffer, data):
+            self.logger.warning('Data for {0} is not contiguous and was '
+                                'copied'.format(kwargs.get('component')))
+        ts_header = TSHeader(start_time, sampling_rate, data=buffer, **kwargs)
+        
+        return self.single_ts_to_ph5(ts_header, count)
+    
+    def stream_ts_to_ph5(self, ts_header, blocks, count=1, 
+                         expected_rows=None):
+        """
+        load a single time series into ph5 from blocks of data, only one 
+        block is in memory at a time.  The data are appended to an 
+        extendable array in the mini file and the number of samples and end
+        times are filled in once all the blocks are written.
+        
+        to_ph5 uses this for MT ascii files bigger than stream_min_bytes, 
+        see stream_file_to_ph5.  Z3D and NIMS files have no block reader and
+        are still loaded a whole channel at a time.
+        
+        :param ts_header: time series header, n_samples is set here
+        :type ts_header: TSHeader
+        
+        :param blocks: iterable of numpy arrays, see ph5_tools.iter_blocks
+        :param int count: first data array number to try
+        :param int expected_rows: expected number of samples, used to pick
+                                  the HDF5 chunk size
+        
+        :return: data array number used
+        
+        :Example: ::
+            
+            >>> data = np.load('long_ex.npy', mmap_mode='r')
+            >>> header = mttoph5.TSHeader('2020-01-01T00:00:00', 256,
+            >>> ...                       station='mt01', component='ex',
+            >>> ...                       channel_number=4, 
+            >>> ...                       data_logger='ZEN_024')
+            >>> mt_obj.stream_ts_to_ph5(header,
+            >>> ...                     ph5_tools.iter_blocks(data, 2**20))
+        """
+        ts_header.data_logger = ts_header.data_logger.replace('-', '_')
+        ts_header.sampling_rate = int(ts_header.sampling_rate)
+        response_n = count
+        
+        mini_handle, mini_name, current_mini = self.open_das_mini(
+                                    ts_header.data_logger,
+                                    ph5_tools.projected_bytes(expected_rows or 0))
+        count, array_name = self.next_array_name(mini_handle, count)
+        self.ts_outputs.append({'das': ts_header.data_logger,
+                                'array': array_name,
+                                'mini': mini_name})
+        
+        with self.stats.stage('write_array') as stage:
+            n_samples, n_bytes = ph5_tools.write_array_stream(
+                                    mini_handle, array_name, blocks, 
+                                    expected_rows=expected_rows,
+                                    profile=self.storage_profile,
+                                    sampling_rate=ts_header.sampling_rate)
+            if stage is not None:
+                stage.n_bytes = n_bytes
+        ts_header.n_samples = n_samples
+        self.update_mini_catalog(current_mini, ts_header.data_logger, n_bytes)
+        
+        self.populate_ts_tables(ts_header, mini_handle, mini_name, 
+                                array_name, response_n)
+        
+        return count
+    
+    def make_ts_rows(self, ts_obj, mini_name, array_name, response_n,
+                     get_receiver_n=None):
+        """
+        make the table rows for a time series whose data array has been 
+        written.
+        
+        :param ts_obj: MTTS object or TSHeader
+        :param str mini_name: mini file name
+        :param str array_name: name of the data array
+        :param int response_n: response table number
+        :param get_receiver_n: function that returns (exists, number) of a
+                               receiver entry, default is 
+                               self.get_receiver_n
+        
+        :return: dictionary with keys
+        
+            * index_t --> Index_t entry
+            * das_t --> Das_t entry, goes in the mini and master files
+            * receiver_t --> Receiver_t entry if it is new otherwise None
+            * array_t --> Array_t entry
+            * sorts_t --> Sort_t entry
+            * das --> data logger
+            * mini --> mini file name
+            * array --> data array name
+        """
+        if get_receiver_n is None:
+            get_receiver_n = self.get_receiver_n
+        ### start populating das table and data arrays
+        with self.stats.stage('metadata'):
+            times = self.make_time_record(ts_obj)
+            index_t_entry = self.make_index_t_entry(ts_obj, times)
+            das_t_entry = self.make_das_entry(ts_obj, times)
+            receiver_t_entry = self.make_receiver_entry(ts_obj)
+            array_t_entry = self.make_array_entry(ts_obj, times)
+            sorts_t_entry = self.make_sorts_entry(ts_obj, times)
+        
+        with self.stats.stage('receiver_lookup'):
+            receiver_exists, receiver_count = get_receiver_n(receiver_t_entry)
+        
+        ### add receiver entry number
+        das_t_entry['receiver_table_n_i'] = receiver_count
+        das_t_entry['response_table_n_i'] = response_n
+        das_t_entry['array_name_data_a'] = array_name
+        array_t_entry['receiver_table_n_i'] = receiver_count
         
         ### create external file names
         index_t_entry['external_file_name_s'] = "./{}".format(mini_name)
         das_path = "/Experiment_g/Receivers_g/Das_g_{0}".format(ts_obj.data_logger)
         index_t_entry['hdf5_path_s'] = das_path
         
-        ### populate metadata tables 
-        ### DAS goes in both mini and main
-        mini_handle.ph5_g_receivers.populateDas_t(das_t_entry)
+        if receiver_exists:
+            receiver_t_entry = None
+        
+        return {'index_t': index_t_entry,
+                'das_t': das_t_entry,
+                'receiver_t': receiver_t_entry,
+                'array_t': array_t_entry,
+                'sorts_t': sorts_t_entry,
+                'das': ts_obj.data_logger,
+                'mini': mini_name,
+                'array': array_name}
+        
+    def commit_master_rows(self, rows):
+        """
+        add the rows made by make_ts_rows that go in the master PH5 file
         
+        :param dict rows: rows from make_ts_rows
+        """
+        if self.array_table is None:
+            self.array_table = self.ph5_obj.ph5_g_sorts.newArraySort('Array_t_001')
+        ### DAS goes in both mini and main
         current_das_table_main = self.get_current_das(self.ph5_obj, 
-                                                      ts_obj.data_logger)
+                                                      rows['das'])
         self.ph5_obj.ph5_g_receivers.setcurrent(current_das_table_main)
-        self.ph5_obj.ph5_g_receivers.populateDas_t(das_t_entry)
+        self.buffer_row(self.ph5_obj.ph5_g_receivers.current_t_das,
+                        rows['das_t'])
         ### index and receivers goes in main
-        self.ph5_obj.ph5_g_receivers.populateIndex_t(index_t_entry)
-        if not receiver_exists:
-            self.ph5_obj.ph5_g_receivers.populateReceiver_t(receiver_t_entry)
-        #mini_handle.ph5_g_receivers.populateTime_t_()
-        columns.populate(self.array_table, array_t_entry)
-        self.ph5_obj.ph5_g_sorts.populateSort_t(sorts_t_entry)
-
-        # Don't forget to close minifile
-        mini_handle.ph5close()
+        self.add_index_entry(rows['index_t'])
+        if rows['receiver_t'] is not None:
+            self.add_reciever_to_table(rows['receiver_t'])
+        self.append_array_entry('Array_t_001', rows['array_t'])
+        self.add_sort_entry(rows['sorts_t'])
+    
+    def populate_ts_tables(self, ts_obj, mini_handle, mini_name, array_name,
+                           response_n):
+        """
+        populate the metadata tables for a time series whose data array has
+        been written.
+        
+        :param ts_obj: MTTS object or TSHeader
+        :param mini_handle: mini PH5 object the data array is in
+        :param str mini_name: mini file name
+        :param str array_name: name of the data array
+        :param int response_n: response table number
+        """
+        rows = self.make_ts_rows(ts_obj, mini_name, array_name, response_n)
+        
+        ### populate metadata tables 
+        with self.stats.stage('populate_tables'):
+            self.buffer_row(mini_handle.ph5_g_receivers.current_t_das,
+                            rows['das_t'])
+            #mini_handle.ph5_g_receivers.populateTime_t_()
+            self.commit_master_rows(rows)
         
         self.logger.info('Loaded {0} to mini file {1}'.format(ts_obj.fn, 
                          mini_name))
         
-        return count
-        
 
-    def to_ph5(self, ts_list):
+    def get_das_bytes(self, ts_list):
+        """
+        projected bytes of data for each data logger in a list of time 
+        series objects, used to plan the mini files.
+        
+        :param ts_list: list of MTTS objects or TSHeaders
+        
+        :return: dictionary of data logger --> bytes
+        """
+        das_bytes = {}
+        for ts_obj in ts_list:
+            data_logger = ts_obj.data_logger.replace('-', '_')
+            das_bytes.setdefault(data_logger, 0)
+            das_bytes[data_logger] += ts_obj.ts.data.nbytes
+        
+        return das_bytes
+    
+    def skip_loaded(self, ts_list):
+        """
+        remove files that the ingest ledger of the master file says are 
+        already loaded and have not changed since.
+        
+        :param list ts_list: list of filenames (full path) or ts objects
+        
+        :return: list of (count, file or ts object) still to load, count is
+                 the place in ts_list starting at 1 so the array and 
+                 response numbers made from it are the same as if no files
+                 were skipped
+        """
+        if self.ledger is None:
+            self.ledger = ph5_tools.IngestLedger(self.ledger_fn, 
+                                                 self.master_id)
+        ts_items = [(count, fn) for count, fn in enumerate(ts_list, 1)
+                    if not (isinstance(fn, str) and self.ledger.is_done(fn))]
+        self.logger.info('Skipping {0} files already loaded'.format(
+                         len(ts_list) - len(ts_items)))
+        
+        return ts_items
+    
+    def to_ph5(self, ts_list, workers=None, resume=False):
         """
         Takes a list of either files or MTTS objects and puts them into a 
         PH5 file.
         
         :param ts_list: list of filenames (full path) or ts objects
-        :returns: success message
+        :param int workers: number of processes used to decode files, the
+                            PH5 file is still written by this process only.
+        :param bool resume: keep a ledger of loaded files next to the PH5
+                            file and skip files that are in it and have not
+                            changed, so a stopped ingest can be rerun.  The
+                            ledger is named after the master file and is 
+                            discarded if the master file is made again.
+        :returns: ingest statistics, see ph5_tools.IngestStats.  Stages are
+                  only recorded if stats were turned on with 
+                  MTtoPH5(stats=True)
+                  
+        .. note:: MT ascii files bigger than stream_min_bytes are written 
+                  block by block, see use_stream.  Z3D and NIMS files are 
+                  loaded a whole channel at a time.
         """
         if self.array_table is None:
             self.array_table = self.ph5_obj.ph5_g_sorts.newArraySort('Array_t_001')
+        self.new_session()
+        
+        ts_list = list(ts_list)
+        if resume:
+            ts_items = self.skip_loaded(ts_list)
+        else:
+            ts_items = list(enumerate(ts_list, 1))
+        ts_list = [fn for count, fn in ts_items]
 
-        # check if we are opening a file or mt ts object
-        for count, fn in enumerate(ts_list, 1):
-            ts_obj = self.load_ts_obj(fn)
-            if isinstance(ts_obj, list):
-                for single_ts_obj in ts_obj:
-                    count = self.single_ts_to_ph5(single_ts_obj, count)
+        # if the time series are already in memory plan the mini files
+        if ts_list and not any([isinstance(fn, str) for fn in ts_list]):
+            self.plan_minis(self.get_das_bytes(ts_list))
+            
+        # check if we are opening a file or mt ts object, big ascii files
+        # are streamed so they are not decoded here
+        streamed = set([count for count, fn in ts_items 
+                        if self.use_stream(fn)])
+        ts_iter = self.iter_ts_objs([fn for count, fn in ts_items 
+                                     if count not in streamed], workers)
+        try:
+            for count, fn in ts_items:
+                self.stats.start_file(fn)
+                self.ts_outputs = []
+                self.mark_rollback()
+                try:
+                    self.file_to_ph5(fn, count, count in streamed, ts_iter)
+                except BaseException:
+                    ### take back the channels of a file that failed part
+                    ### way so a rerun does not load them twice
+                    self.logger.error('Loading {0} failed, rolling back '
+                                      '{1} data arrays'.format(fn, 
+                                      len(self.ts_outputs)))
+                    for key in self.rollback(self.ts_outputs):
+                        self.logger.warning('Could not roll back {1} in '
+                                            '{0}'.format(*key))
+                    raise
+                if resume and isinstance(fn, str):
+                    self.ledger.record(fn, self.ts_outputs)
+                self.stats.end_file()
+        finally:
+            ts_iter.close()
+            # Don't forget to close mini files, even if the flush fails
+            try:
+                self.flush()
+            finally:
+                self.close_minis()
+                self.stats.write_log({'total': self.stats.total})
+        
+        return self.stats
+    
+    def file_to_ph5(self, fn, count, stream, ts_iter):
+        """
+        load one file or ts object of to_ph5, the data arrays written are
+        listed in ts_outputs.
+        
+        :param fn: file name (full path) or ts object
+        :param int count: first data array number to try
+        :param bool stream: write the file block by block, see use_stream
+        :param ts_iter: iterator of decoded ts objects, see iter_ts_objs, 
+                        the next one belongs to fn unless stream is True
+        """
+        if stream:
+            self.stream_file_to_ph5(fn, count)
+            return
+        with self.stats.stage('decode'):
+            ts_obj = next(ts_iter)
+        if isinstance(ts_obj, (list, NIMSSource)):
+            for single_ts_obj in ts_obj:
+                count = self.single_ts_to_ph5(single_ts_obj, count)
+                ### let go of the channel before the next one is made
+                del single_ts_obj
+        else:
+            self.single_ts_to_ph5(ts_obj, count)
+        
+    def plan_parallel_jobs(self, ts_items, num_mini, das_map=None):
+        """
+        split a list of files or time series objects into jobs for each mini
+        file.  Files and time series objects are grouped by data logger, so
+        a data logger is only written by one worker into one mini file.  The
+        groups are spread over the mini files by size with
+        ph5_tools.plan_mini_placement.
+        
+        :param list ts_items: list of (count, filename or ts object), see 
+                              skip_loaded
+        :param int num_mini: number of mini files
+        :param dict das_map: file name --> data logger serial number, files
+                             not in it have the data logger read from their
+                             header, see read_data_logger
+        
+        :return: dictionary of mini number --> list of (count, file or 
+                 record) in the order of ts_items
+        """
+        das_map = das_map or {}
+        group_bytes = {}
+        group_jobs = {}
+        for count, fn in ts_items:
+            if isinstance(fn, str):
+                if fn in das_map:
+                    key = das_map[fn].replace('-', '_')
+                else:
+                    key = self.read_data_logger(fn)
+                n_bytes = os.path.getsize(fn)
+                job = fn
             else:
-                count = self.single_ts_to_ph5(ts_obj, count)
+                key = fn.data_logger.replace('-', '_')
+                job = ts_to_record(fn)
+                n_bytes = job[1].nbytes
+            group_bytes[key] = group_bytes.get(key, 0) + n_bytes
+            group_jobs.setdefault(key, []).append((count, job))
+            
+        placement = ph5_tools.plan_mini_placement(
+                                        group_bytes, 
+                                        num_mini=num_mini,
+                                        mini_size_max=self.mini_size_max,
+                                        first_mini=self.first_mini,
+                                        existing=self.mini_catalog)
+        mini_jobs = {}
+        for key, jobs in group_jobs.items():
+            mini_jobs.setdefault(placement[key], []).extend(jobs)
+        for jobs in mini_jobs.values():
+            jobs.sort(key=lambda job: job[0])
+            
+        return mini_jobs
+    
+    def write_mini_jobs(self, mini_handle, mini_name, jobs, receivers):
+        """
+        write the data arrays and mini Das_t rows for a list of jobs into 
+        one mini file.  This is run in a worker process by write_mini_file,
+        the rows for the master file are handed back.
         
-        return "done"
-
-
+        :param mini_handle: open mini PH5 object
+        :param str mini_name: mini file name
+        :param list jobs: list of (count, file or record), see 
+                          plan_parallel_jobs
+        :param receivers: receiver numbers shared between processes
+        :type receivers: SharedReceiverIndex
+        
+        :return: list of rows, see make_ts_rows, with the extra keys count
+                 and n_bytes
+        """
+        rows_list = []
+        for count, job in jobs:
+            if isinstance(job, tuple):
+                ts_obj = record_to_ts(job)
+            else:
+                ts_obj = self.load_ts_obj(job)
+            if not isinstance(ts_obj, (list, NIMSSource)):
+                ts_obj = [ts_obj]
+            array_num = count
+            for single_ts_obj in ts_obj:
+                single_ts_obj.data_logger = \
+                                single_ts_obj.data_logger.replace('-', '_')
+                single_ts_obj.sampling_rate = int(single_ts_obj.sampling_rate)
+                das_group = self.get_current_das(mini_handle, 
+                                                 single_ts_obj.data_logger)
+                mini_handle.ph5_g_receivers.setcurrent(das_group)
+                array_num, array_name = self.next_array_name(mini_handle,
+                                                             array_num)
+                ph5_tools.write_array(mini_handle, array_name, 
+                                      single_ts_obj.ts.data,
+                                      profile=self.storage_profile,
+                                      sampling_rate=single_ts_obj.sampling_rate)
+                
+                rows = self.make_ts_rows(single_ts_obj, mini_name, array_name,
+                                         count, receivers.get_receiver_n)
+                self.buffer_row(mini_handle.ph5_g_receivers.current_t_das,
+                                rows['das_t'])
+                rows['count'] = count
+                rows['n_bytes'] = single_ts_obj.ts.data.nbytes
+                rows_list.append(rows)
+                self.logger.info('Loaded {0} to mini file {1}'.format(
+                                 single_ts_obj.fn, mini_name))
+                del single_ts_obj
+        self.flush_tables()
+        
+        return rows_list
+    
+    def to_ph5_parallel(self, ts_list, workers=None, resume=False, 
+                        das_map=None):
+        """
+        Put a list of files or MTTS objects into a PH5 file writing several
+        mini files at the same time, one worker process per mini file.
+        
+        The files are spread over the mini files by size, see 
+        plan_parallel_jobs.  Each worker decodes its files and writes the 
+        data arrays and Das_t rows of its mini file.  Receiver numbers are
+        handed out through a SharedReceiverIndex so they agree between 
+        workers.  The rows for the master file (Index_t, Das_t, Receiver_t,
+        Array_t, Sort_t) are sent back and committed here in the order of
+        ts_list, so the master file is only written by this process.
+        
+        :param ts_list: list of filenames (full path) or ts objects
+        :param int workers: number of worker processes, default is the 
+                            number of CPUs
+        :param bool resume: skip files already in the ingest ledger, see 
+                            to_ph5
+        :param dict das_map: file name --> data logger serial number, see
+                             plan_parallel_jobs
+        :returns: ingest statistics, see ph5_tools.IngestStats
+        
+        .. note:: if num_mini is more than 1 the files are spread over 
+                  num_mini mini files, otherwise over one mini file per 
+                  worker.
+        
+        .. note:: receiver numbers handed out by a worker that fails are 
+                  still written to the receiver table, so the numbers the 
+                  other workers wrote to their mini files stay correct.
+        """
+        if self.array_table is None:
+            self.array_table = self.ph5_obj.ph5_g_sorts.newArraySort('Array_t_001')
+        self.new_session()
+        
+        ts_list = list(ts_list)
+        if resume:
+            ts_items = self.skip_loaded(ts_list)
+        else:
+            ts_items = list(enumerate(ts_list, 1))
+        if not ts_items:
+            return self.stats
+        
+        workers = workers or os.cpu_count() or 1
+        num_mini = self.num_mini if self.num_mini and self.num_mini > 1 \
+                   else workers
+        mini_jobs = self.plan_parallel_jobs(ts_items, num_mini, das_map)
+        
+        ### workers open the mini files so they cannot be open here, and the
+        ### receiver table has to be up to date to seed the shared index
+        self.close_minis()
+        self.flush_tables()
+        settings = {'buffer_rows': self.table_buffer.max_rows,
+                    'storage_profile': self.storage_profile}
+        
+        rows_list = []
+        new_receivers = []
+        errors = []
+        try:
+            with self.stats.stage('parallel_write'):
+                with Manager() as manager, ProcessPoolExecutor(
+                        max_workers=min(workers, len(mini_jobs))) as executor:
+                    receivers = SharedReceiverIndex(manager, 
+                                                    self.receiver_index,
+                                                    self._n_receivers,
+                                                    self.receiver_columns)
+                    futures = [executor.submit(write_mini_file, 
+                                               self.ph5_path, mini_num, jobs,
+                                               self.session_time_stamp,
+                                               receivers, settings)
+                               for mini_num, jobs in sorted(mini_jobs.items())]
+                    for future in futures:
+                        try:
+                            rows_list.extend(future.result())
+                        except Exception as error:
+                            self.logger.error('Writing mini file failed: '
+                                              '{0}'.format(error))
+                            errors.append(error)
+                    new_receivers = receivers.new_entries()
+            
+            ### the mini files were written by the workers, counters and 
+            ### lookups made from them here are out of date
+            self._next_array_num = {}
+            self.invalidate_das_station_map()
+            self._time_index = None
+            
+            with self.stats.stage('populate_tables'):
+                self.commit_parallel_rows(rows_list, ts_items, resume,
+                                          new_receivers)
+            for mini_num in mini_jobs:
+                self.update_mini_stat(mini_num)
+        finally:
+            try:
+                self.flush()
+            finally:
+                self.close_minis()
+            
+        if errors:
+            raise MTtoPH5Error('{0} mini files failed, the data that was '
+                               'written has been added to the master '
+                               'file'.format(len(errors))) from errors[0]
+        
+        return self.stats
+    
+    def commit_parallel_rows(self, rows_list, ts_items, resume=False,
+                             new_receivers=None):
+        """
+        commit the master file rows sent back by the workers of 
+        to_ph5_parallel.  New receivers are added in the order of their 
+        numbers so the row numbers match the numbers the workers used.
+        
+        :param list rows_list: list of rows from write_mini_jobs
+        :param list ts_items: list of (count, file or ts object) that were
+                              loaded
+        :param bool resume: record loaded files in the ingest ledger
+        :param list new_receivers: list of (receiver number, receiver entry)
+                                   of every number handed out, see 
+                                   SharedReceiverIndex.new_entries.  Default 
+                                   is the new receivers in rows_list.
+        """
+        if new_receivers is None:
+            new_receivers = [(rows['das_t']['receiver_table_n_i'], 
+                              rows['receiver_t']) for rows in rows_list
+                             if rows['receiver_t'] is not None]
+        for receiver_n, receiver_entry in sorted(new_receivers, 
+                                                 key=lambda item: item[0]):
+            n_row = self.add_reciever_to_table(receiver_entry)
+            if n_row != receiver_n:
+                self.logger.warning('Receiver number {0} was written to row '
+                                    '{1}'.format(receiver_n, n_row))
+        for rows in rows_list:
+            rows['receiver_t'] = None
+        
+        outputs = {}
+        for rows in sorted(rows_list, key=lambda rows: rows['count']):
+            array_t_entry = rows['array_t']
+            array_t_entry['response_table_n_i'] = self.get_response_n(
+                                            array_t_entry['id_s'],
+                                            array_t_entry['sample_rate_i'],
+                                            array_t_entry['channel_number_i'])
+            self.commit_master_rows(rows)
+            self.update_mini_catalog(ph5_tools.get_mini_num(rows['mini']),
+                                     rows['das'], rows['n_bytes'])
+            outputs.setdefault(rows['count'], []).append(
+                                                    {'das': rows['das'],
+                                                     'array': rows['array'],
+                                                     'mini': rows['mini']})
+        
+        if resume:
+            for count, fn in ts_items:
+                if isinstance(fn, str) and count in outputs:
+                    self.ledger.record(fn, outputs[count])
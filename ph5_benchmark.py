@@ -0,0 +1,589 @@
+# -*- coding: utf-8 -*-
+"""
+==============
+PH5 Benchmark
+==============
+
+Reproducible benchmarks of the ingest pipeline.  Synthetic MTTS objects are
+made for a survey of a given size, or real MT files are read, and loaded 
+into a PH5 file in a temporary directory with MTtoPH5.to_ph5 and with the
+generic2ph5 calls.  Throughput,
+per channel latency and how they scale with survey size are reported and
+can be saved as JSON to compare between releases.  The storage profiles of
+the data arrays can be compared by write speed, file size and how long it
+takes to read a window of data.
+
+:Example: ::
+
+    $ python ph5_benchmark.py --stations 1 10 50 --channels 5
+    $ ...                     --sampling-rate 256 --duration 600
+    $ ...                     --output bench_results.json
+    $ python ph5_benchmark.py --profiles --stations 5 --duration 3600
+    $ python ph5_benchmark.py --profiles --files /home/mt/mt01/*.Z3D
+
+    >>> import ph5_benchmark
+    >>> results = ph5_benchmark.run_suite([1, 10], n_channels=5)
+    >>> ph5_benchmark.save_results(results, 'bench_results.json')
+    >>> profiles = ph5_benchmark.run_profile_suite(5, window_seconds=10)
+"""
+
+# =============================================================================
+# Imports
+# =============================================================================
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+
+import numpy as np
+import tables
+
+import ph5_tools
+import mttoph5
+from ph5.core import experiment
+from mtpy.core import ts as mtts
+
+# =============================================================================
+# global variables
+# =============================================================================
+components = ['ex', 'ey', 'hx', 'hy', 'hz']
+
+# =============================================================================
+# Synthetic data
+# =============================================================================
+def make_synthetic_ts(station, component, channel_number, sampling_rate=256,
+                      duration=600, start_time='2020-01-01T00:00:00+00:00',
+                      data_logger=None, seed=0):
+    """
+    make a synthetic MTTS object filled with 24 bit counts that follow a 
+    random walk.  Like MT data the power falls off with frequency, so the 
+    samples compress about as well as real data and storage profiles 
+    compare fairly, which white noise does not.
+
+    :param str station: station name
+    :param str component: component [ ex | ey | hx | hy | hz ]
+    :param int channel_number: channel number
+    :param int sampling_rate: samples per second
+    :param float duration: length of the time series in seconds
+    :param str start_time: start time in UTC
+    :param str data_logger: data logger serial number, default is made from
+                            the station name
+    :param int seed: random seed so runs are reproducible
+
+    :return: MTTS object
+    """
+    n_samples = int(sampling_rate * duration)
+    generator = np.random.RandomState(seed)
+
+    ts_obj = mtts.MTTS()
+    ts_obj.station = station
+    ts_obj.component = component
+    ts_obj.channel_number = channel_number
+    ts_obj.data_logger = data_logger or 'DL_{0}'.format(station)
+    ts_obj.fn = 'synthetic_{0}_{1}'.format(station, component)
+    ts_obj.azimuth = 0 if component[-1] in ['x', 'z'] else 90
+    ts_obj.dipole_length = 100 if component.startswith('e') else 0
+    ts_obj.lat = 40.0
+    ts_obj.lon = -115.0
+    ts_obj.elev = 1000.0
+    ts_obj.sampling_rate = sampling_rate
+    ts_obj.start_time_utc = start_time
+    steps = generator.normal(scale=2**6, size=n_samples)
+    ts_obj.ts = np.clip(np.cumsum(steps), -2**23, 2**23 - 1).astype(np.int32)
+
+    return ts_obj
+
+def make_synthetic_survey(n_stations, n_channels=5, sampling_rate=256,
+                          duration=600, start_time='2020-01-01T00:00:00+00:00'):
+    """
+    make a list of synthetic MTTS objects for a survey
+
+    :param int n_stations: number of stations
+    :param int n_channels: number of channels per station, at most 5
+    :param int sampling_rate: samples per second
+    :param float duration: length of each channel in seconds
+    :param str start_time: start time in UTC
+
+    :return: list of MTTS objects
+    """
+    ts_list = []
+    for ii in range(n_stations):
+        station = 'mt{0:03}'.format(ii + 1)
+        for jj, component in enumerate(components[0:n_channels], 1):
+            ts_list.append(make_synthetic_ts(station, component, jj,
+                                             sampling_rate=sampling_rate,
+                                             duration=duration,
+                                             start_time=start_time,
+                                             seed=ii * 10 + jj))
+    return ts_list
+
+def load_files(fn_list):
+    """
+    read real MT files for the benchmarks instead of making synthetic data
+    
+    :param list fn_list: list of MT files (full path), any file 
+                         MTtoPH5.load_ts_obj can read
+                         
+    :return: list of MTTS objects or TSHeaders, one per channel
+    """
+    mt_obj = mttoph5.MTtoPH5()
+    ts_list = []
+    for fn in fn_list:
+        ts_obj = mt_obj.load_ts_obj(fn)
+        if isinstance(ts_obj, (list, mttoph5.NIMSSource)):
+            ts_list.extend(list(ts_obj))
+        else:
+            ts_list.append(ts_obj)
+    return ts_list
+
+def make_array_dict(ts_obj):
+    """
+    make an array dictionary for the generic2ph5 calls from an MTTS object
+
+    :param ts_obj: MTTS object
+
+    :return: array dictionary, see generic2ph5.add_array_to_sorts
+    """
+    array_dict = {'id_s': ts_obj.station,
+                  'description_s': ts_obj.component,
+                  'channel_number_i': ts_obj.channel_number,
+                  'sample_rate_i': int(ts_obj.sampling_rate),
+                  'sample_rate_multiplier_i': 1,
+                  'receiver_table_n_i': 0,
+                  'response_table_n_i': 0,
+                  'das/serial_number_s': ts_obj.data_logger,
+                  'location/X/value_d': ts_obj.lon,
+                  'location/Y/value_d': ts_obj.lat,
+                  'location/Z/value_d': ts_obj.elev,
+                  'deploy_time/ascii_s': ts_obj.start_time_utc,
+                  'deploy_time/type_s': 'BOTH',
+                  'pickup_time/ascii_s': ts_obj.stop_time_utc,
+                  'pickup_time/type_s': 'BOTH'}
+    return ph5_tools.validate_time_metadata(array_dict)
+
+# =============================================================================
+# Timing tools
+# =============================================================================
+class TimedMTtoPH5(mttoph5.MTtoPH5):
+    """
+    MTtoPH5 that records how long each channel takes to load
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channel_times = []
+
+    def single_ts_to_ph5(self, ts_obj, count=1):
+        st = time.perf_counter()
+        count = super().single_ts_to_ph5(ts_obj, count)
+        self.channel_times.append(time.perf_counter() - st)
+        return count
+
+def summarize_times(times):
+    """
+    summarize a list of latencies in seconds
+
+    :param list times: latencies in seconds
+
+    :return: dictionary of n, mean, median, p95, max and total
+    """
+    if not times:
+        return {'n': 0}
+    times = np.array(times)
+    return {'n': int(times.size),
+            'mean_s': float(times.mean()),
+            'median_s': float(np.median(times)),
+            'p95_s': float(np.percentile(times, 95)),
+            'max_s': float(times.max()),
+            'total_s': float(times.sum())}
+
+def throughput(n_samples, n_bytes, seconds):
+    """
+    :return: dictionary of samples/s and MB/s
+    """
+    seconds = max(seconds, 1E-9)
+    return {'samples_per_s': n_samples / seconds,
+            'mb_per_s': n_bytes / seconds / 2**20}
+
+def new_ph5(directory, name='bench_ph5'):
+    """
+    make a new master PH5 file in directory
+
+    :return: opened PH5 object
+    """
+    ph5_obj = experiment.ExperimentGroup(nickname=name, currentpath=directory)
+    ph5_obj.ph5open(True)
+    ph5_obj.initgroup()
+    return ph5_obj
+
+def directory_size(directory):
+    """
+    :return: total size of files in directory in bytes
+    """
+    return sum([os.path.getsize(os.path.join(directory, fn))
+                for fn in os.listdir(directory)])
+
+# =============================================================================
+# Benchmarks
+# =============================================================================
+def bench_to_ph5(ts_list, directory, **kwargs):
+    """
+    time MTtoPH5.to_ph5 for a list of MTTS objects
+
+    :param list ts_list: list of MTTS objects
+    :param str directory: directory to write the PH5 files to
+
+    Other key words are passed to MTtoPH5
+
+    :return: dictionary of results
+    """
+    n_samples = sum([ts_obj.n_samples for ts_obj in ts_list])
+    n_bytes = sum([ts_obj.ts.data.nbytes for ts_obj in ts_list])
+
+    ph5_obj = new_ph5(directory)
+    mt_obj = TimedMTtoPH5(ph5_obj, **kwargs)
+    st = time.perf_counter()
+    mt_obj.to_ph5(ts_list)
+    ph5_obj.ph5close()
+    elapsed = time.perf_counter() - st
+
+    result = {'elapsed_s': elapsed,
+              'n_channels': len(ts_list),
+              'n_samples': n_samples,
+              'n_bytes': n_bytes,
+              'file_bytes': directory_size(directory),
+              'channel_latency': summarize_times(mt_obj.channel_times)}
+    result.update(throughput(n_samples, n_bytes, elapsed))
+
+    return result
+
+def bench_generic(ts_list, directory):
+    """
+    time the generic2ph5 calls add_channel, which adds the Array_t entry 
+    too, and get_current_mini_num for a list of MTTS objects.  Das groups 
+    are named after the station, the same as id_s which Index_t uses.
+
+    :param list ts_list: list of MTTS objects
+    :param str directory: directory to write the PH5 files to
+
+    :return: dictionary of results
+    """
+    timings = {'add_channel': [],
+               'get_current_mini_num': []}
+    n_samples = 0
+    n_bytes = 0
+
+    ph5_obj = ph5_tools.generic2ph5()
+    ph5_obj.open_ph5_file(os.path.join(directory, 'bench_generic.ph5'))
+    st = time.perf_counter()
+    for ts_obj in ts_list:
+        array_dict = make_array_dict(ts_obj)
+        data = np.ascontiguousarray(ts_obj.ts.data)
+
+        t0 = time.perf_counter()
+        ph5_obj.get_current_mini_num(ts_obj.station)
+        timings['get_current_mini_num'].append(time.perf_counter() - t0)
+
+        das_group, mini_ph5_obj = ph5_obj.get_station_mini(ts_obj.station)
+
+        t0 = time.perf_counter()
+        ph5_obj.add_channel(mini_ph5_obj, ts_obj.station, array_dict, data,
+                            data_type=data.dtype)
+        timings['add_channel'].append(time.perf_counter() - t0)
+        n_samples += data.size
+        n_bytes += data.nbytes
+
+    ph5_obj.flush()
+    ph5_obj.close_minis()
+    ph5_obj.ph5_obj.ph5close()
+    elapsed = time.perf_counter() - st
+
+    result = {'elapsed_s': elapsed,
+              'n_channels': len(ts_list),
+              'n_samples': n_samples,
+              'n_bytes': n_bytes,
+              'file_bytes': directory_size(directory)}
+    result.update(throughput(n_samples, n_bytes, elapsed))
+    for key, times in timings.items():
+        result[key] = summarize_times(times)
+
+    return result
+
+def bench_window_reads(directory, sampling_rate, window_seconds=10,
+                       n_reads=100, seed=0):
+    """
+    time reading random windows of data from the data arrays in the mini 
+    files of a directory, like a viewer or processing code would.
+
+    :param str directory: directory of the PH5 files
+    :param int sampling_rate: samples per second of the data
+    :param float window_seconds: length of each window in seconds
+    :param int n_reads: number of windows to read
+    :param int seed: random seed so the same windows are read each run
+
+    :return: dictionary of latencies, see summarize_times
+    """
+    generator = np.random.RandomState(seed)
+    window = max(int(window_seconds * sampling_rate), 1)
+    mini_fns = sorted([os.path.join(directory, fn) 
+                       for fn in os.listdir(directory) 
+                       if fn.startswith('miniPH5_') and fn.endswith('.ph5')])
+    times = []
+    h5_files = [tables.open_file(fn, 'r') for fn in mini_fns]
+    try:
+        arrays = [node for h5 in h5_files 
+                  for node in h5.walk_nodes('/', classname='Array')
+                  if node._v_name.startswith('Data_a_')]
+        if not arrays:
+            return summarize_times(times)
+        for ii in range(n_reads):
+            node = arrays[generator.randint(len(arrays))]
+            start = generator.randint(max(node.shape[0] - window, 0) + 1)
+            t0 = time.perf_counter()
+            node[start:start + window]
+            times.append(time.perf_counter() - t0)
+    finally:
+        for h5 in h5_files:
+            h5.close()
+
+    return summarize_times(times)
+
+def run_profile_suite(n_stations, n_channels=5, sampling_rate=256,
+                      duration=600, profiles=None, window_seconds=10, 
+                      n_reads=100, repeat=1, keep=False, ts_list=None):
+    """
+    compare the storage profiles of the data arrays by write speed, file
+    size and windowed read latency
+
+    :param int n_stations: number of stations
+    :param int n_channels: number of channels per station
+    :param int sampling_rate: samples per second
+    :param float duration: length of each channel in seconds
+    :param list profiles: storage profiles to compare, default is the PH5
+                          default (None) and each of 
+                          ph5_tools.storage_profiles
+    :param float window_seconds: length of each window read in seconds
+    :param int n_reads: number of windows read for each profile
+    :param int repeat: number of times to run each profile
+    :param bool keep: keep the temporary PH5 files
+    :param list ts_list: MTTS objects to load instead of synthetic data, 
+                         see load_files.  The survey size and sampling 
+                         rate then come from them.
+
+    :return: dictionary of results
+    """
+    if ts_list is None:
+        ts_list = make_synthetic_survey(n_stations, n_channels, 
+                                        sampling_rate, duration)
+    else:
+        n_stations = len(set([ts_obj.station for ts_obj in ts_list]))
+        sampling_rate = int(ts_list[0].sampling_rate)
+    if profiles is None:
+        profiles = [None] + sorted(ph5_tools.storage_profiles)
+    results = {'created': datetime.datetime.now(
+                                    datetime.timezone.utc).isoformat(),
+               'platform': {'python': platform.python_version(),
+                            'machine': platform.machine(),
+                            'system': platform.system(),
+                            'numpy': np.__version__,
+                            'tables': tables.__version__},
+               'parameters': {'n_stations': n_stations,
+                              'n_channels': n_channels,
+                              'sampling_rate': sampling_rate,
+                              'duration': duration,
+                              'window_seconds': window_seconds,
+                              'n_reads': n_reads,
+                              'repeat': repeat},
+               'runs': []}
+
+    for ii in range(repeat):
+        for profile in profiles:
+            directory = tempfile.mkdtemp(prefix='ph5_bench_')
+            try:
+                run = bench_to_ph5(ts_list, directory, 
+                                   storage_profile=profile)
+                run['window_read'] = bench_window_reads(directory, 
+                                                        sampling_rate,
+                                                        window_seconds,
+                                                        n_reads, seed=ii)
+            finally:
+                if not keep:
+                    shutil.rmtree(directory, ignore_errors=True)
+            run.update({'benchmark': 'storage_profile',
+                        'profile': str(profile),
+                        'compression_ratio': run['n_bytes'] / 
+                                             max(run['file_bytes'], 1),
+                        'repeat': ii})
+            results['runs'].append(run)
+            print('{0:>14}: {1:8.2f} MB/s {2:8.2f} MB on disk '
+                  '{3:8.3f} ms per window'.format(
+                      str(profile), run['mb_per_s'], 
+                      run['file_bytes'] / 2**20,
+                      run['window_read'].get('median_s', 0) * 1000))
+
+    return results
+
+def run_suite(station_counts, n_channels=5, sampling_rate=256, duration=600,
+              repeat=1, keep=False, ts_list=None, **kwargs):
+    """
+    run the benchmarks for increasing survey sizes
+
+    :param list station_counts: number of stations for each survey size
+    :param int n_channels: number of channels per station
+    :param int sampling_rate: samples per second
+    :param float duration: length of each channel in seconds
+    :param int repeat: number of times to run each benchmark
+    :param bool keep: keep the temporary PH5 files
+    :param list ts_list: MTTS objects to load instead of synthetic data, 
+                         see load_files.  They are run as one survey size.
+
+    Other key words are passed to MTtoPH5
+
+    :return: dictionary of results
+    """
+    results = {'created': datetime.datetime.now(
+                                    datetime.timezone.utc).isoformat(),
+               'platform': {'python': platform.python_version(),
+                            'machine': platform.machine(),
+                            'system': platform.system(),
+                            'numpy': np.__version__},
+               'parameters': {'station_counts': list(station_counts),
+                              'n_channels': n_channels,
+                              'sampling_rate': sampling_rate,
+                              'duration': duration,
+                              'repeat': repeat,
+                              'mt_kwargs': kwargs},
+               'runs': []}
+
+    if ts_list is None:
+        surveys = [(n_stations, make_synthetic_survey(n_stations, n_channels,
+                                                      sampling_rate, duration))
+                   for n_stations in station_counts]
+    else:
+        surveys = [(len(set([ts_obj.station for ts_obj in ts_list])), 
+                    ts_list)]
+    for n_stations, ts_list in surveys:
+        for ii in range(repeat):
+            for name in ['to_ph5', 'generic']:
+                directory = tempfile.mkdtemp(prefix='ph5_bench_')
+                try:
+                    if name == 'to_ph5':
+                        run = bench_to_ph5(ts_list, directory, **kwargs)
+                    else:
+                        run = bench_generic(ts_list, directory)
+                finally:
+                    if not keep:
+                        shutil.rmtree(directory, ignore_errors=True)
+                run.update({'benchmark': name,
+                            'n_stations': n_stations,
+                            'repeat': ii})
+                results['runs'].append(run)
+                print('{0:>8} {1:>5} stations: {2:10.1f} samples/s '
+                      '{3:8.2f} MB/s {4:8.2f} s'.format(name, n_stations,
+                                                       run['samples_per_s'],
+                                                       run['mb_per_s'],
+                                                       run['elapsed_s']))
+
+    results['scaling'] = scaling_summary(results['runs'])
+
+    return results
+
+def scaling_summary(runs):
+    """
+    summarize how throughput and latency change with survey size
+
+    :param list runs: list of run results from run_suite
+
+    :return: dictionary of benchmark --> list of per survey size summaries
+    """
+    summary = {}
+    for run in runs:
+        key = (run['benchmark'], run['n_stations'])
+        summary.setdefault(key, []).append(run)
+
+    scaling = {}
+    for (name, n_stations), name_runs in sorted(summary.items()):
+        scaling.setdefault(name, []).append(
+            {'n_stations': n_stations,
+             'samples_per_s': float(np.median([run['samples_per_s']
+                                               for run in name_runs])),
+             'mb_per_s': float(np.median([run['mb_per_s']
+                                          for run in name_runs])),
+             's_per_channel': float(np.median([run['elapsed_s'] /
+                                               max(run['n_channels'], 1)
+                                               for run in name_runs]))})
+    return scaling
+
+def save_results(results, json_fn):
+    """
+    save benchmark results as JSON
+
+    :param dict results: results from run_suite
+    :param str json_fn: full path to save to
+    """
+    with open(json_fn, 'w') as fid:
+        json.dump(results, fid, indent=4, default=str)
+    print('Saved benchmark results to {0}'.format(json_fn))
+
+# =============================================================================
+# Run from the command line
+# =============================================================================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark PH5 ingest')
+    parser.add_argument('--stations', type=int, nargs='+', default=[1, 5, 10],
+                        help='number of stations for each survey size')
+    parser.add_argument('--channels', type=int, default=5,
+                        help='number of channels per station')
+    parser.add_argument('--sampling-rate', type=int, default=256,
+                        help='samples per second')
+    parser.add_argument('--duration', type=float, default=600,
+                        help='length of each channel in seconds')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='number of times to run each benchmark')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the temporary PH5 files')
+    parser.add_argument('--output', default=None,
+                        help='JSON file to save results to')
+    parser.add_argument('--profiles', action='store_true',
+                        help='compare storage profiles of the data arrays '
+                             'using the first number of stations')
+    parser.add_argument('--window', type=float, default=10,
+                        help='length of windows read when comparing '
+                             'storage profiles in seconds')
+    parser.add_argument('--files', nargs='+', default=None,
+                        help='MT files to load instead of synthetic data')
+    args = parser.parse_args(argv)
+
+    ts_list = None
+    if args.files:
+        ts_list = load_files(args.files)
+
+    if args.profiles:
+        results = run_profile_suite(args.stations[0], 
+                                    n_channels=args.channels,
+                                    sampling_rate=args.sampling_rate,
+                                    duration=args.duration, 
+                                    window_seconds=args.window,
+                                    repeat=args.repeat, keep=args.keep,
+                                    ts_list=ts_list)
+    else:
+        results = run_suite(args.stations, n_channels=args.channels,
+                            sampling_rate=args.sampling_rate,
+                            duration=args.duration, repeat=args.repeat,
+                            keep=args.keep, ts_list=ts_list)
+    if args.output:
+        save_results(results, args.output)
+    elif args.profiles:
+        json.dump(results['runs'], sys.stdout, indent=4, default=str)
+    else:
+        json.dump(results['scaling'], sys.stdout, indent=4)
+
+    return results
+
+if __name__ == '__main__':
+    main()
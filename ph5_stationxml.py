@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""
+==================
+PH5 StationXML
+==================
+
+Export StationXML straight from the sorts and receiver tables of a PH5 file.
+The array tables (Array_t_xxx) and the receiver table (Receiver_t) are read
+as numpy columns, sorted once by station and channel and turned into
+obspy Network --> Station --> Channel objects in one pass over the groups.
+
+MT metadata that StationXML does not have a place for, like the dipole
+length, are added to each channel as extra attributes in the MT namespace,
+see obspy_custom_attribute_stationxml.py.
+
+For surveys too large to hold as one obspy Inventory the XML can be streamed
+out one station at a time with lxml.
+
+:Example: ::
+
+    >>> from ph5.core import experiment
+    >>> import ph5_stationxml
+    >>> ph5_obj = experiment.ExperimentGroup(nickname='test_ph5',
+    >>> ...                                  currentpath=r"/home/mt/ph5")
+    >>> ph5_obj.ph5open(False)
+    >>> ph5_obj.initgroup()
+    >>> inv = ph5_stationxml.build_inventory(ph5_obj, network_code='MT')
+    >>> ph5_stationxml.write_stationxml(ph5_obj, r"/home/mt/survey.xml",
+    >>> ...                             stream=True)
+"""
+
+# =============================================================================
+# Imports
+# =============================================================================
+import io
+
+import numpy as np
+import obspy
+from obspy.core import inventory
+from obspy.core.util import AttribDict
+
+# =============================================================================
+# global variables
+# =============================================================================
+ns = 'MT'
+fdsn_ns = 'http://www.fdsn.org/xml/station/1'
+
+### columns of the array tables that are used and their default values
+array_columns = {'id_s': '',
+                 'description_s': '',
+                 'channel_number_i': 0,
+                 'seed_band_code_s': '',
+                 'seed_instrument_code_s': '',
+                 'seed_orientation_code_s': '',
+                 'seed_location_code_s': '',
+                 'sample_rate_i': 0,
+                 'sample_rate_multiplier_i': 1,
+                 'receiver_table_n_i': 0,
+                 'location/X/value_d': 0.,
+                 'location/Y/value_d': 0.,
+                 'location/Z/value_d': 0.,
+                 'deploy_time/epoch_l': 0,
+                 'deploy_time/micro_seconds_i': 0,
+                 'pickup_time/epoch_l': 0,
+                 'pickup_time/micro_seconds_i': 0,
+                 'das/serial_number_s': '',
+                 'das/model_s': '',
+                 'das/manufacturer_s': '',
+                 'sensor/serial_number_s': '',
+                 'sensor/model_s': '',
+                 'sensor/manufacturer_s': ''}
+
+### a channel row that starts more than this many seconds after the rows 
+### before it end starts a new channel epoch
+max_epoch_gap = 3600.
+
+### columns of the receiver table that are used and their default values
+receiver_columns = {'orientation/azimuth/value_f': 0.,
+                    'orientation/dip/value_f': 0.,
+                    'orientation/description_s': '',
+                    'location/length/value_f': 0.,
+                    'location/length/units_s': 'm'}
+
+# =============================================================================
+# Read tables as columns
+# =============================================================================
+def read_columns(table, columns):
+    """
+    read columns of a PyTables table into numpy arrays, strings are
+    decoded.  Columns the table does not have are filled with the default.
+
+    :param table: PyTables table
+    :param dict columns: column name --> default value
+
+    :return: dictionary of column name --> numpy array
+    """
+    col_dict = {}
+    for key, default in columns.items():
+        if key in table.colpathnames:
+            values = table.col(key)
+            if values.dtype.kind == 'S':
+                values = np.char.strip(np.char.decode(values))
+        else:
+            values = np.full(table.nrows, default)
+        col_dict[key] = values
+
+    return col_dict
+
+def read_array_columns(ph5_obj):
+    """
+    read the array tables of the sorts group into one set of columns
+
+    :param ph5_obj: opened PH5 object
+
+    :return: dictionary of column name --> numpy array
+    """
+    col_list = []
+    for array_name in ph5_obj.ph5_g_sorts.namesArray_t():
+        table = ph5_obj.ph5.get_node('/Experiment_g/Sorts_g/{0}'.format(
+                                     array_name))
+        col_list.append(read_columns(table, array_columns))
+    if not col_list:
+        return dict([(key, np.zeros(0)) for key in array_columns])
+
+    return dict([(key, np.concatenate([cols[key] for cols in col_list]))
+                 for key in array_columns])
+
+def read_receiver_columns(ph5_obj):
+    """
+    read the receiver table into columns
+
+    :param ph5_obj: opened PH5 object
+
+    :return: dictionary of column name --> numpy array
+    """
+    return read_columns(ph5_obj.ph5_g_receivers.ph5_t_receiver,
+                        receiver_columns)
+
+def lookup_receivers(array_cols, receiver_cols):
+    """
+    get the receiver columns for each row of the array columns from the
+    receiver table number, rows without a receiver get the defaults
+
+    :param dict array_cols: array columns, see read_array_columns
+    :param dict receiver_cols: receiver columns, see read_receiver_columns
+
+    :return: dictionary of column name --> numpy array lined up with the
+             array columns
+    """
+    n_receivers = receiver_cols['orientation/azimuth/value_f'].shape[0]
+    ### receiver table numbers count from 1
+    index = array_cols['receiver_table_n_i'].astype(int) - 1
+    valid = (index >= 0) & (index < n_receivers)
+    index = np.where(valid, index, 0)
+
+    receivers = {}
+    for key, default in receiver_columns.items():
+        if n_receivers == 0:
+            receivers[key] = np.full(index.shape[0], default)
+            continue
+        receivers[key] = np.where(valid, receiver_cols[key][index], default)
+
+    return receivers
+
+def group_bounds(*keys):
+    """
+    get the start and stop of each run of equal keys in sorted columns
+
+    :param keys: sorted numpy arrays of the same length
+
+    :return: list of (start, stop) indexes
+    """
+    n_rows = keys[0].shape[0]
+    if n_rows == 0:
+        return []
+    change = np.zeros(n_rows - 1, dtype=bool)
+    for key in keys:
+        change |= key[1:] != key[:-1]
+
+    return split_bounds(change)
+
+def epoch_bounds(start, end, max_gap, *keys):
+    """
+    split the rows of one channel into epochs.  A new epoch starts where 
+    any of the keys changes or where a row starts more than max_gap seconds
+    after all the rows before it end.
+
+    :param start: start times of the rows in epoch seconds, sorted
+    :param end: end times of the rows in epoch seconds
+    :param float max_gap: largest gap in seconds within an epoch
+    :param keys: numpy arrays of the same length, ex. serial numbers
+
+    :return: list of (start, stop) indexes
+    """
+    if start.shape[0] == 0:
+        return []
+    change = start[1:] - np.maximum.accumulate(end)[:-1] > max_gap
+    for key in keys:
+        change |= key[1:] != key[:-1]
+
+    return split_bounds(change)
+
+def split_bounds(change):
+    """
+    :param change: boolean array, True where row i + 1 differs from row i
+
+    :return: list of (start, stop) indexes of the runs between changes
+    """
+    starts = np.concatenate([[0], np.nonzero(change)[0] + 1]).astype(int)
+    stops = np.concatenate([starts[1:], [change.shape[0] + 1]]).astype(int)
+
+    return list(zip(starts.tolist(), stops.tolist()))
+
+# =============================================================================
+# Make obspy objects
+# =============================================================================
+def channel_code(component, band_code='', instrument_code='',
+                 orientation_code=''):
+    """
+    make a channel code from the seed codes, if they are not all there the
+    component is used
+
+    :return: channel code
+    """
+    if band_code and instrument_code and orientation_code:
+        return '{0}{1}{2}'.format(band_code, instrument_code, orientation_code)
+    return component.upper()
+
+def make_mt_extra(dipole_length, units='m', namespace=ns):
+    """
+    make the MT extra attributes of a channel
+
+    :param float dipole_length: dipole length
+    :param str units: units of the dipole length
+    :param str namespace: namespace of the extra attributes
+
+    :return: AttribDict
+    """
+    extra = AttribDict()
+    extra.DipoleLength = AttribDict()
+    extra.DipoleLength.value = '{0}'.format(dipole_length)
+    extra.DipoleLength.namespace = namespace
+    extra.DipoleLength.attrib = {'units': units}
+
+    return extra
+
+def make_channel(cols, receivers, codes, location, sample_rate, start, end,
+                 rows, namespace=ns):
+    """
+    make an obspy Channel for one epoch of rows, the metadata are the same
+    for every row of an epoch so they are taken from the first one
+
+    :param dict cols: array columns, see read_array_columns
+    :param dict receivers: receiver columns, see lookup_receivers
+    :param rows: indexes of the rows of the epoch
+    :param str namespace: namespace of the MT extra attributes
+
+    :return: obspy.core.inventory.Channel
+    """
+    ii = rows[0]
+    cha = inventory.Channel(
+                code=codes[ii],
+                location_code=location[ii],
+                latitude=cols['location/Y/value_d'][ii],
+                longitude=cols['location/X/value_d'][ii],
+                elevation=cols['location/Z/value_d'][ii],
+                depth=0,
+                azimuth=receivers['orientation/azimuth/value_f'][ii],
+                dip=receivers['orientation/dip/value_f'][ii],
+                sample_rate=sample_rate[ii],
+                start_date=obspy.UTCDateTime(start[rows].min()),
+                end_date=obspy.UTCDateTime(end[rows].max()))
+    cha.data_logger = inventory.Equipment(
+                serial_number=cols['das/serial_number_s'][ii],
+                model=cols['das/model_s'][ii],
+                manufacturer=cols['das/manufacturer_s'][ii])
+    cha.sensor = inventory.Equipment(
+                serial_number=cols['sensor/serial_number_s'][ii],
+                model=cols['sensor/model_s'][ii],
+                manufacturer=cols['sensor/manufacturer_s'][ii])
+
+    if cols['description_s'][ii].lower().startswith('e'):
+        units = str(receivers['location/length/units_s'][ii]) or 'm'
+        cha.extra = make_mt_extra(
+                        receivers['location/length/value_f'][ii],
+                        units, namespace)
+
+    return cha
+
+def iter_stations(ph5_obj, namespace=ns, max_gap=max_epoch_gap):
+    """
+    yield an obspy Station for each station in the array tables.  Rows are
+    sorted by station, channel code, location code, sample rate and start
+    time.  The rows of a channel are split into epochs where the receiver
+    row, data logger or sensor serial number or location changes, or where
+    there is a gap of more than max_gap seconds.  Each epoch is one channel
+    that spans from the first deploy time to the last pick up time of its
+    rows.
+
+    :param ph5_obj: opened PH5 object
+    :param str namespace: namespace of the MT extra attributes
+    :param float max_gap: largest gap in seconds within a channel epoch
+
+    :return: generator of obspy.core.inventory.Station
+    """
+    cols = read_array_columns(ph5_obj)
+    receivers = lookup_receivers(cols, read_receiver_columns(ph5_obj))
+
+    multiplier = cols['sample_rate_multiplier_i'].astype(float)
+    multiplier[multiplier == 0] = 1
+    sample_rate = cols['sample_rate_i'] / multiplier
+    start = (cols['deploy_time/epoch_l'] +
+             cols['deploy_time/micro_seconds_i'] / 1E6)
+    end = (cols['pickup_time/epoch_l'] +
+           cols['pickup_time/micro_seconds_i'] / 1E6)
+    codes = np.array([channel_code(*row) for row in
+                      zip(cols['description_s'], cols['seed_band_code_s'],
+                          cols['seed_instrument_code_s'],
+                          cols['seed_orientation_code_s'])], dtype='U')
+    location = cols['seed_location_code_s']
+
+    order = np.lexsort((start, sample_rate, location, codes, cols['id_s']))
+    station = cols['id_s'][order]
+    for st_0, st_1 in group_bounds(station):
+        index = order[st_0:st_1]
+        sta = inventory.Station(code=station[st_0],
+                                latitude=cols['location/Y/value_d'][index[0]],
+                                longitude=cols['location/X/value_d'][index[0]],
+                                elevation=cols['location/Z/value_d'][index[0]],
+                                start_date=obspy.UTCDateTime(
+                                                    start[index].min()),
+                                end_date=obspy.UTCDateTime(end[index].max()),
+                                site=inventory.Site(name=station[st_0]))
+
+        for ch_0, ch_1 in group_bounds(codes[index], location[index],
+                                       sample_rate[index]):
+            channel_rows = index[ch_0:ch_1]
+            for ep_0, ep_1 in epoch_bounds(
+                                start[channel_rows], end[channel_rows], 
+                                max_gap,
+                                cols['receiver_table_n_i'][channel_rows],
+                                cols['das/serial_number_s'][channel_rows],
+                                cols['sensor/serial_number_s'][channel_rows],
+                                cols['location/X/value_d'][channel_rows],
+                                cols['location/Y/value_d'][channel_rows],
+                                cols['location/Z/value_d'][channel_rows]):
+                sta.channels.append(make_channel(cols, receivers, codes, 
+                                                 location, sample_rate, 
+                                                 start, end,
+                                                 channel_rows[ep_0:ep_1],
+                                                 namespace))
+
+        yield sta
+
+def build_inventory(ph5_obj, network_code='MT', source='mt2ph5',
+                    description=None, namespace=ns, max_gap=max_epoch_gap):
+    """
+    build an obspy Inventory from the sorts and receiver tables of a PH5
+    file
+
+    :param ph5_obj: opened PH5 object
+    :param str network_code: network code
+    :param str source: source of the inventory
+    :param str description: description of the network
+    :param str namespace: namespace of the MT extra attributes
+    :param float max_gap: largest gap in seconds within a channel epoch
+
+    :return: obspy.core.inventory.Inventory
+    """
+    net = inventory.Network(code=network_code,
+                            stations=list(iter_stations(ph5_obj, namespace,
+                                                        max_gap)),
+                            description=description)
+    if net.stations:
+        net.start_date = min([sta.start_date for sta in net.stations])
+        net.end_date = max([sta.end_date for sta in net.stations])
+
+    return inventory.Inventory(networks=[net], source=source)
+
+# =============================================================================
+# Write StationXML
+# =============================================================================
+def station_to_element(station, network_code='MT', namespace=ns):
+    """
+    make the lxml element of a single station by writing it with obspy
+
+    :param station: obspy Station
+    :param str network_code: network code
+    :param str namespace: namespace of the MT extra attributes
+
+    :return: lxml element of the station
+    """
+    from lxml import etree
+
+    inv = inventory.Inventory(networks=[inventory.Network(network_code,
+                                                          [station])],
+                              source='')
+    buffer = io.BytesIO()
+    inv.write(buffer, format='STATIONXML', nsmap={namespace: namespace})
+    root = etree.fromstring(buffer.getvalue())
+
+    return root.find('{{{0}}}Network/{{{0}}}Station'.format(fdsn_ns))
+
+def write_stationxml(ph5_obj, xml_fn, network_code='MT', source='mt2ph5',
+                     description=None, namespace=ns, stream=False,
+                     max_gap=max_epoch_gap):
+    """
+    write StationXML from the sorts and receiver tables of a PH5 file
+
+    :param ph5_obj: opened PH5 object
+    :param str xml_fn: full path to StationXML file to write
+    :param str network_code: network code
+    :param str source: source of the inventory
+    :param str description: description of the network
+    :param str namespace: namespace of the MT extra attributes
+    :param bool stream: write one station at a time with lxml instead of
+                        building the whole inventory in memory
+    :param float max_gap: largest gap in seconds within a channel epoch
+
+    :return: full path to StationXML file
+    """
+    if not stream:
+        inv = build_inventory(ph5_obj, network_code, source, description,
+                              namespace, max_gap)
+        inv.write(xml_fn, format='STATIONXML', validate=True,
+                  nsmap={namespace: namespace})
+        return xml_fn
+
+    from lxml import etree
+
+    with etree.xmlfile(xml_fn, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element('{{{0}}}FDSNStationXML'.format(fdsn_ns),
+                        nsmap={None: fdsn_ns, namespace: namespace},
+                        schemaVersion='1.1'):
+            source_element = etree.Element('{{{0}}}Source'.format(fdsn_ns),
+                                           nsmap={None: fdsn_ns})
+            source_element.text = source
+            xf.write(source_element)
+            created = etree.Element('{{{0}}}Created'.format(fdsn_ns),
+                                    nsmap={None: fdsn_ns})
+            created.text = str(obspy.UTCDateTime())
+            xf.write(created)
+            with xf.element('{{{0}}}Network'.format(fdsn_ns),
+                            code=network_code):
+                if description:
+                    description_element = etree.Element(
+                                    '{{{0}}}Description'.format(fdsn_ns),
+                                    nsmap={None: fdsn_ns})
+                    description_element.text = description
+                    xf.write(description_element)
+                for sta in iter_stations(ph5_obj, namespace, max_gap):
+                    xf.write(station_to_element(sta, network_code,
+                                                namespace))
+                    xf.flush()
+
+    return xml_fn
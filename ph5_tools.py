@@ -27,10 +27,22 @@ Created on Wed Jul 17 17:05:20 2019
 import os
 import re
 import json
+import time
+import heapq
+import hashlib
+import logging
+import tracemalloc
+import uuid
+from contextlib import nullcontext
+from collections import OrderedDict, namedtuple
 from pathlib import Path
+import csv
+import glob
 import numpy as np
-import dateutil
+import tables
+import dateutil.parser
 import datetime
+from functools import lru_cache
 
 from ph5.core import experiment
 from ph5.core import columns
@@ -38,8 +50,48 @@ from ph5.core import columns
 # =============================================================================
 # global variables
 # =============================================================================
+logger = logging.getLogger(__name__)
+
 t_list = ['ascii_s', 'epoch_l', 'micro_seconds_i', 'type_s']
 
+### a single time in the 4 PH5 formats, fields are in the order of t_list
+TimeValue = namedtuple('TimeValue', t_list)
+### start and end time of a channel as TimeValues
+ChannelTimes = namedtuple('ChannelTimes', ['start', 'end'])
+### a window of data read back from a PH5 file, start is the time of the 
+### first sample as a UTC datetime and gaps is a list of (UTC datetime, 
+### seconds) where the data arrays joined in the window do not line up, 
+### seconds is negative if they overlap
+ChannelWindow = namedtuple('ChannelWindow', ['data', 'start', 'sampling_rate',
+                                             'serial', 'channel_number', 
+                                             'gaps'], defaults=[()])
+
+### directory of the metadata definitions
+metadata_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                             'metadata')
+### compiled definition of a metadata key
+MetadataField = namedtuple('MetadataField', ['column_type', 'width', 
+                                             'required'])
+
+### HDF5 storage profiles for data arrays.  The chunk length is chunk_seconds
+### of data at the sample rate of the channel, kept within min_chunk and 
+### max_chunk samples.  Shuffle groups the bytes of integer counts which 
+### compress much better afterwards.
+storage_profiles = {'fast-write': {'complib': 'blosc:lz4',
+                                   'complevel': 1,
+                                   'shuffle': True,
+                                   'chunk_seconds': 600},
+                    'compact': {'complib': 'zlib',
+                                'complevel': 9,
+                                'shuffle': True,
+                                'chunk_seconds': 3600},
+                    'random-access': {'complib': 'blosc:lz4',
+                                      'complevel': 5,
+                                      'shuffle': True,
+                                      'chunk_seconds': 10}}
+min_chunk = 2**12
+max_chunk = 2**20
+
 # =============================================================================
 # Begin tools
 # =============================================================================
@@ -52,25 +104,700 @@ def read_date_time(time_string):
     :return: iso-format, epoch, microseconds
     """
     
-    dt_obj = check_timezone(dateutil.parser.parse(time_string))
+    return format_date_time(parse_date_time(time_string))
+
+@lru_cache(maxsize=8192)
+def parse_date_time(time_string):
+    """
+    parse a time string into a UTC aware datetime object.  ISO-8601 strings
+    are parsed with datetime.fromisoformat, anything else falls back to 
+    dateutil.  Results are cached because the same time strings are parsed
+    for every table a channel goes into.
+    
+    :param str time_string: time string date-time
+    
+    :return: datetime object in UTC
+    """
+    if isinstance(time_string, bytes):
+        time_string = time_string.decode()
+    try:
+        iso_string = time_string.strip()
+        if iso_string.endswith('Z'):
+            iso_string = iso_string[:-1] + '+00:00'
+        dt_obj = datetime.datetime.fromisoformat(iso_string)
+    except ValueError:
+        dt_obj = dateutil.parser.parse(time_string)
+        
+    return check_timezone(dt_obj)
+
+def to_epoch(time_value):
+    """
+    convert a time to epoch seconds
+    
+    :param time_value: time string, datetime object or epoch seconds, 
+                       times without a time zone are taken as UTC
+    
+    :return: epoch seconds as a float
+    """
+    if isinstance(time_value, (int, float, np.number)):
+        return float(time_value)
+    if isinstance(time_value, datetime.datetime):
+        return check_timezone(time_value).timestamp()
+    return parse_date_time(time_value).timestamp()
+
+def epoch_to_date_time(epoch, micro_seconds=0):
+    """
+    convert epoch seconds and micro seconds into a UTC aware datetime object
+    
+    :param float epoch: epoch seconds
+    :param int micro_seconds: micro seconds 
+    
+    :return: datetime object in UTC
+    """
+    return (datetime.datetime.fromtimestamp(int(epoch), 
+                                            tz=datetime.timezone.utc) + 
+            datetime.timedelta(seconds=float(epoch) - int(epoch),
+                               microseconds=int(micro_seconds)))
+
+def make_time_value(dt_obj):
+    """
+    make a TimeValue from a datetime object
+    
+    :param dt_obj: datetime object
+    
+    :return: TimeValue(ascii_s, epoch_l, micro_seconds_i, type_s)
+    """
+    return TimeValue(*format_date_time(dt_obj), 'BOTH')
+
+def set_time_value(entry, base, time_value):
+    """
+    fill in the base/ascii_s, base/epoch_l, ... keys of a table entry
+    
+    :param dict entry: table entry
+    :param str base: name of the time column, ex. start_time
+    :param time_value: TimeValue to fill in
+    
+    :return: entry
+    """
+    for key, value in zip(t_list, time_value):
+        entry['{0}/{1}'.format(base, key)] = value
+    return entry
+
+def format_date_time(dt_obj):
+    """
+    get the PH5 time values of a datetime object
+    
+    :param dt_obj: datetime object
     
+    :return: iso-format, epoch, microseconds
+    """
+    dt_obj = check_timezone(dt_obj)
     return dt_obj.isoformat(), int(dt_obj.timestamp()), dt_obj.microsecond
 
+@lru_cache(maxsize=None)
 def get_column_type(keyword):
     """
-    get the column type from the key word
+    get the column type from the key word, results are cached as the same
+    keys are looked up for every entry.
     """
     if keyword[-1] in ['s']:
         col_type = 'string'
     elif keyword[-1] in ['l', 'i']:
         col_type = 'int'
-    elif keyword[-1] in ['d']:
+    elif keyword[-1] in ['d', 'f']:
         col_type = 'float'
         
     else:
-        raise ValueError('Cannot determine type of {0} keyword')
+        raise ValueError('Cannot determine type of {0} keyword'.format(
+                         keyword))
     return col_type
 
+def decode_entry(entry):
+    """
+    decode any byte keys or values of a table entry into strings
+    
+    :param dict entry: table entry as read from PH5
+    
+    :return: dictionary with unicode keys and values
+    """
+    return {key.decode() if isinstance(key, bytes) else key:
+            val.decode() if isinstance(val, bytes) else val
+            for key, val in entry.items()}
+    
+def table_columns(table):
+    """
+    get the columns of a table to normalize entries with, see 
+    normalize_value
+    
+    :param table: PyTables table
+    
+    :return: list of (column path, default, dtype)
+    """
+    return [(column_path, table.coldflts[column_path], 
+             table.coldtypes[column_path]) 
+            for column_path in table.colpathnames]
+    
+def normalize_value(value, default, dtype):
+    """
+    convert a value to what reading it back from a table column gives, so 
+    entries made in memory compare equal to rows read from the table
+    
+    :param value: value of the entry, None gets the default
+    :param default: column default
+    :param dtype: numpy dtype of the column
+    
+    :return: python value, strings are decoded
+    """
+    if value is None:
+        value = default
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    value = np.array(value, dtype=dtype)[()]
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='ignore')
+    return value.item()
+
+def receiver_key(receiver_entry, columns=None):
+    """
+    make a hashable key from a receiver table entry so it can be looked up
+    in a dictionary.  Two entries have the same key when they are equal.
+    
+    :param dict receiver_entry: receiver table entry
+    :param list columns: columns of the receiver table, see table_columns.
+                         If given the entry is normalized to the columns so
+                         a partial entry made in memory has the same key as
+                         the row read back from the table.
+    
+    :return: tuple of sorted (key, value) pairs, or of the normalized values
+             in column order if columns are given
+    """
+    if columns is None:
+        return tuple(sorted(decode_entry(receiver_entry).items()))
+    return tuple([normalize_value(receiver_entry.get(column_path), default, 
+                                  dtype)
+                  for column_path, default, dtype in columns])
+
+def response_key(station, sample_rate, channel_number):
+    """
+    make a hashable key to look up a response table number
+    
+    :param str station: station name
+    :param int sample_rate: sample rate (samples/second)
+    :param int channel_number: channel number
+    
+    :return: tuple of (station, sample_rate, channel_number)
+    """
+    if isinstance(station, bytes):
+        station = station.decode()
+    return (station, sample_rate, channel_number)
+
+def get_mini_num(mini_fn):
+    """
+    get the mini file number from a file name miniPH5_xxxxx.ph5
+    
+    :param str mini_fn: mini file name or full path
+    
+    :return: mini number
+    """
+    return int(os.path.basename(mini_fn).split('.')[-2].split('_')[-1])
+
+def mini_file_stat(mini_fn):
+    """
+    size and modification time of a mini file, used to tell if the mini 
+    catalog entry of the file is out of date
+    
+    :param str mini_fn: full path to mini file
+    
+    :return: file size in bytes, modification time
+    """
+    stat = os.stat(mini_fn)
+    return stat.st_size, stat.st_mtime
+
+def get_das_name(ph5_obj):
+    """
+    get the data logger name of the current DAS group of a PH5 object
+    
+    :param ph5_obj: PH5 object with a current das group set
+    
+    :return: data logger serial number
+    """
+    return ph5_obj.ph5_g_receivers.current_g_das._v_name[len('Das_g_'):]
+
+def get_max_array_num(das_group):
+    """
+    get the largest data array number in a das group 
+    
+    :param das_group: das group node Das_g_xxxxx
+    
+    :return: largest xxxxx of the Data_a_xxxxx arrays, 0 if there are none
+    """
+    array_re = re.compile(r"Data_a_(\d+)$")
+    max_num = 0
+    for name in das_group._v_children.keys():
+        match = array_re.match(name)
+        if match:
+            max_num = max(max_num, int(match.group(1)))
+    return max_num
+
+def iter_blocks(data, block_size=2**20):
+    """
+    yield fixed size blocks of an array like object.  Use with a memory 
+    mapped array or an HDF5 array so only one block is read at a time.
+    
+    :param data: array like object that can be sliced
+    :param int block_size: number of samples in each block
+    
+    :return: generator of numpy arrays
+    """
+    for start in range(0, data.shape[0], block_size):
+        yield np.asarray(data[start:start + block_size])
+        
+def get_storage_profile(profile):
+    """
+    get the settings of a storage profile
+    
+    :param profile: name of a profile in storage_profiles or a dictionary 
+                    with keys complib, complevel, shuffle and chunk_seconds
+    :type profile: string or dict
+    
+    :return: dictionary of profile settings
+    """
+    if isinstance(profile, dict):
+        profile_dict = dict(storage_profiles['random-access'])
+        profile_dict.update(profile)
+        return profile_dict
+    try:
+        return storage_profiles[profile]
+    except KeyError:
+        raise ValueError('Storage profile {0} is not one of {1}'.format(
+                         profile, ', '.join(sorted(storage_profiles))))
+
+@lru_cache(maxsize=None)
+def _storage_filters(complib, complevel, shuffle):
+    ### cached, so the fall back is logged once for each profile
+    if tables.which_lib_version(complib.split(':')[0]) is None:
+        logger.warning('{0} is not available, using zlib'.format(complib))
+        complib = 'zlib'
+    return tables.Filters(complevel=complevel, complib=complib, 
+                          shuffle=shuffle)
+
+def get_storage_filters(profile):
+    """
+    get the HDF5 filters of a storage profile, if the compressor is not
+    built into PyTables zlib is used and a warning is logged.
+    
+    :param profile: storage profile, see get_storage_profile
+    
+    :return: tables.Filters
+    """
+    profile = get_storage_profile(profile)
+    return _storage_filters(profile['complib'], profile['complevel'],
+                            profile['shuffle'])
+
+def get_chunk_shape(profile, sampling_rate, n_samples=None):
+    """
+    get the chunk shape of a data array from a storage profile and the 
+    sample rate.
+    
+    :param profile: storage profile, see get_storage_profile
+    :param float sampling_rate: samples per second
+    :param int n_samples: number of samples in the array if known, a chunk
+                          is never longer than the array
+    
+    :return: chunk shape as a tuple
+    """
+    profile = get_storage_profile(profile)
+    chunk = int(profile['chunk_seconds'] * sampling_rate)
+    chunk = min(max(chunk, min_chunk), max_chunk)
+    if n_samples is not None:
+        chunk = min(chunk, n_samples)
+    
+    return (max(chunk, 1),)
+
+def write_array(ph5_obj, name, data, profile=None, sampling_rate=1, 
+                description=None):
+    """
+    write a data array into the current das group of a PH5 file.
+    
+    :param ph5_obj: PH5 object with the current das group set
+    :param str name: name of data array Data_a_xxxxx
+    :param np.ndarray data: data
+    :param profile: storage profile, see get_storage_profile.  If None the
+                    array is made by PH5 with its default settings.
+    :param float sampling_rate: samples per second, sets the chunk length
+    :param str description: description of the array
+    """
+    data = np.asarray(data)
+    if profile is None or data.shape[0] == 0:
+        ph5_obj.ph5_g_receivers.newarray(name, data, dtype=data.dtype,
+                                         description=description)
+        return
+    
+    ph5_obj.ph5.create_carray(ph5_obj.ph5_g_receivers.current_g_das,
+                              name,
+                              obj=data,
+                              title=description or '',
+                              filters=get_storage_filters(profile),
+                              chunkshape=get_chunk_shape(profile, 
+                                                         sampling_rate,
+                                                         data.shape[0]))
+
+def write_array_stream(ph5_obj, name, blocks, dtype=None, 
+                       expected_rows=None, description=None, profile=None,
+                       sampling_rate=1):
+    """
+    write a data array from blocks into the current das group of a PH5 file.
+    An extendable array is created and each block is appended, so peak 
+    memory is set by the block size not the length of the data.
+    
+    :param ph5_obj: PH5 object with the current das group set
+    :param str name: name of data array Data_a_xxxxx
+    :param blocks: iterable of numpy arrays
+    :param dtype: data type of the array, default is the type of the first
+                  block
+    :param int expected_rows: expected number of samples, used by PyTables
+                              to choose a chunk size
+    :param str description: description of the array
+    :param profile: storage profile, see get_storage_profile.  If None zlib
+                    is used and PyTables picks the chunk size.
+    :param float sampling_rate: samples per second, sets the chunk length
+                                of a storage profile
+    
+    :return: number of samples written, number of bytes written
+    """
+    blocks = iter(blocks)
+    try:
+        first_block = np.asarray(next(blocks))
+    except StopIteration:
+        first_block = np.zeros(0, dtype=dtype or 'int32')
+    if dtype is None:
+        dtype = first_block.dtype
+    
+    kwargs = {}
+    if expected_rows:
+        kwargs['expectedrows'] = expected_rows
+    if profile is None:
+        filters = tables.Filters(complevel=6, complib='zlib')
+    else:
+        filters = get_storage_filters(profile)
+        kwargs['chunkshape'] = get_chunk_shape(profile, sampling_rate)
+    array = ph5_obj.ph5.create_earray(ph5_obj.ph5_g_receivers.current_g_das,
+                                      name,
+                                      atom=tables.Atom.from_dtype(np.dtype(dtype)),
+                                      shape=(0,),
+                                      title=description or '',
+                                      filters=filters,
+                                      **kwargs)
+    n_samples = 0
+    n_bytes = 0
+    block = first_block
+    while True:
+        block = np.asarray(block, dtype=dtype)
+        array.append(block)
+        n_samples += block.shape[0]
+        n_bytes += block.nbytes
+        try:
+            block = next(blocks)
+        except StopIteration:
+            break
+    array.flush()
+    
+    return n_samples, n_bytes
+
+def projected_bytes(n_samples, dtype='int32'):
+    """
+    number of bytes a data array will take before compression
+    
+    :param int n_samples: number of samples
+    :param dtype: data type of the samples
+    
+    :return: number of bytes
+    """
+    return int(n_samples) * np.dtype(dtype).itemsize
+
+def plan_mini_placement(das_bytes, num_mini=None, mini_size_max=26843545600,
+                        first_mini=1, existing=None):
+    """
+    place data loggers in mini files so the mini files come out about the 
+    same size.  Each data logger goes into a single mini file.  Data loggers
+    are placed largest first into the mini file with the fewest bytes 
+    (longest processing time first bin packing), which is never more than 
+    4/3 of the best possible largest mini file.
+    
+    :param dict das_bytes: data logger serial number --> projected bytes, 
+                           see projected_bytes
+    :param int num_mini: least number of mini files to spread the data 
+                         loggers over, more are used if the bytes do not fit
+                         in num_mini files under mini_size_max.  Default is 
+                         the fewest that keeps all of them under 
+                         mini_size_max.
+    :param int mini_size_max: size a mini file should stay under in bytes
+    :param int first_mini: number of the first mini file
+    :param dict existing: mini catalog of mini files already written, data
+                          loggers in it stay where they are and their bytes 
+                          are counted, see generic2ph5.mini_catalog
+    
+    :return: dictionary of data logger serial number --> mini number
+    
+    .. note:: a data logger is never put in a mini file that has data if 
+              that would take it over mini_size_max, a new mini file is 
+              started instead.  A data logger bigger than mini_size_max 
+              gets a mini file to itself.
+    
+    :Example: ::
+        
+        >>> plan_mini_placement({'ZEN_024': 8E9, 'ZEN_025': 6E9, 
+        >>> ...                  'ZEN_026': 5E9, 'ZEN_027': 3E9}, 
+        >>> ...                 num_mini=2)
+        {'ZEN_024': 1, 'ZEN_025': 2, 'ZEN_026': 2, 'ZEN_027': 1}
+    """
+    existing = existing or {}
+    loads = dict([(num, entry['size']) for num, entry in existing.items()])
+    placement = {}
+    for num, entry in existing.items():
+        for serial in entry['das_list']:
+            placement[serial] = num
+    
+    new_das = [(n_bytes, serial) for serial, n_bytes in das_bytes.items()
+               if serial not in placement]
+    total = sum(loads.values()) + sum([b for b, s in new_das])
+    num_mini = max(int(np.ceil(total / float(mini_size_max))), num_mini or 1)
+    for num in range(first_mini, first_mini + num_mini):
+        loads.setdefault(num, 0)
+    
+    heap = [(n_bytes, num) for num, n_bytes in loads.items()]
+    heapq.heapify(heap)
+    next_num = max(loads) + 1
+    for n_bytes, serial in sorted(new_das, reverse=True):
+        load, num = heapq.heappop(heap)
+        if load > 0 and load + n_bytes > mini_size_max:
+            ### even the emptiest mini file is too full, start a new one
+            heapq.heappush(heap, (load, num))
+            load, num = 0, next_num
+            next_num += 1
+        placement[serial] = num
+        heapq.heappush(heap, (load + n_bytes, num))
+        
+    return placement
+
+def read_metadata_requirements(csv_fn):
+    """
+    read which keys are compulsory from an MT metadata standards CSV file.
+    The files have either a title line and a header with Parameter and
+    Requirement columns or only rows of a LaTeX table 
+    (key & explanation & type & requirement \\\\ \\hline).
+    
+    :param str csv_fn: full path to CSV file
+    
+    :return: dictionary of key --> True if compulsory
+    """
+    with open(csv_fn, 'r', newline='') as fid:
+        lines = list(csv.reader(fid))
+    ### skip a title line, LaTeX rows and the header are kept
+    if lines and '&' not in ','.join(lines[0]) and \
+       'Parameter' not in lines[0]:
+        lines = lines[1:]
+    if not lines:
+        return {}
+    
+    requirements = {}
+    if 'Parameter' in lines[0] and 'Requirement' in lines[0]:
+        key_index = lines[0].index('Parameter')
+        req_index = lines[0].index('Requirement')
+        for line in lines[1:]:
+            if len(line) > max(key_index, req_index) and line[key_index]:
+                requirements[line[key_index].strip()] = \
+                        line[req_index].strip().lower() == 'compulsory'
+    else:
+        for line in lines:
+            parts = [part.strip() for part in ','.join(line).split('&')]
+            if len(parts) < 4:
+                continue
+            key = parts[0].replace('\\_', '_')
+            requirement = parts[3].split('\\')[0].strip().lower()
+            requirements[key] = requirement == 'compulsory'
+            
+    return requirements
+
+def metadata_schema_names():
+    """
+    :return: names of the MT metadata schemas in metadata_path, ex. survey
+    """
+    return sorted([os.path.basename(fn)[:-len('_metadata_mt.json')] 
+                   for fn in glob.glob(os.path.join(metadata_path, 
+                                                    '*_metadata_mt.json'))])
+
+def get_metadata_schema(name, table=None):
+    """
+    compile an MT metadata schema from metadata/<name>_metadata_mt.json and
+    the requirements in metadata/MT Metadata Standards - <Name>.csv into a 
+    table of key --> MetadataField(column_type, width, required).  Each 
+    schema is compiled once and cached.
+    
+    The definitions do not give string widths, so width is None unless a 
+    PH5 table is given, then the widths of its string columns are used.
+    
+    :param str name: schema name [ survey | station | run | data_logger | 
+                     electrics | magnetics ]
+    :param table: PyTables table the entries will be written to 
+                     
+    :return: OrderedDict of key --> MetadataField
+    
+    :Example: ::
+        
+        >>> schema = get_metadata_schema('electrics')
+        >>> schema['dipole/length_d']
+        MetadataField(column_type='float', width=None, required=True)
+    """
+    schema = _compile_metadata_schema(name)
+    if table is None:
+        return schema
+    
+    table_schema = get_table_schema(table)
+    return OrderedDict([(key, field._replace(width=table_schema[key].width))
+                        if key in table_schema else (key, field)
+                        for key, field in schema.items()])
+
+@lru_cache(maxsize=None)
+def _compile_metadata_schema(name):
+    json_fn = os.path.join(metadata_path, '{0}_metadata_mt.json'.format(name))
+    if not os.path.isfile(json_fn):
+        raise ValueError('No metadata schema {0}, choose from {1}'.format(
+                         name, ', '.join(metadata_schema_names())))
+    csv_fn = os.path.join(metadata_path, 'MT Metadata Standards - {0}.csv'.format(
+                          name.replace('_', ' ').title()))
+    requirements = {}
+    if os.path.isfile(csv_fn):
+        requirements = read_metadata_requirements(csv_fn)
+    
+    schema = OrderedDict()
+    for key in load_json(json_fn).keys():
+        key = key.replace(' ', '')
+        schema[key] = MetadataField(get_column_type(key), None, 
+                                    requirements.get(key, False))
+        
+    return schema
+
+def get_table_schema(table):
+    """
+    make a schema from the columns of a PyTables table, no key is required
+    
+    :param table: PyTables table
+    
+    :return: dictionary of column path --> MetadataField
+    """
+    schema = {}
+    for column_path in table.colpathnames:
+        column_type = table.coltypes[column_path]
+        width = None
+        if column_type == 'string':
+            width = table.coldescrs[column_path].itemsize
+        elif column_type.startswith(('int', 'uint')):
+            column_type = 'int'
+        elif column_type.startswith('float'):
+            column_type = 'float'
+        schema[column_path] = MetadataField(column_type, width, False)
+        
+    return schema
+
+def _to_string(value, width, truncate=False):
+    if isinstance(value, bytes):
+        value = value.decode()
+    value = str(value)
+    if width is not None and len(value.encode()) > width:
+        if not truncate:
+            raise ValueError('longer than {0} characters'.format(width))
+        value = value.encode()[:width].decode(errors='ignore')
+    return value
+
+def _to_int(value, width, truncate=False):
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        value = float(value.strip())
+    if float(value) != int(value):
+        raise ValueError('{0} is not an integer'.format(value))
+    return int(value)
+
+def _to_float(value, width, truncate=False):
+    if isinstance(value, bytes):
+        value = value.decode()
+    return float(value)
+
+### functions that check and convert a value to a column type
+converters = {'string': _to_string,
+              'int': _to_int,
+              'float': _to_float}
+
+def validate_entries(entries, schema=None, strict=False, truncate=False):
+    """
+    check and convert a batch of metadata entries before they are written.
+    Values are converted to the column type of their key, strings are 
+    checked to fit the column width and compulsory keys must have a value.
+    Keys that are not in the schema get their type from the key suffix.
+    
+    :param list entries: list of entry dictionaries
+    :param dict schema: key --> MetadataField, see get_metadata_schema and
+                        get_table_schema.  If None only the types from the
+                        key suffixes are checked.
+    :param bool strict: raise a ValueError on the first bad entry instead of
+                        leaving bad entries out
+    :param bool truncate: cut strings to the column width instead of 
+                          reporting them, like writing to the table does
+    
+    :return: list of converted entries, list of (entry index, key, message)
+             of problems found, entries with problems are not in the list of
+             converted entries
+             
+    :Example: ::
+        
+        >>> schema = get_metadata_schema('station')
+        >>> good, errors = validate_entries(station_list, schema)
+        >>> for index, key, message in errors:
+        >>> ...     print(index, key, message)
+    """
+    schema = schema or {}
+    required = [key for key, field in schema.items() if field.required]
+    field_cache = {}
+    
+    good_entries = []
+    errors = []
+    for index, entry in enumerate(entries):
+        entry_errors = []
+        new_entry = {}
+        for key, value in entry.items():
+            if key not in field_cache:
+                try:
+                    field_cache[key] = schema.get(key, 
+                                       MetadataField(get_column_type(key),
+                                                     None, False))
+                except (ValueError, IndexError):
+                    field_cache[key] = None
+            field = field_cache[key]
+            if field is None:
+                new_entry[key] = value
+                continue
+            if value is None:
+                continue
+            try:
+                new_entry[key] = converters[field.column_type](value, 
+                                                               field.width,
+                                                               truncate)
+            except (ValueError, TypeError) as error:
+                entry_errors.append((index, key, str(error)))
+        for key in required:
+            if new_entry.get(key) in [None, '']:
+                entry_errors.append((index, key, 'compulsory key is missing'))
+        
+        if entry_errors:
+            if strict:
+                raise ValueError('Entry {0}: {1} {2}'.format(*entry_errors[0]))
+            errors.extend(entry_errors)
+        else:
+            good_entries.append(new_entry)
+            
+    return good_entries, errors
+
 def load_json(json_fn):
     """
     read in a json file 
@@ -108,13 +835,12 @@ def validate_time_metadata(meta_dict):
             continue
         base = key.split('/')[0]
         if 'ascii_s' in key:
-            t_keys[base]['ascii_s'] = check_timezone(dateutil.parser.parse(value))     
+            t_keys[base]['ascii_s'] = parse_date_time(value)
         elif 'epoch' in key:
-            try:
-                value += meta_dict['{0}/{1}'.format(base, 'micro_seconds_i')]
-            except KeyError:
-                pass
-            t_keys[base]['epoch_l'] = check_timezone(datetime.datetime.fromtimestamp(float(value)))
+            micro_seconds = meta_dict.get('{0}/{1}'.format(base, 
+                                                           'micro_seconds_i'),
+                                          0)
+            t_keys[base]['epoch_l'] = epoch_to_date_time(value, micro_seconds)
             
     for t_key, t_value in t_keys.items():
         dt_obj_s = None
@@ -135,7 +861,7 @@ def validate_time_metadata(meta_dict):
                 print('epoch time is {0}'.format(dt_obj_e.isoformat()))
                 print('Difference is {0}'.format(dt_obj_s - dt_obj_e))
                 print('Using ascii time as the correct one')
-                iso, ts, ms = read_date_time(dt_obj_s.isoformat())
+                iso, ts, ms = format_date_time(dt_obj_s)
                 t_dict = {'ascii_s':iso, 'epoch_l':ts, 'micro_seconds_i':ms}
                 for s_key, s_value in t_dict.items():
                     meta_dict['{0}/{1}'.format(t_key, s_key)] = s_value
@@ -143,18 +869,807 @@ def validate_time_metadata(meta_dict):
             continue
                 
         elif not dt_obj_e:
-            iso, ts, ms = read_date_time(dt_obj_s.isoformat())
+            iso, ts, ms = format_date_time(dt_obj_s)
             t_dict = {'ascii_s':iso, 'epoch_l':ts, 'micro_seconds_i':ms}
             for s_key, s_value in t_dict.items():
                     meta_dict['{0}/{1}'.format(t_key, s_key)] = s_value
                 
         elif not dt_obj_s:
-            iso, ts, ms = read_date_time(dt_obj_e.isoformat())
+            iso, ts, ms = format_date_time(dt_obj_e)
             t_dict = {'ascii_s':iso, 'epoch_l':ts, 'micro_seconds_i':ms}
             for s_key, s_value in t_dict.items():
                     meta_dict['{0}/{1}'.format(t_key, s_key)] = s_value
     
     return meta_dict
+
+def validate_time_metadata_bulk(meta_list):
+    """
+    validate the times of a list of data dictionaries at once.  The ascii
+    and epoch times of each time column are compared as numpy datetime64 
+    arrays and only entries that are missing a value or disagree are 
+    changed, the ascii time is assumed to be correct.
+    
+    :param list meta_list: list of metadata dictionaries
+    
+    :return: the same list with corrected times
+    """
+    t_bases = ['deploy_time', 'pickup_time', 'start_time', 'end_time', 
+               'time_stamp']
+    n_fixed = 0
+    for t_base in t_bases:
+        a_key = '{0}/ascii_s'.format(t_base)
+        e_key = '{0}/epoch_l'.format(t_base)
+        m_key = '{0}/micro_seconds_i'.format(t_base)
+        entries = [meta_dict for meta_dict in meta_list 
+                   if a_key in meta_dict or e_key in meta_dict]
+        if not entries:
+            continue
+        
+        has_ascii = np.array([a_key in entry for entry in entries])
+        has_epoch = np.array([e_key in entry for entry in entries])
+        ascii_times = np.array(
+            [np.datetime64(parse_date_time(entry[a_key]).replace(tzinfo=None),
+                           'us') 
+             if a_key in entry else np.datetime64('NaT') 
+             for entry in entries], dtype='datetime64[us]')
+        epoch_times = (np.array([entry.get(e_key, 0) for entry in entries], 
+                                dtype='datetime64[s]') + 
+                       np.array([entry.get(m_key, 0) for entry in entries],
+                                dtype='timedelta64[us]'))
+        
+        use_ascii = has_ascii & (~has_epoch | (ascii_times != epoch_times))
+        use_epoch = ~has_ascii & has_epoch
+        for index in np.nonzero(use_ascii | use_epoch)[0]:
+            if use_ascii[index]:
+                dt_obj = parse_date_time(entries[index][a_key])
+            else:
+                dt_obj = epoch_to_date_time(entries[index][e_key],
+                                            entries[index].get(m_key, 0))
+            iso, ts, ms = format_date_time(dt_obj)
+            entries[index][a_key] = iso
+            entries[index][e_key] = ts
+            entries[index][m_key] = ms
+            n_fixed += 1
+            
+    if n_fixed:
+        print('Filled or corrected {0} times, ascii time is used as the '
+              'correct one'.format(n_fixed))
+        
+    return meta_list
+        
+def time_value_to_epoch(time_value):
+    """
+    :param time_value: TimeValue
+    :return: epoch seconds including micro seconds as a float
+    """
+    return time_value.epoch_l + time_value.micro_seconds_i / 1E6
+
+def merge_time_spans(spans, gap=0):
+    """
+    merge time spans that overlap or are separated by no more than gap
+    
+    :param list spans: list of (start, end) TimeValues
+    :param float gap: largest gap in seconds between spans that are merged
+    
+    :return: list of merged (start, end) TimeValues sorted by start time
+    """
+    merged = []
+    for start, end in sorted(spans, 
+                             key=lambda span: time_value_to_epoch(span[0])):
+        if (merged and time_value_to_epoch(start) <= 
+                time_value_to_epoch(merged[-1][1]) + gap):
+            if time_value_to_epoch(end) > time_value_to_epoch(merged[-1][1]):
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+            
+    return merged
+
+def get_field(rows, column_path):
+    """
+    get a view of a (nested) column of a structured array
+    
+    :param np.ndarray rows: structured array with the dtype of a table
+    :param str column_path: column path name, ex. start_time/epoch_l
+    
+    :return: view of the column
+    """
+    column = rows
+    for name in column_path.split('/'):
+        column = column[name]
+    return column
+
+def append_rows(table, entries):
+    """
+    append a list of entry dictionaries to a table with a single structured
+    array append.  The rows are the same as adding the entries one at a 
+    time with columns.populate, columns missing from an entry get the 
+    column default and keys that are not columns of the table are ignored.
+    
+    Two things populate cannot write are handled here, a column set to 
+    None gets the column default, a table row would store the text 'None' 
+    or raise, and strings are encoded as UTF-8, a table row raises for 
+    strings that are not ASCII.
+    
+    :param table: PyTables table
+    :param list entries: list of entry dictionaries
+    
+    :return: number of rows appended
+    """
+    if not entries:
+        return 0
+    rows = np.zeros(len(entries), dtype=table.dtype)
+    for column_path in table.colpathnames:
+        default = table.coldflts[column_path]
+        values = [entry.get(column_path) for entry in entries]
+        values = [default if value is None else 
+                  value.encode('utf-8') if isinstance(value, str) else value
+                  for value in values]
+        get_field(rows, column_path)[:] = values
+    table.append(rows)
+    table.flush()
+    
+    return len(entries)
+
+class TableBuffer(object):
+    """
+    Write behind buffer for PH5 tables.  Entries are collected for each 
+    table and written with a single append when a table has max_rows
+    entries waiting or when flush is called.  
+    
+    :param int max_rows: number of entries to hold for a table before it is
+                         written, if less than 2 entries are written as they
+                         are added.
+    :param bool validate: check and convert entries against the table 
+                          columns before they are written, bad entries are
+                          reported and left out.
+                         
+    .. note:: Tables are keyed by file name and node path, so entries for a 
+              file must be flushed before the file is closed.
+              
+    Entries added after mark can be taken back with rollback, whether they
+    are still in the buffer or have been written.
+    """
+    
+    def __init__(self, max_rows=1000, validate=False):
+        self.max_rows = max_rows
+        self.validate = validate
+        self._buffers = OrderedDict()
+        self._mark = None
+        
+    def __len__(self):
+        return sum([len(entries) for table, entries in self._buffers.values()])
+        
+    def append(self, table, entry):
+        """
+        add an entry to be written to table
+        
+        :param table: PyTables table
+        :param dict entry: table entry
+        """
+        key = (table._v_file.filename, table._v_pathname)
+        if self._mark is not None and key not in self._mark:
+            n_buffered = len(self._buffers[key][1]) \
+                         if key in self._buffers else 0
+            self._mark[key] = (table, table.nrows + n_buffered)
+        
+        if self.max_rows < 2:
+            if self.validate:
+                self._write(table, [entry])
+            else:
+                columns.populate(table, entry)
+            return
+        
+        if key not in self._buffers:
+            self._buffers[key] = (table, [])
+        table, entries = self._buffers[key]
+        entries.append(entry)
+        if len(entries) >= self.max_rows:
+            self._write(table, entries)
+            del self._buffers[key]
+        
+    def flush(self, filename=None):
+        """
+        write buffered entries to their tables
+        
+        :param str filename: only flush tables in this file, default is all
+        
+        :return: number of rows written
+        """
+        n_rows = 0
+        for key in list(self._buffers.keys()):
+            if filename is not None and key[0] != filename:
+                continue
+            table, entries = self._buffers.pop(key)
+            n_rows += self._write(table, entries)
+            
+        return n_rows
+    
+    def mark(self):
+        """
+        start keeping track of the entries added from now on so they can be
+        taken back with rollback.  A new mark replaces the old one.
+        """
+        self._mark = OrderedDict()
+        
+    def rollback(self):
+        """
+        take back every entry added since mark.  Entries still in the 
+        buffer are dropped and rows already written are truncated from 
+        their tables.
+        
+        :return: list of (file name, node path) of tables that could not be
+                 rolled back because their file has been closed
+        """
+        closed = []
+        if self._mark is None:
+            return closed
+        for key, (table, n_keep) in self._mark.items():
+            table, entries = self._buffers.get(key, (table, []))
+            if not table._v_isopen:
+                closed.append(key)
+                continue
+            if table.nrows > n_keep:
+                table.truncate(n_keep)
+            del entries[max(n_keep - table.nrows, 0):]
+            if not entries:
+                self._buffers.pop(key, None)
+        self._mark = None
+        
+        return closed
+    
+    def _write(self, table, entries):
+        """
+        append entries to table, validating them first if validate is True
+        """
+        if self.validate:
+            entries, errors = validate_entries(entries, 
+                                               get_table_schema(table))
+            for index, key, message in errors:
+                print('Skipping entry {0} of {1}, {2}: {3}'.format(
+                      index, table._v_pathname, key, message))
+        if not entries:
+            return 0
+        return append_rows(table, entries)
+        
+class _Stage(object):
+    """
+    context manager that times one stage for IngestStats.  
+    
+    Stages can be nested, the tracemalloc peak is reset when a stage starts
+    so the peak an outer stage had reached is kept on the outer stage and 
+    the peak of the inner stage is passed up to it when the inner stage 
+    ends.
+    """
+    
+    def __init__(self, stats, name, n_bytes):
+        self.stats = stats
+        self.name = name
+        self.n_bytes = n_bytes
+        self.outer_peak = 0
+        
+    def __enter__(self):
+        if self.stats.track_memory:
+            stages = self.stats._stages
+            if stages:
+                stages[-1].outer_peak = max(stages[-1].outer_peak,
+                                            tracemalloc.get_traced_memory()[1])
+            stages.append(self)
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        peak = 0
+        if self.stats.track_memory:
+            peak_memory = max(tracemalloc.get_traced_memory()[1], 
+                              self.outer_peak)
+            stages = self.stats._stages
+            if stages and stages[-1] is self:
+                stages.pop()
+            if stages:
+                stages[-1].outer_peak = max(stages[-1].outer_peak, 
+                                            peak_memory)
+            peak = max(peak_memory - self.memory_start, 0)
+        self.stats.record(self.name, seconds, self.n_bytes, peak)
+        return False
+
+class IngestStats(object):
+    """
+    Opt in timing of the stages of an ingest.  For each named stage the 
+    number of calls, wall time, bytes written and peak memory are kept for
+    each input file and in total.  When disabled stage returns a shared do
+    nothing context so the cost is a single method call.
+    
+    :param bool enabled: record stages
+    :param bool track_memory: record peak memory of each stage with 
+                              tracemalloc, this slows things down
+    :param str log_fn: JSON lines file to append per file statistics to
+    
+    :Example: ::
+        
+        >>> stats = IngestStats(enabled=True)
+        >>> stats.start_file('test.Z3D')
+        >>> with stats.stage('write_array', n_bytes=data.nbytes):
+        >>> ...     write(data)
+        >>> stats.end_file()
+        >>> stats.to_dict()['total']
+    """
+    
+    def __init__(self, enabled=False, track_memory=False, log_fn=None):
+        self.enabled = enabled
+        self.track_memory = track_memory
+        self.log_fn = log_fn
+        self.total = OrderedDict()
+        self.files = OrderedDict()
+        self.current_file = None
+        self._null_stage = nullcontext()
+        self._stages = []
+        if self.enabled and self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            
+    def stage(self, name, n_bytes=0):
+        """
+        time a stage 
+        
+        :param str name: name of stage
+        :param int n_bytes: number of bytes written in the stage
+        
+        :return: context manager
+        """
+        if not self.enabled:
+            return self._null_stage
+        return _Stage(self, name, n_bytes)
+    
+    def _add(self, stages, name, seconds, n_bytes, peak):
+        if name not in stages:
+            stages[name] = {'calls': 0, 'seconds': 0.0, 'bytes': 0,
+                            'peak_memory': 0}
+        stage = stages[name]
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        stage['bytes'] += int(n_bytes)
+        stage['peak_memory'] = max(stage['peak_memory'], int(peak))
+        
+    def record(self, name, seconds, n_bytes=0, peak=0):
+        """
+        add a measurement of a stage to the current file and the total
+        """
+        self._add(self.total, name, seconds, n_bytes, peak)
+        if self.current_file is not None:
+            self._add(self.files[self.current_file], name, seconds, n_bytes,
+                      peak)
+            
+    def start_file(self, fn):
+        """
+        start recording stages for an input file
+        
+        :param fn: file name or object being loaded
+        """
+        if not self.enabled:
+            return
+        self.current_file = str(fn)
+        self.files.setdefault(self.current_file, OrderedDict())
+        
+    def end_file(self):
+        """
+        stop recording stages for the current file and write them to the
+        log file
+        """
+        if not self.enabled or self.current_file is None:
+            return
+        self.write_log({'file': self.current_file,
+                        'stages': self.files[self.current_file]})
+        self.current_file = None
+        
+    def write_log(self, entry):
+        """
+        append an entry to the JSON lines log file
+        """
+        if self.log_fn is None:
+            return
+        with open(self.log_fn, 'a') as fid:
+            fid.write('{0}\n'.format(json.dumps(entry)))
+            
+    def to_dict(self):
+        """
+        :return: dictionary of total and per file stage statistics
+        """
+        return {'total': self.total, 'files': self.files}
+    
+    def __str__(self):
+        lines = ['{0:<20}{1:>8}{2:>12}{3:>14}{4:>14}'.format(
+                 'stage', 'calls', 'seconds', 'bytes', 'peak memory')]
+        for name, stage in self.total.items():
+            lines.append('{0:<20}{1:>8}{2:>12.3f}{3:>14}{4:>14}'.format(
+                         name, stage['calls'], stage['seconds'], 
+                         stage['bytes'], stage['peak_memory']))
+        return '\n'.join(lines)
+
+def file_hash(fn, block_size=2**20):
+    """
+    get the sha1 hash of the contents of a file
+    
+    :param str fn: full path to file
+    :param int block_size: number of bytes read at a time
+    
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    with open(fn, 'rb') as fid:
+        for block in iter(lambda: fid.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def index_entry_times(entry):
+    """
+    get the start and end of a time index table entry in epoch seconds
+    
+    :param dict entry: time index table entry
+    
+    :return: start, end as floats
+    """
+    start = (entry['start_time/epoch_l'] + 
+             entry.get('start_time/micro_seconds_i', 0) / 1E6)
+    end = (entry['end_time/epoch_l'] + 
+           entry.get('end_time/micro_seconds_i', 0) / 1E6)
+    return float(start), float(end)
+
+class TimeIndex(object):
+    """
+    In memory index of the time spans in the time index table (Index_t) for
+    each data logger, to answer which mini file has data at a time, where 
+    the gaps are and how much of a window is covered without scanning the
+    table.  
+    
+    For each serial number the spans are kept as numpy arrays sorted by 
+    start time, with a running maximum of the end times, so a query is a 
+    binary search plus a look at the spans that start before the end of the
+    query.  New spans are held in lists and merged into the arrays on the 
+    next query.
+    
+    :Example: ::
+        
+        >>> time_index = TimeIndex()
+        >>> time_index.add('ZEN_024', 0, 3600, './miniPH5_00001.ph5')
+        >>> time_index.add('ZEN_024', 7200, 10800, './miniPH5_00001.ph5')
+        >>> time_index.gaps('ZEN_024')
+        [(3600.0, 7200.0)]
+        >>> time_index.coverage('ZEN_024', 0, 10800)
+        0.6666666666666666
+    """
+    
+    def __init__(self):
+        self._spans = {}
+        self._pending = {}
+        
+    def __len__(self):
+        return sum([len(spans[0]) for spans in self._spans.values()] + 
+                   [len(pending) for pending in self._pending.values()])
+        
+    @property
+    def serials(self):
+        """
+        serial numbers in the index
+        """
+        return sorted(set(self._spans) | set(self._pending))
+    
+    def add(self, serial, start, end, mini=''):
+        """
+        add a time span
+        
+        :param str serial: data logger serial number
+        :param float start: start time in epoch seconds
+        :param float end: end time in epoch seconds
+        :param str mini: mini file name the data are in
+        """
+        if isinstance(serial, bytes):
+            serial = serial.decode()
+        if isinstance(mini, bytes):
+            mini = mini.decode()
+        self._pending.setdefault(serial, []).append((float(start), 
+                                                     float(end), mini))
+        
+    def add_entry(self, entry):
+        """
+        add a time index table entry, see generic2ph5.make_time_index_entry
+        
+        :param dict entry: time index table entry
+        """
+        start, end = index_entry_times(entry)
+        self.add(entry['serial_number_s'], start, end, 
+                 entry.get('external_file_name_s', ''))
+        
+    def build(self, index_t):
+        """
+        bulk load the spans from a time index table by reading its columns
+        
+        :param index_t: PyTables time index table
+        
+        :return: self
+        """
+        serials = index_t.col('serial_number_s')
+        starts = (index_t.col('start_time/epoch_l') + 
+                  index_t.col('start_time/micro_seconds_i') / 1E6)
+        ends = (index_t.col('end_time/epoch_l') + 
+                index_t.col('end_time/micro_seconds_i') / 1E6)
+        minis = index_t.col('external_file_name_s')
+        for serial in np.unique(serials):
+            mask = serials == serial
+            self._pending.setdefault(serial.decode(), []).extend(
+                zip(starts[mask].tolist(), ends[mask].tolist(),
+                    [mini.decode() for mini in minis[mask]]))
+        
+        return self
+    
+    def _get_spans(self, serial):
+        """
+        get the sorted spans of a serial number, merging in pending spans
+        
+        :return: starts, ends, running maximum of ends, minis
+        """
+        if isinstance(serial, bytes):
+            serial = serial.decode()
+        pending = self._pending.pop(serial, None)
+        if pending:
+            starts, ends, max_ends, minis = self._spans.get(
+                serial, (np.zeros(0), np.zeros(0), None, np.zeros(0, 'U')))
+            new_starts, new_ends, new_minis = zip(*pending)
+            starts = np.concatenate([starts, new_starts])
+            ends = np.concatenate([ends, new_ends])
+            minis = np.concatenate([minis, np.array(new_minis, dtype='U')])
+            order = np.argsort(starts, kind='mergesort')
+            starts, ends, minis = starts[order], ends[order], minis[order]
+            self._spans[serial] = (starts, ends, np.maximum.accumulate(ends),
+                                   minis)
+        try:
+            return self._spans[serial]
+        except KeyError:
+            return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, 'U')
+        
+    def overlap(self, serial, start, end):
+        """
+        get the spans of a serial number that overlap a window
+        
+        :param str serial: data logger serial number
+        :param float start: start of window in epoch seconds
+        :param float end: end of window in epoch seconds
+        
+        :return: list of (start, end, mini) sorted by start
+        """
+        starts, ends, max_ends, minis = self._get_spans(serial)
+        ### spans starting after the window are never needed and spans 
+        ### before the first whose running max end reaches start are done
+        i1 = np.searchsorted(starts, end, side='right')
+        i0 = np.searchsorted(max_ends[:i1], start, side='left')
+        index = i0 + np.nonzero(ends[i0:i1] >= start)[0]
+        
+        return [(float(starts[ii]), float(ends[ii]), str(minis[ii])) 
+                for ii in index]
+    
+    def at(self, serial, time):
+        """
+        get the mini files that have data for a serial number at a time
+        
+        :param str serial: data logger serial number
+        :param float time: time in epoch seconds
+        
+        :return: list of mini file names
+        """
+        minis = []
+        for start, end, mini in self.overlap(serial, time, time):
+            if mini not in minis:
+                minis.append(mini)
+        return minis
+    
+    def merged(self, serial, gap=1.0):
+        """
+        merge the spans of a serial number that overlap or are separated by
+        no more than gap seconds
+        
+        :param str serial: data logger serial number
+        :param float gap: largest gap in seconds that is merged
+        
+        :return: starts, ends of the merged spans as numpy arrays
+        """
+        starts, ends, max_ends, minis = self._get_spans(serial)
+        if starts.size == 0:
+            return starts, ends
+        breaks = np.nonzero(starts[1:] > max_ends[:-1] + gap)[0]
+        merged_starts = np.concatenate([starts[0:1], starts[breaks + 1]])
+        merged_ends = np.concatenate([max_ends[breaks], max_ends[-1:]])
+        
+        return merged_starts, merged_ends
+    
+    def gaps(self, serial, start=None, end=None, gap=1.0):
+        """
+        find the gaps in the data of a serial number
+        
+        :param str serial: data logger serial number
+        :param float start: start of window in epoch seconds, default is the
+                            start of the data
+        :param float end: end of window in epoch seconds, default is the end
+                          of the data
+        :param float gap: gaps up to this many seconds are ignored
+        
+        :return: list of (gap start, gap end) in epoch seconds
+        """
+        starts, ends = self.merged(serial, gap)
+        if starts.size == 0:
+            if start is not None and end is not None and end > start:
+                return [(float(start), float(end))]
+            return []
+        gap_starts = list(ends[:-1])
+        gap_ends = list(starts[1:])
+        if start is not None and starts[0] - start > gap:
+            gap_starts.insert(0, start)
+            gap_ends.insert(0, starts[0])
+        if end is not None and end - ends[-1] > gap:
+            gap_starts.append(ends[-1])
+            gap_ends.append(end)
+            
+        gaps = []
+        for gap_start, gap_end in zip(gap_starts, gap_ends):
+            if start is not None:
+                gap_start = max(gap_start, start)
+            if end is not None:
+                gap_end = min(gap_end, end)
+            if gap_end > gap_start:
+                gaps.append((float(gap_start), float(gap_end)))
+        return gaps
+    
+    def coverage(self, serial, start, end, gap=1.0):
+        """
+        fraction of a window that has data for a serial number
+        
+        :param str serial: data logger serial number
+        :param float start: start of window in epoch seconds
+        :param float end: end of window in epoch seconds
+        :param float gap: gaps up to this many seconds count as covered
+        
+        :return: fraction between 0 and 1
+        """
+        if end <= start:
+            return 0.
+        starts, ends = self.merged(serial, gap)
+        covered = (np.minimum(ends, end) - np.maximum(starts, start)).clip(0)
+        return float(min(covered.sum() / (end - start), 1.))
+
+class IngestLedger(object):
+    """
+    Ledger of input files that have been loaded into a PH5 file, kept as a
+    JSON lines file so an ingest that stops part way can be restarted and
+    only load files that are new or have changed.
+    
+    Each line has the keys
+    
+        * path --> full path to the input file
+        * size --> size of the file in bytes
+        * mtime --> modification time of the file
+        * hash --> sha1 hash of the file contents
+        * outputs --> list of dictionaries of das, array and mini file the
+                      file was written to
+    
+    The first line holds the id of the master PH5 file the ledger belongs
+    to, {"master_id": id}.
+    
+    :param str ledger_fn: full path to the ledger file
+    :param str master_id: id of the master PH5 file, see 
+                          generic2ph5.master_id.  A ledger made for a 
+                          different master file is discarded.
+    
+    .. note:: files are recorded with record and only written to the ledger
+              file by commit, which should be called once the table rows of
+              the recorded files are written.
+    """
+    
+    def __init__(self, ledger_fn, master_id=None):
+        self.ledger_fn = ledger_fn
+        self.master_id = master_id
+        self.entries = {}
+        self._pending = []
+        self._new_file = True
+        self.read()
+        
+    def read(self):
+        """
+        read the ledger file, later lines replace earlier ones for the same
+        path.  If the ledger was made for a different master file it is 
+        ignored and replaced on the next commit.
+        """
+        self.entries = {}
+        self._new_file = True
+        if not os.path.isfile(self.ledger_fn):
+            return
+        ledger_master_id = None
+        with open(self.ledger_fn, 'r') as fid:
+            for line in fid:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partial line from an interrupted write
+                    continue
+                if 'path' not in entry:
+                    ledger_master_id = entry.get('master_id')
+                    continue
+                self.entries[entry['path']] = entry
+        
+        if self.master_id is not None and ledger_master_id != self.master_id:
+            ### the master file was made again, nothing in it is loaded
+            self.entries = {}
+            return
+        self._new_file = False
+                
+    def is_done(self, fn):
+        """
+        check if a file has already been loaded and has not changed.  The 
+        size and modification time are checked first, the file is only 
+        hashed if those changed.
+        
+        :param str fn: full path to input file
+        
+        :return: True if the file can be skipped
+        """
+        path = os.path.abspath(fn)
+        try:
+            entry = self.entries[path]
+        except KeyError:
+            return False
+        
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime == entry['mtime']:
+            return True
+        if file_hash(path) == entry['hash']:
+            entry['mtime'] = stat.st_mtime
+            self._pending.append(entry)
+            return True
+        return False
+        
+    def record(self, fn, outputs):
+        """
+        record a file as loaded, it is written to the ledger file by commit
+        
+        :param str fn: full path to input file
+        :param list outputs: list of dictionaries describing where the data
+                             of the file were written
+        """
+        path = os.path.abspath(fn)
+        stat = os.stat(path)
+        entry = {'path': path,
+                 'size': stat.st_size,
+                 'mtime': stat.st_mtime,
+                 'hash': file_hash(path),
+                 'outputs': outputs}
+        self.entries[path] = entry
+        self._pending.append(entry)
+        
+    def commit(self):
+        """
+        append the recorded files to the ledger file
+        """
+        if not self._pending:
+            return
+        with open(self.ledger_fn, 'w' if self._new_file else 'a') as fid:
+            if self._new_file:
+                fid.write('{0}\n'.format(json.dumps({'master_id': 
+                                                     self.master_id})))
+            for entry in self._pending:
+                fid.write('{0}\n'.format(json.dumps(entry)))
+            fid.flush()
+            os.fsync(fid.fileno())
+        self._pending = []
+        self._new_file = False
         
 # =============================================================================
 #  A generic class with tools to convert any data into PH5
@@ -181,8 +1696,74 @@ class generic2ph5(object):
     
     def __init__(self):
         
-        self.ph5_obj = None
+        self._ph5_obj = None
         self.mini_size_max = 26843545600
+        self.mini_pool_size = 4
+        self._mini_pool = OrderedDict()
+        self._next_array_num = {}
+        ### rows are written as they are added unless buffering is turned
+        ### on with table_buffer.max_rows, then flush or close must be called
+        self.table_buffer = TableBuffer(max_rows=1)
+        self._session_time_stamp = None
+        self.aggregate_sorts = False
+        self.sort_merge_gap = 1.0
+        self._sort_extents = OrderedDict()
+        self._sort_mark = {}
+        self._array_num_mark = {}
+        self._external_links = OrderedDict()
+        self.ledger = None
+        self.stats = IngestStats()
+        self.storage_profile = None
+        self.num_mini = None
+        self.first_mini = 1
+        self.reset_indexes()
+        
+    @property
+    def ph5_obj(self):
+        return self._ph5_obj
+    
+    @ph5_obj.setter
+    def ph5_obj(self, ph5_obj):
+        """
+        attach a PH5 object, any lookup indexes from a previously attached
+        object are dropped and rebuilt from the new one on first use.
+        """
+        self._ph5_obj = ph5_obj
+        self.ledger = None
+        self.reset_indexes()
+        
+    def reset_indexes(self):
+        """
+        drop the in-memory lookup indexes so they are rebuilt from the 
+        attached PH5 object the next time they are needed.
+        """
+        self._receiver_index = None
+        self._receiver_columns = None
+        self._n_receivers = 0
+        self._response_index = None
+        self._n_arrays = 0
+        self.invalidate_das_station_map()
+        self._mini_catalog = None
+        self._mini_plan = {}
+        self._time_index = None
+        
+    @property
+    def session_time_stamp(self):
+        """
+        time stamp, as a TimeValue, used for the time_stamp columns of every
+        table entry made in an ingest session so they are consistent.  It is
+        made on first use, call new_session to start a new one.
+        """
+        if self._session_time_stamp is None:
+            self.new_session()
+        return self._session_time_stamp
+    
+    def new_session(self):
+        """
+        start a new ingest session with a new time stamp
+        """
+        self._session_time_stamp = make_time_value(
+                                datetime.datetime.now(datetime.timezone.utc))
         
     @property
     def ph5_path(self):
@@ -211,42 +1792,283 @@ class generic2ph5(object):
         
         ph5_path = Path(ph5_fn)
         
-        self.ph5_obj = experiment.ExperimentGroup(nickname=ph5_path.name,
-                                             currentpath=ph5_path.parent)
-        self.ph5_obj.ph5open(True)
-        self.ph5_obj.initgroup()
+        self.ph5_obj = experiment.ExperimentGroup(nickname=ph5_path.name,
+                                             currentpath=ph5_path.parent)
+        self.ph5_obj.ph5open(True)
+        self.ph5_obj.initgroup()
+        
+        print("Made PH5 File {0}".format(ph5_path))
+    
+    def get_arrays(self):
+        """
+        read in each array entry as a dictionary from sorts group and append
+        to a list.
+        
+        :return: list of sorts group array table entries 
+        """    
+        self.flush_tables()
+        arrays = []
+        for name in self.ph5_obj.ph5_g_sorts.names():
+            array_list, null = self.ph5_obj.ph5_g_sorts.read_arrays(name)
+            for entry in array_list:
+                arrays.append(entry)
+                
+        return arrays
+    
+    @property
+    def response_index(self):
+        """
+        response_index is a dictionary of 
+        (station, sample_rate, channel_number) --> response_table_n_i 
+        for the array tables in the sorts group.  It is built from the 
+        attached PH5 object the first time it is needed and kept up to date
+        as rows are added to the array tables through add_array_to_sorts.
+        """
+        if self._response_index is None:
+            self.build_response_index()
+        return self._response_index
+    
+    def build_response_index(self):
+        """
+        read the sorts group array tables once and index the response 
+        table numbers
+        
+        :return: response index dictionary
+        """
+        self._response_index = {}
+        self._n_arrays = 0
+        for array_entry in self.get_arrays():
+            self._index_array_entry(array_entry)
+            
+        return self._response_index
+    
+    def _index_array_entry(self, array_entry, array_name=None):
+        """
+        add an entry that was just appended to an array table to the lookup
+        indexes.  The first entry for a given key wins, same as a linear 
+        search through the tables would find.
+        
+        :param dict array_entry: array table entry
+        :param str array_name: name of the array table the entry is in
+        """
+        self._n_arrays += 1
+        key = response_key(array_entry['id_s'],
+                           array_entry['sample_rate_i'],
+                           array_entry['channel_number_i'])
+        self._response_index.setdefault(key, 
+                                        array_entry['response_table_n_i'])
+        if array_name is not None and self._das_station_map is not None:
+            self._map_das_station(array_entry.get('das/serial_number_s', ''),
+                                  array_entry['id_s'],
+                                  array_name)
+        
+    def append_array_entry(self, array_name, array_dict):
+        """
+        append a row to an array table in the sorts group and keep the 
+        lookup indexes current
+        
+        :param str array_name: name of array --> Array_t_xxxxx
+        :param dict array_dict: array table entry
+        """
+        ### make sure the indexes exist before the table grows
+        if self._response_index is None:
+            self.build_response_index()
+        if self._das_station_map is None:
+            self.build_das_station_map()
+        self.buffer_row(self.ph5_obj.ph5.get_node(
+                            '/Experiment_g/Sorts_g/{0}'.format(array_name)),
+                        array_dict)
+        self._index_array_entry(array_dict, array_name)
+        
+    def buffer_row(self, table, entry):
+        """
+        add an entry to a table through the write behind buffer, see 
+        TableBuffer.  Rows are written right away unless 
+        table_buffer.max_rows is more than 1, then call flush_tables, flush
+        or close to make sure all entries are written.
+        
+        :param table: PyTables table
+        :param dict entry: table entry
+        """
+        self.table_buffer.append(table, entry)
+        
+    def flush_tables(self, filename=None):
+        """
+        write the entries waiting in the write behind buffer
+        
+        :param str filename: only flush tables in this file, default is all
+        """
+        self.table_buffer.flush(filename)
         
-        print("Made PH5 File {0}".format(ph5_path))
-    
-    def get_arrays(self):
+    def mark_rollback(self):
         """
-        read in each array entry as a dictionary from sorts group and append
-        to a list.
+        mark the point to go back to if loading a file fails part way, see
+        rollback.
+        """
+        self.table_buffer.mark()
+        self._sort_mark = dict([(key, len(extents)) for key, extents in 
+                                self._sort_extents.items()])
+        self._array_num_mark = dict(self._next_array_num)
         
-        :return: list of sorts group array table entries 
-        """    
-        arrays = []
-        for name in self.ph5_obj.ph5_g_sorts.names():
-            array_list, null = self.ph5_obj.ph5_g_sorts.read_arrays(name)
-            for entry in array_list:
-                arrays.append(entry)
-                
-        return arrays
+    def rollback(self, outputs):
+        """
+        take back what was added since mark_rollback so a file that failed 
+        part way leaves nothing behind.  Table entries are dropped or 
+        truncated, the data arrays in outputs are removed from their mini 
+        files and the lookup indexes are rebuilt from disk on next use.
+        
+        :param list outputs: list of dictionaries of das, array and mini 
+                             file of the data arrays written since the mark
+                             
+        :return: list of (file name, node path) of tables that could not be
+                 rolled back, see TableBuffer.rollback
+        """
+        closed = self.table_buffer.rollback()
+        for output in outputs:
+            mini_handle, mini_name = self.get_mini(get_mini_num(output['mini']))
+            array_path = '/Experiment_g/Receivers_g/Das_g_{0}/{1}'.format(
+                                            output['das'], output['array'])
+            if array_path in mini_handle.ph5:
+                mini_handle.ph5.remove_node(array_path)
+        
+        for key, extents in list(self._sort_extents.items()):
+            n_keep = self._sort_mark.get(key, 0)
+            if n_keep:
+                del extents[n_keep:]
+            else:
+                del self._sort_extents[key]
+        self._next_array_num = self._array_num_mark
+        
+        mini_plan = self._mini_plan
+        self.reset_indexes()
+        self._mini_plan = mini_plan
+        
+        return closed
     
     def get_receivers(self):
         """
         get receivers entrys
         """
+        self.flush_tables()
         receivers = []
         receiver_list, null = self.ph5_obj.ph5_g_receivers.read_receiver()
         for entry in receiver_list:
-            entry = {key.decode() if isinstance(key, bytes) else key:
-                     val.decode() if isinstance(val, bytes) else val
-                     for key, val in entry.items()}
-            receivers.append(entry)
+            receivers.append(decode_entry(entry))
                 
         return receivers
+    
+    @property
+    def receiver_columns(self):
+        """
+        columns of the receiver table used to make receiver keys, see 
+        receiver_key
+        """
+        if self._receiver_columns is None:
+            self._receiver_columns = table_columns(
+                                    self.ph5_obj.ph5_g_receivers.ph5_t_receiver)
+        return self._receiver_columns
+    
+    @property
+    def receiver_index(self):
+        """
+        receiver_index is a dictionary of receiver_key(entry) --> row number
+        (starting at 1) of the receiver table.  It is built from the attached
+        PH5 object the first time it is needed and kept up to date as 
+        receivers are added with add_reciever_to_table.
+        """
+        if self._receiver_index is None:
+            self.build_receiver_index()
+        return self._receiver_index
+    
+    def build_receiver_index(self):
+        """
+        read the receiver table once and hash each entry to its row number
+        
+        :return: receiver index dictionary
+        """
+        self._receiver_index = {}
+        self._n_receivers = 0
+        for entry in self.get_receivers():
+            self._index_receiver(entry)
+            
+        return self._receiver_index
+    
+    def _index_receiver(self, receiver_entry):
+        """
+        add a receiver entry that was just appended to the receiver table to
+        the index.  If an identical entry already exists the first row number
+        is kept, same as a linear search would find.
+        
+        :return: row number of the appended entry
+        """
+        self._n_receivers += 1
+        self._receiver_index.setdefault(receiver_key(receiver_entry,
+                                                     self.receiver_columns),
+                                        self._n_receivers)
+        return self._n_receivers
+        
+    
+    @property
+    def time_index(self):
+        """
+        time_index is a TimeIndex of the time spans in the time index table
+        for each data logger.  It is built from the attached PH5 object the
+        first time it is needed and kept up to date as entries are added 
+        with add_index_entry.
+        """
+        if self._time_index is None:
+            self.flush_tables()
+            self._time_index = TimeIndex().build(
+                                    self.ph5_obj.ph5_g_receivers.ph5_t_index)
+        return self._time_index
+    
+    def add_index_entry(self, index_t_entry):
+        """
+        add an entry to the time index table and the time index
+        
+        :param dict index_t_entry: time index table entry
+        """
+        self.buffer_row(self.ph5_obj.ph5_g_receivers.ph5_t_index, 
+                        index_t_entry)
+        if self._time_index is not None:
+            self._time_index.add_entry(index_t_entry)
+            
+    def find_minis(self, station, time):
+        """
+        find the data loggers and mini files that have data for a station at
+        a given time
+        
+        :param str station: station name or data logger serial number
+        :param time: time string, datetime or epoch seconds
+        
+        :return: list of (serial, mini file name)
+        """
+        epoch = to_epoch(time)
+        found = []
+        for serial in sorted(self.get_station_serials(station) | {station}):
+            for mini in self.time_index.at(serial, epoch):
+                found.append((serial, mini))
+                
+        return found
+    
+    def find_gaps(self, station, start_time=None, end_time=None, gap=1.0):
+        """
+        find the gaps in the data of each data logger of a station
+        
+        :param str station: station name or data logger serial number
+        :param start_time: start of window, default is start of the data
+        :param end_time: end of window, default is end of the data
+        :param float gap: gaps up to this many seconds are ignored
         
+        :return: dictionary of serial --> list of (gap start, gap end) in
+                 epoch seconds
+        """
+        start = None if start_time is None else to_epoch(start_time)
+        end = None if end_time is None else to_epoch(end_time)
+        return dict([(serial, self.time_index.gaps(serial, start, end, gap))
+                     for serial in sorted(self.get_station_serials(station) | 
+                                          {station})
+                     if serial in self.time_index.serials])
     
     @property
     def das_station_map(self):
@@ -261,28 +2083,88 @@ class generic2ph5(object):
         :return: list of dictionaries
         
         .. note:: If there are no array entries returns and empty list
+        
+        .. note:: The map is cached and kept up to date as array entries are
+                  added, use invalidate_das_station_map if the sorts group
+                  is changed by other means.
         """
-        array_names = self.ph5_obj.ph5_g_sorts.namesArray_t()
-        if not array_names:
-            return []
-        station_list = []
-        # use tables where to search array tables and find matches
-        for array_name in array_names:
+        if self._das_station_map is None:
+            self.build_das_station_map()
+        
+        return [{'serial': serial, 'station': station, 'array_name': name}
+                for serial, station, name in self._das_station_map]
+    
+    def build_das_station_map(self):
+        """
+        bulk build the serial <--> station <--> array map by reading the 
+        station and data logger columns of each array table in the sorts 
+        group.  Use this for files opened from disk.
+        
+        :return: dictionary of (serial, station, array_name) keys
+        """
+        self.flush_tables()
+        self._das_station_map = {}
+        self._station_arrays = {}
+        self._station_serials = {}
+        self._serial_stations = {}
+        for array_name in self.ph5_obj.ph5_g_sorts.namesArray_t():
             table = self.ph5_obj.ph5.get_node('/Experiment_g/Sorts_g/{0}'.format(
                 array_name))
-            data = table.read()
-            for row in data:
-                station_list.append({'serial': row[4][0], 
-                                     'station': row[13],
-                                     'array_name': array_name})
-        
-        das_station_map = []
-        for station in station_list:
-            if station not in das_station_map:
-                das_station_map.append(station)
+            for serial, station in zip(table.col('das/serial_number_s'),
+                                       table.col('id_s')):
+                self._map_das_station(serial, station, array_name)
         table = None
+        
+        return self._das_station_map
+    
+    def invalidate_das_station_map(self):
+        """
+        drop the cached das_station_map so it is rebuilt on next use
+        """
+        self._das_station_map = None
+        self._station_arrays = {}
+        self._station_serials = {}
+        self._serial_stations = {}
+    
+    def _map_das_station(self, serial, station, array_name):
+        """
+        add a serial, station, array name triplet to the das_station_map
+        """
+        if isinstance(serial, bytes):
+            serial = serial.decode()
+        if isinstance(station, bytes):
+            station = station.decode()
+        key = (serial, station, array_name)
+        if key in self._das_station_map:
+            return
+        self._das_station_map[key] = None
+        self._station_arrays.setdefault(station, array_name)
+        self._station_serials.setdefault(station, set()).add(serial)
+        self._serial_stations.setdefault(serial, set()).add(station)
+        
+    def get_station_serials(self, station):
+        """
+        get the data logger serial numbers used by a station
+        
+        :param str station: station name
+        
+        :return: set of serial numbers
+        """
+        if self._das_station_map is None:
+            self.build_das_station_map()
+        return self._station_serials.get(station, set())
     
-        return das_station_map
+    def get_serial_stations(self, serial):
+        """
+        get the stations a data logger has recorded
+        
+        :param str serial: data logger serial number
+        
+        :return: set of station names
+        """
+        if self._das_station_map is None:
+            self.build_das_station_map()
+        return self._serial_stations.get(serial, set())
     
     def get_sort_array_name(self, station):
         """
@@ -292,11 +2174,15 @@ class generic2ph5(object):
         
         .. note:: station name should be verbatim or close
         """
-        
-        for entry in self.das_station_map:
-            ### the entry is binary, need to decode into unicode
-            if station in entry['station'].decode():
-                return entry['array_name']
+        if self._das_station_map is None:
+            self.build_das_station_map()
+        try:
+            return self._station_arrays[station]
+        except KeyError:
+            pass
+        for entry_station, array_name in self._station_arrays.items():
+            if station in entry_station:
+                return array_name
         return None
         
     def open_mini(self, mini_num):
@@ -315,37 +2201,132 @@ class generic2ph5(object):
         mini_ph5_obj.initgroup()
         
         return mini_ph5_obj, filename
+    
+    def get_mini(self, mini_num):
+        """
+        Get an open mini PH5 file from the pool of open mini files, it is 
+        opened with open_mini if it is not in the pool.  The pool holds at 
+        most mini_pool_size files, when it is full the least recently used 
+        mini file is flushed and closed.
+        
+        :param mini_num: number of mini file to get
+        
+        :return: class: ph5.core.experiment, str: name
+        
+        .. note:: do not close the returned mini file, use close_minis when
+                  done adding data.
+        """
+        if mini_num in self._mini_pool:
+            self._mini_pool.move_to_end(mini_num)
+            return self._mini_pool[mini_num]
+        
+        while self._mini_pool and len(self._mini_pool) >= self.mini_pool_size:
+            old_num, (old_handle, old_name) = self._mini_pool.popitem(last=False)
+            self._release_mini(old_num, old_handle)
+        with self.stats.stage('mini_open'):
+            self._mini_pool[mini_num] = self.open_mini(mini_num)
+        
+        return self._mini_pool[mini_num]
+    
+    def _release_mini(self, mini_num, mini_ph5_obj):
+        """
+        flush and close a mini PH5 file that is leaving the pool, the file
+        size and modification time in the mini catalog are updated to match
+        the closed file.
+        """
+        self.flush_tables(mini_ph5_obj.ph5.filename)
+        mini_ph5_obj.ph5.flush()
+        mini_ph5_obj.ph5close()
+        self.update_mini_stat(mini_num)
+        
+    def close_minis(self):
+        """
+        flush and close all mini PH5 files in the pool, then save the mini 
+        catalog so it matches the closed files.
+        """
+        with self.stats.stage('mini_close'):
+            released = bool(self._mini_pool)
+            while self._mini_pool:
+                mini_num, (mini_ph5_obj, name) = self._mini_pool.popitem(
+                                                                    last=False)
+                self._release_mini(mini_num, mini_ph5_obj)
+            if released:
+                self.save_mini_catalog()
      
-    def get_current_mini_num(self, station, first_mini=1):
+    def get_current_mini_num(self, station, first_mini=None, n_bytes=0):
         """
         get the current mini number for the given station.
         
-        :param str station: station name
-        :param int first_mini: number of the first mini PH5 file
+        A data logger already in a mini file stays in it, then one placed by
+        plan_minis goes where it was planned unless that mini file has since
+        filled up past mini_size_max.  Otherwise if num_mini is set
+        the mini file with the fewest bytes out of num_mini is used, if not
+        the last mini file is used until the projected bytes would take it
+        over mini_size_max.
+        
+        :param str station: station name or data logger serial number
+        :param int first_mini: number of the first mini PH5 file, default is
+                               self.first_mini
+        :param int n_bytes: projected bytes of the data about to be written,
+                            see projected_bytes
         
         :return: current mini number.
         
+        .. note:: uses the mini catalog so no mini files are opened.
         """    
-        mini_list = self.get_mini_list()
-        if not mini_list:
-            current_mini = first_mini
-        else:
-            current_mini = None 
-            for mini in self.mini_map:
-                for entry in self.das_station_map:
-                    if (entry['serial'] in mini['das_list'] and
-                            entry['station'] == station):
-                        current_mini = mini['num']
-                if not current_mini:
-                    largest = 0
-                    for station in self.mini_map:
-                        if station['num'] >= largest:
-                            largest = station['num']
-                    if (mini['size'] < self.mini_size_max):
-                        current_mini = largest
-                    else:
-                        current_mini = largest + 1
-        return current_mini
+        if first_mini is None:
+            first_mini = self.first_mini
+        catalog = self.mini_catalog
+        
+        ### keep a data logger in the mini file it is already in
+        serials = self.get_station_serials(station) | {station}
+        for mini in catalog.values():
+            if serials.intersection(mini['das_list']):
+                return mini['num']
+        for serial in serials:
+            if serial in self._mini_plan:
+                num = self._mini_plan[serial]
+                size = catalog[num]['size'] if num in catalog else 0
+                if size == 0 or size + n_bytes <= self.mini_size_max:
+                    return num
+                break
+        
+        if self.num_mini:
+            sizes = [(catalog[num]['size'] if num in catalog else 0, num)
+                     for num in range(first_mini, 
+                                      first_mini + self.num_mini)]
+            size, num = min(sizes)
+            if size == 0 or size + n_bytes <= self.mini_size_max:
+                return num
+        
+        if not catalog:
+            return first_mini
+        largest = max(catalog)
+        if (catalog[largest]['size'] == 0 or 
+            catalog[largest]['size'] + n_bytes <= self.mini_size_max):
+            return max(largest, first_mini)
+        return max(largest + 1, first_mini)
+    
+    def plan_minis(self, das_bytes, num_mini=None):
+        """
+        plan which mini file each data logger goes into before any data are
+        written so the mini files come out balanced, see 
+        plan_mini_placement.  Data loggers already in a mini file stay 
+        there.
+        
+        :param dict das_bytes: data logger serial number --> projected bytes
+        :param int num_mini: number of mini files, default is self.num_mini
+        
+        :return: dictionary of data logger serial number --> mini number
+        """
+        if num_mini is None:
+            num_mini = self.num_mini
+        self._mini_plan = plan_mini_placement(das_bytes, 
+                                              num_mini=num_mini,
+                                              mini_size_max=self.mini_size_max,
+                                              first_mini=self.first_mini,
+                                              existing=self.mini_catalog)
+        return self._mini_plan
     
     def get_mini_size(self, mini_fn):
         """
@@ -378,29 +2359,220 @@ class generic2ph5(object):
         
             * num --> mini file number
             * das_list --> list of stations associated with that mini file
-            * size --> size of mini file in bytes
+            * size --> uncompressed bytes of the data arrays in the mini file
         
         :return: list of dictionaries containing what mini file contains 
                  what serial #s
+                 
+        .. note:: this is read from the mini catalog, see mini_catalog
+        """
+        return [self.mini_catalog[num] for num in sorted(self.mini_catalog)]
+    
+    @property
+    def master_id(self):
+        """
+        id of the attached master PH5 file.  It is made the first time it is
+        asked for and kept as an attribute of the root group, so a master 
+        file that is deleted and made again gets a new id.
+        """
+        attrs = self.ph5_obj.ph5.root._v_attrs
+        if 'ingest_id' not in attrs._v_attrnames:
+            attrs.ingest_id = uuid.uuid4().hex
+        return str(attrs.ingest_id)
+    
+    @property
+    def ledger_fn(self):
+        """
+        full path to the ingest ledger of the master file, it sits next to
+        the master file and is named after it
+        """
+        master_name = os.path.splitext(os.path.basename(
+                                            self.ph5_obj.filename))[0]
+        return os.path.join(self.ph5_path, 
+                            '{0}_ingest_ledger.jsonl'.format(master_name))
+    
+    @property
+    def mini_catalog_fn(self):
+        """
+        full path to the mini catalog file that sits next to the master 
+        """
+        return os.path.join(self.ph5_path, 'miniPH5_catalog.json')
+    
+    @property
+    def mini_catalog(self):
+        """
+        mini_catalog is a dictionary of mini number --> mini_map entry.  
+        Sizes are uncompressed bytes of the data arrays, the same as 
+        projected_bytes, so they can be compared with mini_size_max before
+        anything is written.  It is read from mini_catalog_fn the first 
+        time it is needed, mini files missing from it or whose size or 
+        modification time changed since it was saved are scanned, see 
+        load_mini_catalog.  It is updated as data are written with 
+        update_mini_catalog and saved with save_mini_catalog.
+        """
+        if self._mini_catalog is None:
+            self.load_mini_catalog()
+        return self._mini_catalog
+    
+    def load_mini_catalog(self):
+        """
+        read the mini catalog from disk.  Each entry keeps the file size and
+        modification time of its mini file, a mini file that does not match
+        them, or is not in the catalog, is scanned instead.
+        
+        :return: mini catalog dictionary
+        """
+        saved = {}
+        if os.path.isfile(self.mini_catalog_fn):
+            for entry in load_json(self.mini_catalog_fn):
+                saved[entry['num']] = entry
+                
+        catalog = {}
+        for mini_fn in self.get_mini_list():
+            mini_num = get_mini_num(mini_fn)
+            entry = saved.get(mini_num)
+            if entry is None or mini_file_stat(mini_fn) != \
+                    (entry.get('file_size'), entry.get('mtime')):
+                entry = self.scan_mini_file(mini_fn)
+            catalog[mini_num] = entry
+            
+        self._mini_catalog = catalog
+        return self._mini_catalog
+    
+    def scan_mini_file(self, mini_fn):
+        """
+        list the data loggers a mini file contains and the uncompressed 
+        bytes of its data arrays.  The file is opened read only, or the 
+        open handle is used if it is in the pool of open mini files.  This
+        is slow for large mini files and is only used when the mini catalog
+        is out of date.
+        
+        :param str mini_fn: full path to mini file
+        
+        :return: mini catalog entry
+        """
+        mini_num = get_mini_num(mini_fn)
+        read_files = {}
+        das_list = []
+        mini_size = 0
+        try:
+            h5 = self._read_mini_file(mini_num, read_files)
+            if '/Experiment_g/Receivers_g' in h5:
+                for group in h5.iter_nodes('/Experiment_g/Receivers_g', 
+                                           'Group'):
+                    if group._v_name.startswith('Das_g_'):
+                        das_list.append(group._v_name[len('Das_g_'):])
+                for node in h5.walk_nodes('/Experiment_g/Receivers_g',
+                                          'Array'):
+                    if node._v_name.startswith('Data_a_'):
+                        mini_size += int(node.nrows) * node.atom.itemsize
+        finally:
+            for h5 in read_files.values():
+                h5.close()
+        file_size, mtime = mini_file_stat(mini_fn)
+        
+        return {'num':mini_num,
+                'das_list':das_list,
+                'size':mini_size,
+                'file_size':file_size,
+                'mtime':mtime}
+    
+    def scan_mini_files(self):
+        """
+        scan every mini file, see scan_mini_file
+        
+        :return: mini catalog dictionary
         """
-        mini_map = []
+        catalog = {}
         for mini_fn in self.get_mini_list():
-            mini_num = int(mini_fn.split('.')[-2].split('_')[-1])
-            exrec = experiment.ExperimentGroup(nickname=mini_fn)
-            exrec.ph5open(True)
-            exrec.initgroup()
-            all_das = exrec.ph5_g_receivers.alldas_g()
-            mini_size = self.get_mini_size(exrec.filename)
-            das_list = []
-            for g in all_das:
-                name = g.split('_')[-1]
-                das_list.append(name)
-            mini_map.append({'num':mini_num,
-                             'das_list':das_list,
-                             'size':mini_size})
-            exrec.ph5close()
+            catalog[get_mini_num(mini_fn)] = self.scan_mini_file(mini_fn)
+            
+        return catalog
+    
+    def update_mini_catalog(self, mini_num, serial, n_bytes=0):
+        """
+        record data written to a mini file
+        
+        :param int mini_num: mini file number
+        :param str serial: data logger serial number the data belongs to
+        :param int n_bytes: number of bytes written
+        """
+        catalog = self.mini_catalog
+        if mini_num not in catalog:
+            catalog[mini_num] = {'num':mini_num, 'das_list':[], 'size':0,
+                                 'file_size':None, 'mtime':None}
+        entry = catalog[mini_num]
+        if serial not in entry['das_list']:
+            entry['das_list'].append(serial)
+        entry['size'] += int(n_bytes)
+        
+    def update_mini_stat(self, mini_num):
+        """
+        record the file size and modification time of a closed mini file in
+        its mini catalog entry, see load_mini_catalog
+        
+        :param int mini_num: mini file number
+        """
+        if self._mini_catalog is None or mini_num not in self._mini_catalog:
+            return
+        mini_fn = os.path.join(self.ph5_path, 
+                               'miniPH5_{0:05}.ph5'.format(mini_num))
+        file_size, mtime = mini_file_stat(mini_fn)
+        self._mini_catalog[mini_num]['file_size'] = file_size
+        self._mini_catalog[mini_num]['mtime'] = mtime
+        
+    def save_mini_catalog(self):
+        """
+        write the mini catalog next to the master PH5 file.  Mini files that
+        are still open have their file size and modification time recorded
+        when they are closed, see close_minis.
+        """
+        if self._mini_catalog is None:
+            return
+        with open(self.mini_catalog_fn, 'w') as fid:
+            json.dump(self.mini_map, fid, indent=4)
+            
+    def flush(self):
+        """
+        write any state that is kept in memory while loading data to disk.
+        Call this when done adding data.
+        
+        .. note:: the files waiting in the ingest ledger are committed as 
+                  loaded last, once their rows, external links and the mini
+                  catalog are on disk.
+        """
+        with self.stats.stage('flush'):
+            self.flush_sorts()
+            self.flush_tables()
+            self.reconcile_external_references()
+            self.save_mini_catalog()
+            if self.ledger is not None:
+                self.ledger.commit()
+            
+    def close(self):
+        """
+        flush everything kept in memory and close the mini files.  The 
+        master PH5 object is left open for the caller to close.  Mini files
+        are closed even if the flush fails.
+        
+        :Example: ::
+            
+            >>> with generic2ph5() as ph5_gen:
+            >>> ...     ph5_gen.ph5_obj = ph5_obj
+            >>> ...     ph5_gen.add_channel(...)
+            >>> ph5_obj.ph5close()
+        """
+        try:
+            self.flush()
+        finally:
+            self.close_minis()
             
-        return mini_map   
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
     
     ### add survey metadata
     def add_survey_metadata(self, survey_dict):
@@ -446,6 +2618,10 @@ class generic2ph5(object):
         ===================================== =============================== ======
         """
         survey_dict = validate_time_metadata(survey_dict)
+        ### check and convert the values before they get to the table
+        survey_dict = validate_entries([survey_dict], 
+                                       get_table_schema(self.ph5_obj.ph5_g_experiment.Experiment_t),
+                                       strict=True, truncate=True)[0][0]
         
         keys_not_added = columns.append(self.ph5_obj.ph5_g_experiment.Experiment_t,
                                         survey_dict)
@@ -492,7 +2668,7 @@ class generic2ph5(object):
                 
      
     ### Add a station 
-    def add_array_to_sorts(self, array_name, array_dict):
+    def add_array_to_sorts(self, array_name, array_dict, validate=True):
         """
         add array metadata to main ph5 file
             * will add entry to Sorts_t
@@ -512,6 +2688,9 @@ class generic2ph5(object):
         
         :param dict array_dict: dictionary containing important metadata
         
+        :param bool validate: validate times with validate_time_metadata,
+                              set to False if already validated
+        
         :return: array name
         
         station_dict should have
@@ -559,15 +2738,66 @@ class generic2ph5(object):
         response_table_n_i           response table number           int
         ============================ =============================== ==============
         """
-        array_dict = validate_time_metadata(array_dict)
+        if validate:
+            array_dict = validate_time_metadata(array_dict)
         ### make new array in sorts table
         ### make a new sorts array table from given name
         if not array_name in self.ph5_obj.ph5_g_sorts.namesArray_t():
             self.ph5_obj.ph5_g_sorts.newArraySort(array_name)
-        self.ph5_obj.ph5_g_sorts.populateArray_t(array_dict, name=array_name)
+        self.append_array_entry(array_name, array_dict)
         
         return array_name
     
+    def add_sort_entry(self, sorts_dict):
+        """
+        add an entry to the sorts table.  If aggregate_sorts is True the 
+        time span of the entry is held in memory instead and one entry per
+        array and deployment window is written by flush_sorts.
+        
+        :param dict sorts_dict: sorts table entry with start_time and 
+                                end_time keys
+        """
+        if not self.aggregate_sorts:
+            self.buffer_row(self.ph5_obj.ph5_g_sorts.ph5_t_sort, sorts_dict)
+            return
+        
+        key = tuple([sorts_dict.get(name, '') for name in 
+                     ['array_name_s', 'array_t_name_s', 'description_s',
+                      'event_id_s']])
+        start = TimeValue(*[sorts_dict['start_time/{0}'.format(t_key)] 
+                            for t_key in t_list])
+        end = TimeValue(*[sorts_dict['end_time/{0}'.format(t_key)] 
+                          for t_key in t_list])
+        self._sort_extents.setdefault(key, []).append((start, end))
+        
+    def flush_sorts(self):
+        """
+        write the sorts table entries held by add_sort_entry.  For each 
+        array the time spans are merged where they overlap or are less than
+        sort_merge_gap seconds apart, and one entry is written per merged 
+        span.
+        
+        :return: number of sorts entries written
+        """
+        n_rows = 0
+        for key, extents in self._sort_extents.items():
+            array_name, array_t_name, description, event_id = key
+            for start, end in merge_time_spans(extents, self.sort_merge_gap):
+                sorts_dict = {'event_id_s': event_id,
+                              'array_name_s': array_name,
+                              'array_t_name_s': array_t_name,
+                              'description_s': description}
+                set_time_value(sorts_dict, 'start_time', start)
+                set_time_value(sorts_dict, 'end_time', end)
+                set_time_value(sorts_dict, 'time_stamp', 
+                               self.session_time_stamp)
+                self.buffer_row(self.ph5_obj.ph5_g_sorts.ph5_t_sort, 
+                                sorts_dict)
+                n_rows += 1
+        self._sort_extents = OrderedDict()
+        
+        return n_rows
+    
     def add_reciever_to_table(self, receiver_dict):
         """
         Add a receiver metadata to the receivers table
@@ -584,9 +2814,12 @@ class generic2ph5(object):
         dip/units_s               units of azimuth                  string 
         ========================= ================================= ===========
         """
+        ### make sure the index exists before the table grows
+        receiver_index = self.receiver_index
         ### add receiver information to table
-        self.ph5_obj.ph5_g_receivers.populateReceiver_t(receiver_dict)
-        n_row = self.ph5_obj.ph5_g_receivers.ph5_t_receiver.nrows
+        self.buffer_row(self.ph5_obj.ph5_g_receivers.ph5_t_receiver,
+                        receiver_dict)
+        n_row = self._index_receiver(receiver_dict)
         
         return n_row
     
@@ -602,28 +2835,68 @@ class generic2ph5(object):
         
         return n_row
     
-    def add_station_mini(self, station_name):
+    def add_station_mini(self, station_name, n_bytes=0):
         """
         Make a station mini_ph5_xxxxx file
         
         :param str station_name: station name
+        :param int n_bytes: projected bytes of the data to be added, used to
+                            pick the mini file, see get_current_mini_num
         
         :return: das_group_name, mini_ph5_object
+        
+        .. note:: the mini file is opened for the caller, close it with 
+                  ph5close when done.  If table_buffer.max_rows is more than
+                  1 call flush_tables first.  A mini file in the pool of 
+                  open mini files is flushed and closed before it is opened
+                  here, use get_station_mini to work with the pool instead.
         """
         ### get mini number first
-        mini_num = self.get_current_mini_num(station_name)
+        mini_num = self.get_current_mini_num(station_name, n_bytes=n_bytes)
+        if mini_num in self._mini_pool:
+            self._release_mini(mini_num, self._mini_pool.pop(mini_num)[0])
         mini_ph5_obj, filename = self.open_mini(mini_num)
+        das_group = self._set_station_das(mini_ph5_obj, station_name)
+        self.update_mini_catalog(mini_num, station_name)
+        
+        return das_group, mini_ph5_obj
+    
+    def get_station_mini(self, station_name, n_bytes=0):
+        """
+        get the mini file of a station from the pool of open mini files, 
+        see get_mini, and make the station group current
+        
+        :param str station_name: station name
+        :param int n_bytes: projected bytes of the data to be added, used to
+                            pick the mini file, see get_current_mini_num
+        
+        :return: das_group_name, mini_ph5_object
+        
+        .. note:: do not close the returned mini file, use close_minis when 
+                  done adding data.
+        """
+        mini_num = self.get_current_mini_num(station_name, n_bytes=n_bytes)
+        mini_ph5_obj, filename = self.get_mini(mini_num)
+        das_group = self._set_station_das(mini_ph5_obj, station_name)
+        self.update_mini_catalog(mini_num, station_name)
         
-        ### make sure there is a station group
+        return das_group, mini_ph5_obj
+    
+    def _set_station_das(self, mini_ph5_obj, station_name):
+        """
+        make sure there is a station group in a mini file and make it the
+        current one
+        """
         das_group = mini_ph5_obj.ph5_g_receivers.getdas_g(station_name)
         if not das_group:
             das_group, dt, rt, tt = mini_ph5_obj.ph5_g_receivers.newdas(station_name)
         mini_ph5_obj.ph5_g_receivers.setcurrent(das_group)
         
-        return das_group, mini_ph5_obj
+        return das_group
     
     def add_channel(self, mini_ph5_obj, station, array_dict, channel_array,
-                    data_type='int32', description=None):
+                    data_type='int32', description=None, 
+                    storage_profile=None):
         """
         add channel to station mini PH5 file
         
@@ -631,19 +2904,18 @@ class generic2ph5(object):
         :param str station: station name
         :param array channel_array: data array
         :param dict channel_meta_dict: channel 
+        :param storage_profile: storage profile of the data array, default is
+                                self.storage_profile, see 
+                                get_storage_profile
+        
+        .. note:: call flush when done adding channels, table rows are 
+                  buffered and the external references to the mini files 
+                  are made then.
             
         """
         array_dict = validate_time_metadata(array_dict)
         #Make sure we aren't overwriting a data array
-        count = 1
-        while True:
-            next_num = '{0:05}'.format(count)
-            data_array_name = "Data_a_{0}".format(next_num)
-            node = mini_ph5_obj.ph5_g_receivers.find_trace_ref(data_array_name)
-            if not node:
-                break
-            count = count + 1
-            continue
+        count, data_array_name = self.next_array_name(mini_ph5_obj)
         
         ### get channel dictionary from array metadata
         channel_dict = self.make_channel_entry(array_dict)
@@ -653,28 +2925,67 @@ class generic2ph5(object):
         channel_dict['array_name_data_a'] = data_array_name
         
         ### create new data array
-        mini_ph5_obj.ph5_g_receivers.newarray(channel_dict['array_name_data_a'],
-                                              channel_array,
-                                              dtype=data_type,
-                                              description=description)
-        
-        ### add the channel metadata to the das table
-        mini_ph5_obj.ph5_g_receivers.populateDas_t(channel_dict)
-        
-        ### add channel metadata to appropriate sorts array
-        sorts_array_name = self.get_sort_array_name(station)
-        self.add_array_to_sorts(sorts_array_name, array_dict)
-        
-        ### make time index entry
-        t_index_entry = self.make_time_index_entry(array_dict,
-                                                   mini_ph5_obj.nickname)
-        self.ph5_obj.ph5_g_receivers.populateIndex_t(t_index_entry)
+        if storage_profile is None:
+            storage_profile = self.storage_profile
+        sampling_rate = (array_dict.get('sample_rate_i', 1) / 
+                         float(array_dict.get('sample_rate_multiplier_i', 1)
+                               or 1))
+        with self.stats.stage('write_array', channel_array.nbytes):
+            write_array(mini_ph5_obj,
+                        channel_dict['array_name_data_a'],
+                        np.asarray(channel_array, dtype=data_type),
+                        profile=storage_profile,
+                        sampling_rate=sampling_rate,
+                        description=description)
+        
+        self.update_mini_catalog(get_mini_num(mini_ph5_obj.filename),
+                                 get_das_name(mini_ph5_obj),
+                                 channel_array.nbytes)
+        
+        with self.stats.stage('populate_tables'):
+            ### add the channel metadata to the das table
+            self.buffer_row(mini_ph5_obj.ph5_g_receivers.current_t_das, 
+                            channel_dict)
+            
+            ### add channel metadata to appropriate sorts array
+            sorts_array_name = self.get_sort_array_name(station)
+            if sorts_array_name is None:
+                sorts_array_name = self.ph5_obj.ph5_g_sorts.nextName()
+            self.add_array_to_sorts(sorts_array_name, array_dict, 
+                                    validate=False)
+            
+            ### make time index entry
+            t_index_entry = self.make_time_index_entry(array_dict,
+                                                       mini_ph5_obj.nickname)
+            self.add_index_entry(t_index_entry)
         
         ### update external references
         self.update_external_reference(t_index_entry)
         
         return t_index_entry
     
+    def next_array_name(self, mini_ph5_obj, first=1):
+        """
+        get the next free data array name in the current das group of a mini
+        PH5 file.  A counter is kept for each das group, it is seeded once 
+        from the largest Data_a_xxxxx already in the group so the group does
+        not need to be searched again.
+        
+        :param object mini_ph5_obj: mini PH5 object with current das group set
+        :param int first: smallest array number to use
+        
+        :return: array number, array name --> Data_a_xxxxx
+        """
+        das_group = mini_ph5_obj.ph5_g_receivers.current_g_das
+        key = (mini_ph5_obj.filename, das_group._v_name)
+        if key not in self._next_array_num:
+            self._next_array_num[key] = get_max_array_num(das_group) + 1
+        
+        array_num = max(first, self._next_array_num[key])
+        self._next_array_num[key] = array_num + 1
+        
+        return array_num, "Data_a_{0:05}".format(array_num)
+    
     def make_channel_entry(self, meta_dict):
         """
         make a channel dictionary from array dictionary 
@@ -717,9 +3028,8 @@ class generic2ph5(object):
                     channel_dict['sample_rate_i'],
                     channel_dict['channel_number_i'])
         ### add receiver table entry number to metadata
-        channel_dict['receiver_table_n_i'] = self.get_receiver_n(meta_dict['id_s'],
-                    channel_dict['sample_rate_i'],
-                    channel_dict['channel_number_i'])
+        channel_dict['receiver_table_n_i'] = meta_dict.get('receiver_table_n_i',
+                                                           0)
         
         return channel_dict
     
@@ -735,11 +3045,7 @@ class generic2ph5(object):
             entry_dict['end_time/{0}'.format(t_key)] = meta_dict['pickup_time/{0}'.format(t_key)]
     
         ### make time stamp
-        now = datetime.datetime.now(datetime.timezone.utc)
-        entry_dict['time_stamp/ascii_s'] = now.isoformat()
-        entry_dict['time_stamp/epoch_l'] = int(now.timestamp())
-        entry_dict['time_stamp/micro_seconds_i'] = now.microsecond
-        entry_dict['time_stamp/type_s'] = 'BOTH'
+        set_time_value(entry_dict, 'time_stamp', self.session_time_stamp)
         
         ### add external references
         entry_dict['hdf5_path_s'] = "/Experiment_g/Receivers_g/Das_g_{0}".format(entry_dict['serial_number_s'])
@@ -749,52 +3055,329 @@ class generic2ph5(object):
     
     def update_external_reference(self, time_entry_dict):
         """
-        make external reference for mini file
+        make external reference for mini file.  If rows are written as they
+        are added the link is made right away, otherwise it is only recorded
+        here and made or updated once by reconcile_external_references when
+        flush or close is called.
         """
         
         external_fn = time_entry_dict['external_file_name_s'][2:]
         external_dir = time_entry_dict['hdf5_path_s']
         
-        target = '{0}:{1}'.format(external_fn, external_dir)
-        external_group = external_dir.split('/')[3]
+        self._external_links[external_dir] = '{0}:{1}'.format(external_fn, 
+                                                              external_dir)
+        if self.table_buffer.max_rows < 2:
+            self.reconcile_external_references()
         
-        try:
-            group_node = self.ph5_obj.ph5.get_node(external_dir)
-            group_node.remove()
-    
-        except Exception:
-            pass
+    def reconcile_external_references(self):
+        """
+        make the external references recorded by update_external_reference,
+        links that already point at the right mini file are left alone.
         
-        #   Re-create node
-        try:
-            self.ph5_obj.ph5.create_external_link('/Experiment_g/Receivers_g', 
-                                                  external_group, target)
-        except Exception as error:
-            print('x'*10)
-            print(error)
-            print('x'*10)
+        :return: number of links made
+        """
+        n_links = 0
+        for external_dir, target in self._external_links.items():
+            external_group = external_dir.split('/')[3]
+            try:
+                group_node = self.ph5_obj.ph5.get_node(external_dir)
+            except tables.NoSuchNodeError:
+                group_node = None
+            
+            if group_node is not None:
+                if (isinstance(group_node, tables.link.ExternalLink) and
+                        group_node.target == target):
+                    continue
+                try:
+                    group_node.remove()
+                except Exception:
+                    pass
+                
+            #   Re-create node
+            try:
+                self.ph5_obj.ph5.create_external_link('/Experiment_g/Receivers_g', 
+                                                      external_group, target)
+                n_links += 1
+            except Exception as error:
+                print('x'*10)
+                print(error)
+                print('x'*10)
+        self._external_links = OrderedDict()
+        
+        return n_links
         
     def get_receiver_n(self, receiver_entry):
         """
         get receiver table index for given station, given channel
+        
+        :param dict receiver_entry: receiver table entry
+        
+        :return: (exists, row number) if the entry is not in the table yet
+                 the row number is where it would be added.
         """
-        # figure out receiver
-        for count, entry in enumerate(self.get_receivers(), 1):
-            if entry == receiver_entry:
-                return True, count
-        return False, len(self.get_receivers()) + 1
+        n_row = self.receiver_index.get(receiver_key(receiver_entry,
+                                                     self.receiver_columns))
+        if n_row is not None:
+            return True, n_row
+        return False, self._n_receivers + 1
     
     def get_response_n(self, station, sample_rate, channel_number):
         """
-        get receiver table index for given station, given channel
+        get response table index for given station, given channel
+        
+        :param str station: station name
+        :param int sample_rate: sample rate (samples/second)
+        :param int channel_number: channel number
+        
+        :return: response table number, if the station channel is not in 
+                 the sorts group yet the number of array entries is returned
+        """
+        key = response_key(station, sample_rate, channel_number)
+        try:
+            return self.response_index[key]
+        except KeyError:
+            return self._n_arrays
+    
+    ### read data back
+    def find_channels(self, station, component):
+        """
+        find the data loggers and channel numbers that recorded a component
+        at a station from the array tables in the sorts group
+        
+        :param str station: station name
+        :param str component: component, matched to description_s 
+                              ignoring case
+        
+        :return: list of (serial, channel_number)
+        """
+        self.flush_tables()
+        channels = []
+        for array_name in self.ph5_obj.ph5_g_sorts.namesArray_t():
+            table = self.ph5_obj.ph5.get_node('/Experiment_g/Sorts_g/{0}'.format(
+                array_name))
+            mask = ((table.col('id_s') == station.encode()) & 
+                    (np.char.lower(table.col('description_s')) == 
+                     component.lower().encode()))
+            for serial, channel_number in zip(
+                    table.col('das/serial_number_s')[mask],
+                    table.col('channel_number_i')[mask]):
+                channel = (serial.decode(), int(channel_number))
+                if channel not in channels:
+                    channels.append(channel)
+                    
+        return channels
+    
+    def find_segments(self, serial, channel_number, start, end, 
+                      read_files=None):
+        """
+        find the data arrays of a channel that overlap a time window.  The
+        time index table gives the mini files the data logger is in and the
+        das table in each mini file gives the data arrays.
+        
+        :param str serial: data logger serial number
+        :param int channel_number: channel number
+        :param float start: start of window in epoch seconds
+        :param float end: end of window in epoch seconds
+        :param dict read_files: mini number --> read only HDF5 file, mini 
+                                files opened here are added to it and left
+                                open for the caller to close.  If None they
+                                are closed before returning.
+        
+        :return: list of dictionaries sorted by start time with keys
+        
+            * mini --> mini file number
+            * array --> data array name
+            * start --> time of first sample in epoch seconds
+            * sampling_rate --> samples per second
+            * n_samples --> number of samples in the array
+        """
+        self.flush_tables()
+        index_t = self.ph5_obj.ph5_g_receivers.ph5_t_index
+        mask = ((index_t.col('serial_number_s') == serial.encode()) &
+                (index_t.col('start_time/epoch_l') <= end) &
+                (index_t.col('end_time/epoch_l') + 1 >= start))
+        mini_names = sorted(set(index_t.col('external_file_name_s')[mask]))
+        
+        close_files = read_files is None
+        if close_files:
+            read_files = {}
+        segments = []
+        try:
+            for mini_name in mini_names:
+                mini_num = get_mini_num(mini_name.decode())
+                h5_file = self._read_mini_file(mini_num, read_files)
+                try:
+                    das_t = h5_file.get_node(
+                            '/Experiment_g/Receivers_g/Das_g_{0}/Das_t'.format(
+                            serial))
+                except tables.NoSuchNodeError:
+                    continue
+                multiplier = das_t.col('sample_rate_multiplier_i').astype(float)
+                multiplier[multiplier == 0] = 1
+                sampling_rate = das_t.col('sample_rate_i') / multiplier
+                seg_start = (das_t.col('time/epoch_l') + 
+                             das_t.col('time/micro_seconds_i') / 1E6)
+                n_samples = das_t.col('sample_count_i')
+                seg_end = seg_start + n_samples / sampling_rate
+                mask = ((das_t.col('channel_number_i') == channel_number) &
+                        (seg_start < end) & (seg_end > start))
+                for ii in np.nonzero(mask)[0]:
+                    segments.append({'mini': mini_num,
+                                     'array': das_t.col('array_name_data_a')[ii].decode(),
+                                     'start': float(seg_start[ii]),
+                                     'sampling_rate': float(sampling_rate[ii]),
+                                     'n_samples': int(n_samples[ii])})
+        finally:
+            if close_files:
+                for h5_file in read_files.values():
+                    h5_file.close()
+                
+        return sorted(segments, key=lambda segment: segment['start'])
+    
+    def _read_mini_file(self, mini_num, read_files):
+        """
+        get the HDF5 file of a mini file to read from.  A mini file in the 
+        pool of open mini files is used as is, otherwise it is opened read 
+        only and kept in read_files for the caller to close.
+        """
+        if mini_num in self._mini_pool:
+            return self._mini_pool[mini_num][0].ph5
+        if mini_num not in read_files:
+            read_files[mini_num] = tables.open_file(
+                    os.path.join(self.ph5_path, 
+                                 "miniPH5_{0:05}.ph5".format(mini_num)), 'r')
+        return read_files[mini_num]
+    
+    def read_window(self, station, component, start_time, end_time, 
+                    as_mtts=False):
+        """
+        read a window of data for a station component.  Only the samples in
+        the window are read from the data arrays, so reading a short window
+        from a long channel is fast.
+        
+        :param str station: station name
+        :param str component: component, ex. ex, hy
+        :param start_time: start of the window
+        :param end_time: end of the window, the sample at end_time is not
+                         included
+        :type start_time: string, datetime or epoch seconds
+        :type end_time: string, datetime or epoch seconds
+        :param bool as_mtts: return an mtpy MTTS object
+        
+        :return: ChannelWindow, or MTTS object if as_mtts is True.  None if
+                 there are no data in the window.
+                 
+        :raises ValueError: if the data in the window come from more than 
+                            one data logger, channel number or sample rate,
+                            they cannot be joined into one window.
+        
+        .. note:: if the window covers more than one data array they are 
+                  joined in time order, gaps and overlaps between them are
+                  not filled but are listed in ChannelWindow.gaps and 
+                  logged.
+                  
+        .. note:: mini files that are not open for writing are opened read 
+                  only and closed before returning, mini files in the pool
+                  of open mini files are read from as they are and left 
+                  open.
+                  
+        :Example: ::
+            
+            >>> ph5_obj = generic2ph5()
+            >>> ph5_obj.open_ph5_file(r"/home/mt/survey.ph5")
+            >>> window = ph5_obj.read_window('mt01', 'ex',
+            >>> ...                          '2020-01-10T00:00:00',
+            >>> ...                          '2020-01-10T00:10:00')
+            >>> window.data.shape
+            (153600,)
+        """
+        start = to_epoch(start_time)
+        end = to_epoch(end_time)
+        
+        pieces = []
+        read_files = {}
+        try:
+            for serial, channel_number in self.find_channels(station, 
+                                                             component):
+                segments = self.find_segments(serial, channel_number, start, 
+                                              end, read_files)
+                for segment in segments:
+                    ### partial read of only the samples in the window
+                    sampling_rate = segment['sampling_rate']
+                    i0 = max(int(np.ceil((start - segment['start']) * 
+                                         sampling_rate - 1E-6)), 0)
+                    i1 = min(int(np.ceil((end - segment['start']) * 
+                                         sampling_rate - 1E-6)), 
+                             segment['n_samples'])
+                    if i1 <= i0:
+                        continue
+                    h5_file = self._read_mini_file(segment['mini'], 
+                                                   read_files)
+                    node = h5_file.get_node(
+                            '/Experiment_g/Receivers_g/Das_g_{0}/{1}'.format(
+                            serial, segment['array']))
+                    pieces.append((segment['start'] + i0 / sampling_rate,
+                                   sampling_rate, node[i0:i1], serial, 
+                                   channel_number))
+        finally:
+            for h5_file in read_files.values():
+                h5_file.close()
+        if not pieces:
+            logger.info('No data for {0} {1} between {2} and {3}'.format(
+                        station, component, start_time, end_time))
+            return None
+        
+        sources = sorted(set([(piece[3], piece[4], piece[1]) 
+                              for piece in pieces]))
+        if len(sources) > 1:
+            raise ValueError('Data for {0} {1} between {2} and {3} come from '
+                             'more than one (data logger, channel, sample '
+                             'rate): {4}, read a shorter window'.format(
+                             station, component, start_time, end_time, 
+                             sources))
+        
+        pieces.sort(key=lambda piece: piece[0])
+        first_start, sampling_rate, data, serial, channel_number = pieces[0]
+        gaps = []
+        for previous, current in zip(pieces[:-1], pieces[1:]):
+            previous_end = previous[0] + previous[2].shape[0] / sampling_rate
+            gap = current[0] - previous_end
+            if abs(gap) > 1. / sampling_rate:
+                gaps.append((epoch_to_date_time(previous_end), gap))
+                logger.warning('Gap of {0:.6f} s in {1} {2} at {3}'.format(
+                               gap, station, component, 
+                               epoch_to_date_time(previous_end)))
+        if len(pieces) > 1:
+            data = np.concatenate([piece[2] for piece in pieces])
+        window = ChannelWindow(data, epoch_to_date_time(first_start), 
+                               sampling_rate, serial, channel_number, gaps)
+        
+        if as_mtts:
+            return self.window_to_mtts(window, station, component)
+        return window
+    
+    def window_to_mtts(self, window, station, component):
+        """
+        make an mtpy MTTS object from a ChannelWindow
+        
+        :param window: ChannelWindow from read_window
+        :param str station: station name
+        :param str component: component
+        
+        :return: MTTS object
         """
-        # figure out receiver and response n_i
-        for count, array_entry in enumerate(self.get_arrays(), 1):
-            if (array_entry['sample_rate_i'] == sample_rate and
-                array_entry['channel_number_i'] == channel_number and
-                array_entry['id_s'] == station):
-                return array_entry['response_table_n_i']
-        return len(self.get_arrays())
+        from mtpy.core import ts as mtts
+        
+        ts_obj = mtts.MTTS()
+        ts_obj.station = station
+        ts_obj.component = component
+        ts_obj.channel_number = window.channel_number
+        ts_obj.data_logger = window.serial
+        ts_obj.sampling_rate = window.sampling_rate
+        ts_obj.start_time_utc = window.start.isoformat()
+        ts_obj.ts = window.data
+        
+        return ts_obj
 
 
 
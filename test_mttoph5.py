@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for mttoph5, data are written to PH5 files made in a temporary
+directory and read back with PyTables.
+"""
+# =============================================================================
+# Imports
+# =============================================================================
+import tracemalloc
+
+import numpy as np
+import pytest
+import tables
+
+pytest.importorskip('ph5')
+pytest.importorskip('mtpy')
+
+from ph5.core import experiment
+
+import mttoph5
+
+# =============================================================================
+# Helpers
+# =============================================================================
+@pytest.fixture
+def mt_obj(tmp_path):
+    ph5_obj = experiment.ExperimentGroup(nickname='master.ph5',
+                                         currentpath=str(tmp_path))
+    ph5_obj.ph5open(True)
+    ph5_obj.initgroup()
+    mt_obj = mttoph5.MTtoPH5(ph5_obj)
+    yield mt_obj
+    ph5_obj.ph5close()
+
+def spy_data(mt_obj):
+    """
+    keep the data of each time series handed to single_ts_to_ph5
+    """
+    passed = []
+    single_ts_to_ph5 = mt_obj.single_ts_to_ph5
+    def spy(ts_obj, count=1):
+        passed.append(ts_obj.ts.data)
+        return single_ts_to_ph5(ts_obj, count)
+    mt_obj.single_ts_to_ph5 = spy
+
+    return passed
+
+def read_data_array(ph5_path, data_logger, count):
+    array_path = '/Experiment_g/Receivers_g/Das_g_{0}/Data_a_{1:05}'.format(
+                                                        data_logger, count)
+    with tables.open_file(str(ph5_path / 'miniPH5_00001.ph5'), 'r') as h5:
+        return h5.get_node(array_path).read()
+
+def load_raw(mt_obj, data):
+    count = mt_obj.raw_to_ph5(data, '2020-01-01T00:00:00', 256,
+                              station='mt01', component='ex',
+                              channel_number=4, data_logger='ZEN_024')
+    mt_obj.close()
+
+    return count
+
+class FakeNIMS(object):
+    """
+    stands in for mtpy.usgs.nims.NIMS, each channel property makes a new 
+    copy of the channel like NIMS does
+    """
+    n_samples = 2**18
+    
+    def __init__(self, fn):
+        self.fn = fn
+        self.data = dict([(component, np.random.rand(self.n_samples))
+                          for component in mttoph5.NIMSSource.components])
+        
+    def __getattr__(self, component):
+        if component not in mttoph5.NIMSSource.components:
+            raise AttributeError(component)
+        return mttoph5.TSHeader('2020-01-01T00:00:00', 8, 
+                                data=self.data[component].copy(),
+                                component=component, station='mt01',
+                                data_logger='NIMS_2608', fn=self.fn)
+
+def channel_peak(consume):
+    """
+    peak memory while a NIMS file is decoded and its channels are consumed
+    """
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        components = consume(mttoph5.NIMSSource('mt01.bin'))
+        peak = tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+        
+    assert components == mttoph5.NIMSSource.components
+    return peak
+
+# =============================================================================
+# Tests
+# =============================================================================
+@pytest.mark.parametrize('dtype', [np.int32, np.float64])
+def test_raw_to_ph5_stores_data(tmp_path, mt_obj, dtype):
+    src = np.arange(256 * 10).astype(dtype)
+    passed = spy_data(mt_obj)
+
+    count = load_raw(mt_obj, src)
+
+    assert np.shares_memory(passed[0], src)
+    stored = read_data_array(tmp_path, 'ZEN_024', count)
+    assert stored.dtype == src.dtype
+    assert np.array_equal(stored, src)
+
+def test_raw_to_ph5_copies_strided(tmp_path, mt_obj):
+    src = np.arange(256 * 10, dtype=np.int32)[::2]
+    passed = spy_data(mt_obj)
+
+    count = load_raw(mt_obj, src)
+
+    assert passed[0].flags['C_CONTIGUOUS']
+    assert not np.shares_memory(passed[0], src)
+    stored = read_data_array(tmp_path, 'ZEN_024', count)
+    assert stored.dtype == src.dtype
+    assert np.array_equal(stored, src)
+
+def test_ascontiguousarray_no_copy():
+    src = np.arange(4096, dtype=np.int32)
+    assert np.shares_memory(np.ascontiguousarray(src), src)
+    assert not np.shares_memory(np.ascontiguousarray(src[::2]), src)
+
+def test_nims_source_one_channel_at_a_time(monkeypatch):
+    monkeypatch.setattr(mttoph5.nims, 'NIMS', FakeNIMS)
+    channel_bytes = FakeNIMS.n_samples * 8
+    
+    def keep_all(source):
+        ts_list = list(source)
+        return [ts_header.component for ts_header in ts_list]
+    
+    def write_each(source):
+        components = []
+        mt_obj = mttoph5.MTtoPH5()
+        def single_ts_to_ph5(ts_obj, count=1):
+            components.append(ts_obj.component)
+            return count + 1
+        mt_obj.single_ts_to_ph5 = single_ts_to_ph5
+        mt_obj.file_to_ph5('mt01.bin', 1, False, iter([source]))
+        return components
+    
+    ### the decoded file holds 5 channels, keeping every channel doubles 
+    ### that while writing each one as it is made adds only one channel
+    assert channel_peak(keep_all) > 9 * channel_bytes
+    assert channel_peak(write_each) < 6.5 * channel_bytes
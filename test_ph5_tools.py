@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for ph5_tools, tables are written to PH5 files made in a temporary
+directory.
+"""
+# =============================================================================
+# Imports
+# =============================================================================
+import datetime
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pytest
+import tables
+
+pytest.importorskip('ph5')
+
+from ph5.core import columns, experiment
+
+import ph5_tools
+
+# =============================================================================
+# Helpers
+# =============================================================================
+def open_master(path):
+    ph5_obj = experiment.ExperimentGroup(nickname='master.ph5', 
+                                         currentpath=str(path))
+    ph5_obj.ph5open(True)
+    ph5_obj.initgroup()
+    
+    return ph5_obj
+
+def sample_value(dtype, text='abc'):
+    if dtype.kind == 'S':
+        return text
+    if dtype.kind == 'f':
+        return 1.5
+    return 3
+
+def make_entries(table):
+    """
+    entries for every column, for every other column and with nested paths
+    """
+    column_list = ph5_tools.table_columns(table)
+    full = dict([(path, sample_value(dtype)) 
+                 for path, default, dtype in column_list])
+    partial = dict([(path, sample_value(dtype)) 
+                    for path, default, dtype in column_list[::2]])
+    nested = dict([(path, value) for path, value in full.items()
+                   if '/' in path])
+    assert nested
+    
+    return [full, partial, nested]
+
+@pytest.fixture
+def receiver_tables(tmp_path):
+    """
+    two empty receiver tables, one for populate and one for append_rows
+    """
+    handles = []
+    for name in ['populate', 'append']:
+        (tmp_path / name).mkdir()
+        handles.append(open_master(tmp_path / name))
+    yield [handle.ph5_g_receivers.ph5_t_receiver for handle in handles]
+    for handle in handles:
+        handle.ph5close()
+
+def epoch_time_value(seconds):
+    return ph5_tools.make_time_value(datetime.datetime.fromtimestamp(
+                                        seconds, datetime.timezone.utc))
+
+def populate_all(table, entries):
+    for entry in entries:
+        columns.populate(table, entry)
+    
+    return table.read().tolist()
+
+# =============================================================================
+# Tests
+# =============================================================================
+def test_append_rows_matches_populate(receiver_tables):
+    populate_table, append_table = receiver_tables
+    entries = make_entries(populate_table)
+    
+    ph5_tools.append_rows(append_table, entries)
+    
+    assert append_table.read().tolist() == populate_all(populate_table,
+                                                        entries)
+
+def test_table_buffer_matches_populate(receiver_tables):
+    populate_table, append_table = receiver_tables
+    entries = make_entries(populate_table)
+    
+    table_buffer = ph5_tools.TableBuffer(max_rows=2)
+    for entry in entries:
+        table_buffer.append(append_table, entry)
+    assert append_table.nrows == 2
+    table_buffer.flush()
+    
+    assert append_table.read().tolist() == populate_all(populate_table,
+                                                        entries)
+    
+def test_append_rows_none_is_default(receiver_tables):
+    populate_table, append_table = receiver_tables
+    full = make_entries(populate_table)[0]
+    with_none = dict([(path, None if n % 2 else value) 
+                      for n, (path, value) in enumerate(full.items())])
+    given = dict([(path, value) for path, value in with_none.items()
+                  if value is not None])
+    
+    ph5_tools.append_rows(append_table, [with_none])
+    
+    assert append_table.read().tolist() == populate_all(populate_table, 
+                                                        [given])
+    
+def test_append_rows_non_ascii(receiver_tables):
+    populate_table, append_table = receiver_tables
+    column_list = ph5_tools.table_columns(populate_table)
+    entry = dict([(path, sample_value(dtype, u'Zürich'))
+                  for path, default, dtype in column_list])
+    encoded = dict([(path, value.encode('utf-8') 
+                     if isinstance(value, str) else value) 
+                    for path, value in entry.items()])
+    
+    ph5_tools.append_rows(append_table, [entry])
+    
+    assert append_table.read().tolist() == populate_all(populate_table,
+                                                        [encoded])
+    string_path = [path for path, default, dtype in column_list 
+                   if dtype.kind == 'S'][0]
+    value = ph5_tools.get_field(append_table.read(), string_path)[0]
+    assert value.decode('utf-8') == u'Zürich'
+
+# =============================================================================
+# Time index
+# =============================================================================
+@pytest.fixture
+def time_index():
+    time_index = ph5_tools.TimeIndex()
+    time_index.add('ZEN_024', 7200, 10800, './miniPH5_00002.ph5')
+    time_index.add('ZEN_024', 0, 3600, './miniPH5_00001.ph5')
+    time_index.add('ZEN_024', 3000, 3600.5, './miniPH5_00002.ph5')
+    time_index.add('ZEN_025', 0, 100, './miniPH5_00001.ph5')
+    
+    return time_index
+
+def test_time_index_gaps(time_index):
+    assert time_index.gaps('ZEN_024') == [(3600.5, 7200.)]
+    assert time_index.gaps('ZEN_024', -100, 11000) == [(-100., 0.),
+                                                       (3600.5, 7200.),
+                                                       (10800., 11000.)]
+    assert time_index.gaps('ZEN_024', 5000, 6000) == [(5000., 6000.)]
+    assert time_index.gaps('ZEN_024', gap=4000) == []
+    assert time_index.gaps('ZEN_026', 0, 10) == [(0., 10.)]
+    
+def test_time_index_coverage(time_index):
+    assert time_index.coverage('ZEN_024', 0, 3600) == 1.
+    assert time_index.coverage('ZEN_024', 0, 10800) == \
+            pytest.approx(7200.5 / 10800)
+    assert time_index.coverage('ZEN_024', 4000, 5000) == 0.
+    assert time_index.coverage('ZEN_026', 0, 10) == 0.
+    assert time_index.coverage('ZEN_024', 10, 10) == 0.
+
+def test_time_index_at(time_index):
+    assert time_index.at('ZEN_024', 1800) == ['./miniPH5_00001.ph5']
+    assert time_index.at('ZEN_024', 3500) == ['./miniPH5_00001.ph5',
+                                              './miniPH5_00002.ph5']
+    assert time_index.at('ZEN_024', 5000) == []
+    assert time_index.at('ZEN_025', 100) == ['./miniPH5_00001.ph5']
+
+def test_time_index_overlap(time_index):
+    assert time_index.overlap('ZEN_024', 3500, 7500) == [
+                            (0., 3600., './miniPH5_00001.ph5'),
+                            (3000., 3600.5, './miniPH5_00002.ph5'),
+                            (7200., 10800., './miniPH5_00002.ph5')]
+    ### a long span that started early still overlaps a late window
+    time_index.add('ZEN_024', -10, 20000, './miniPH5_00003.ph5')
+    assert time_index.overlap('ZEN_024', 15000, 16000) == [
+                            (-10., 20000., './miniPH5_00003.ph5')]
+    
+def test_time_index_large():
+    n_spans = 10**5
+    starts = np.arange(n_spans, dtype=np.float64) * 10
+    starts[::1000] += 5
+    start_time = time.perf_counter()
+    time_index = ph5_tools.TimeIndex()
+    for start in starts:
+        time_index.add('ZEN_024', start, start + 9.5, './miniPH5_00001.ph5')
+    gaps = time_index.gaps('ZEN_024', gap=1.0)
+    coverage = time_index.coverage('ZEN_024', 0, starts[-1] + 9.5)
+    for query in np.linspace(0, starts[-1], 1000):
+        time_index.at('ZEN_024', query)
+    elapsed = time.perf_counter() - start_time
+    
+    assert len(time_index) == n_spans
+    assert len(gaps) == n_spans // 1000 - 1
+    assert 0.9 < coverage < 1.
+    assert elapsed < 1.
+
+# =============================================================================
+# Sorts time spans
+# =============================================================================
+def test_merge_time_spans():
+    spans = [(epoch_time_value(start), epoch_time_value(end)) 
+             for start, end in [(100, 200), (0, 50), (40, 60), (60.5, 80),
+                                (150, 180)]]
+    
+    merged = [(ph5_tools.time_value_to_epoch(start), 
+               ph5_tools.time_value_to_epoch(end)) 
+              for start, end in ph5_tools.merge_time_spans(spans)]
+    assert merged == [(0, 60), (60.5, 80), (100, 200)]
+    
+    merged = [(ph5_tools.time_value_to_epoch(start), 
+               ph5_tools.time_value_to_epoch(end)) 
+              for start, end in ph5_tools.merge_time_spans(spans, gap=1)]
+    assert merged == [(0, 80), (100, 200)]
+    assert ph5_tools.merge_time_spans([]) == []
+
+# =============================================================================
+# Ingest ledger
+# =============================================================================
+def test_ingest_ledger_resume(tmp_path):
+    ledger_fn = str(tmp_path / 'master_ingest_ledger.jsonl')
+    data_fn = tmp_path / 'mt01.asc'
+    data_fn.write_text('1\n2\n3\n')
+    outputs = [{'das': 'ZEN_024', 'array': 'Data_a_00001', 
+                'mini': 'miniPH5_00001.ph5'}]
+    
+    ledger = ph5_tools.IngestLedger(ledger_fn, 'id_1')
+    assert not ledger.is_done(str(data_fn))
+    ledger.record(str(data_fn), outputs)
+    ### nothing is written until commit
+    assert not os.path.isfile(ledger_fn)
+    ledger.commit()
+    
+    ledger = ph5_tools.IngestLedger(ledger_fn, 'id_1')
+    assert ledger.is_done(str(data_fn))
+    assert ledger.entries[str(data_fn)]['outputs'] == outputs
+    
+    ### touched but the same contents is still done
+    stat = os.stat(data_fn)
+    os.utime(data_fn, (stat.st_atime, stat.st_mtime + 10))
+    assert ledger.is_done(str(data_fn))
+    ### same size different contents has to be loaded again
+    data_fn.write_text('1\n2\n4\n')
+    assert not ledger.is_done(str(data_fn))
+    data_fn.write_text('1\n2\n3\n4\n')
+    assert not ledger.is_done(str(data_fn))
+    data_fn.unlink()
+    assert not ledger.is_done(str(data_fn))
+
+def test_ingest_ledger_partial_line(tmp_path):
+    ledger_fn = tmp_path / 'master_ingest_ledger.jsonl'
+    data_fn = tmp_path / 'mt01.asc'
+    data_fn.write_text('1\n2\n3\n')
+    ledger = ph5_tools.IngestLedger(str(ledger_fn), 'id_1')
+    ledger.record(str(data_fn), [])
+    ledger.commit()
+    with open(str(ledger_fn), 'a') as fid:
+        fid.write('{"path": "/data/mt02.as')
+        
+    ledger = ph5_tools.IngestLedger(str(ledger_fn), 'id_1')
+    assert list(ledger.entries) == [str(data_fn)]
+    assert ledger.is_done(str(data_fn))
+
+def test_ingest_ledger_new_master(tmp_path):
+    ledger_fn = str(tmp_path / 'master_ingest_ledger.jsonl')
+    data_fn = tmp_path / 'mt01.asc'
+    data_fn.write_text('1\n2\n3\n')
+    ledger = ph5_tools.IngestLedger(ledger_fn, 'id_1')
+    ledger.record(str(data_fn), [])
+    ledger.commit()
+    
+    ### the master file was made again, so nothing is loaded
+    ledger = ph5_tools.IngestLedger(ledger_fn, 'id_2')
+    assert not ledger.is_done(str(data_fn))
+    other_fn = tmp_path / 'mt02.asc'
+    other_fn.write_text('5\n')
+    ledger.record(str(other_fn), [])
+    ledger.commit()
+    
+    ledger = ph5_tools.IngestLedger(ledger_fn, 'id_2')
+    assert list(ledger.entries) == [str(other_fn)]
+    assert ph5_tools.IngestLedger(ledger_fn, 'id_1').entries == {}
+
+# =============================================================================
+# Mini file placement
+# =============================================================================
+def test_plan_mini_placement_lpt():
+    das_bytes = {'ZEN_024': 8, 'ZEN_025': 6, 'ZEN_026': 5, 'ZEN_027': 3,
+                 'ZEN_028': 2}
+    
+    placement = ph5_tools.plan_mini_placement(das_bytes, num_mini=2,
+                                              mini_size_max=100)
+    
+    assert placement == {'ZEN_024': 1, 'ZEN_025': 2, 'ZEN_026': 2,
+                         'ZEN_027': 1, 'ZEN_028': 1}
+    
+def test_plan_mini_placement_size_max():
+    das_bytes = {'ZEN_024': 8, 'ZEN_025': 6, 'ZEN_026': 5, 'ZEN_027': 12}
+    
+    placement = ph5_tools.plan_mini_placement(das_bytes, num_mini=1,
+                                              mini_size_max=10, 
+                                              first_mini=3)
+    
+    ### too big for one mini file, and the one bigger than mini_size_max
+    ### gets a mini file to itself
+    loads = {}
+    for serial, num in placement.items():
+        loads[num] = loads.get(num, 0) + das_bytes[serial]
+    assert min(loads) == 3
+    assert loads[placement['ZEN_027']] == 12
+    assert all([load <= 10 for num, load in loads.items() 
+                if num != placement['ZEN_027']])
+    
+def test_plan_mini_placement_existing():
+    existing = {1: {'num': 1, 'das_list': ['ZEN_024'], 'size': 9},
+                2: {'num': 2, 'das_list': [], 'size': 0}}
+    das_bytes = {'ZEN_024': 4, 'ZEN_025': 6, 'ZEN_026': 2}
+    
+    placement = ph5_tools.plan_mini_placement(das_bytes, num_mini=2,
+                                              mini_size_max=100,
+                                              existing=existing)
+    
+    assert placement == {'ZEN_024': 1, 'ZEN_025': 2, 'ZEN_026': 2}
+
+# =============================================================================
+# Metadata schemas
+# =============================================================================
+def test_read_metadata_requirements_csv(tmp_path):
+    csv_fn = tmp_path / 'MT Metadata Standards - Test.csv'
+    csv_fn.write_text('Title line,,,\n'
+                      'Parameter,Explanation,Type,Requirement\n'
+                      'sensor/type_s,"type [ a, b ]",string,compulsory\n'
+                      'sensor/notes_s,notes,string,optional\n')
+    
+    assert ph5_tools.read_metadata_requirements(str(csv_fn)) == {
+                    'sensor/type_s': True, 'sensor/notes_s': False}
+    
+def test_read_metadata_requirements_latex(tmp_path):
+    csv_fn = tmp_path / 'MT Metadata Standards - Test.csv'
+    csv_fn.write_text('model\\_s & model name & string & compulsory '
+                      '\\\\ \\hline\n'
+                      'notes\\_s & notes, if any & string & '
+                      '\\\\ \\hline\n')
+    
+    assert ph5_tools.read_metadata_requirements(str(csv_fn)) == {
+                    'model_s': True, 'notes_s': False}
+    
+def test_metadata_schema():
+    assert 'electrics' in ph5_tools.metadata_schema_names()
+    schema = ph5_tools.get_metadata_schema('electrics')
+    
+    assert schema['dipole/length_d'].column_type == 'float'
+    assert schema['channel_num_i'].column_type == 'int'
+    assert schema['sensor/type_s'] == ph5_tools.MetadataField('string', 
+                                                              None, True)
+    assert not schema['sensor/notes_s'].required
+    assert ph5_tools.get_metadata_schema('electrics') is schema
+    with pytest.raises(ValueError):
+        ph5_tools.get_metadata_schema('not_a_schema')
+
+def test_validate_entries():
+    schema = {'id_s': ph5_tools.MetadataField('string', 4, True),
+              'n_i': ph5_tools.MetadataField('int', None, False),
+              'value_d': ph5_tools.MetadataField('float', None, False)}
+    entries = [{'id_s': 'mt01', 'n_i': '3', 'value_d': '1.5'},
+               {'id_s': 'mt001', 'n_i': 2},
+               {'n_i': 2.5, 'value_d': 'a'},
+               {'id_s': b'mt02', 'other_l': '7', 'other': object}]
+    
+    good, errors = ph5_tools.validate_entries(entries, schema)
+    
+    assert good[0] == {'id_s': 'mt01', 'n_i': 3, 'value_d': 1.5}
+    assert good[1]['id_s'] == 'mt02'
+    assert good[1]['other_l'] == 7
+    assert len(good) == 2
+    assert set([(index, key) for index, key, message in errors]) == set([
+                (1, 'id_s'), (2, 'id_s'), (2, 'n_i'), (2, 'value_d')])
+    
+    good, errors = ph5_tools.validate_entries(entries[1:2], schema, 
+                                              truncate=True)
+    assert good == [{'id_s': 'mt00', 'n_i': 2}]
+    with pytest.raises(ValueError):
+        ph5_tools.validate_entries(entries, schema, strict=True)
+
+# =============================================================================
+# Ingest statistics
+# =============================================================================
+def test_ingest_stats_nested_peak():
+    was_tracing = tracemalloc.is_tracing()
+    stats = ph5_tools.IngestStats(enabled=True, track_memory=True)
+    n_bytes = 2**22
+    try:
+        with stats.stage('outer'):
+            big = np.ones(n_bytes, dtype=np.uint8)
+            del big
+            with stats.stage('inner'):
+                small = np.ones(n_bytes // 4, dtype=np.uint8)
+                del small
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    
+    assert stats.total['inner']['peak_memory'] < n_bytes // 2
+    assert stats.total['outer']['peak_memory'] >= n_bytes
+
+# =============================================================================
+# Reading windows
+# =============================================================================
+def make_window_reader(tmp_path, segments):
+    """
+    generic2ph5 that reads the given segments from one HDF5 file, segments
+    are (serial, channel number, start, sampling rate, n_samples)
+    """
+    h5 = tables.open_file(str(tmp_path / 'miniPH5_00001.ph5'), 'w')
+    found = {}
+    for ii, (serial, channel_number, start, sampling_rate, 
+             n_samples) in enumerate(segments, 1):
+        array_name = 'Data_a_{0:05}'.format(ii)
+        h5.create_array('/Experiment_g/Receivers_g/Das_g_{0}'.format(serial),
+                        array_name, np.arange(n_samples, dtype=np.int32),
+                        createparents=True)
+        found.setdefault((serial, channel_number), []).append(
+                                        {'mini': 1,
+                                         'array': array_name,
+                                         'start': float(start),
+                                         'sampling_rate': float(sampling_rate),
+                                         'n_samples': n_samples})
+    h5.close()
+    
+    reader = ph5_tools.generic2ph5()
+    reader.find_channels = lambda station, component: sorted(found)
+    reader.find_segments = lambda serial, channel_number, start, end, \
+                           read_files=None: found[(serial, channel_number)]
+    def read_mini_file(mini_num, read_files):
+        if mini_num not in read_files:
+            read_files[mini_num] = tables.open_file(
+                            str(tmp_path / 'miniPH5_00001.ph5'), 'r')
+        return read_files[mini_num]
+    reader._read_mini_file = read_mini_file
+    
+    return reader
+
+def test_read_window_gaps(tmp_path):
+    ### arrays of 10 s, the last one starts 5 s late
+    reader = make_window_reader(tmp_path, [('ZEN_024', 4, 10, 10, 100),
+                                           ('ZEN_024', 4, 0, 10, 100),
+                                           ('ZEN_024', 4, 25, 10, 100)])
+    
+    window = reader.read_window('mt01', 'ex', 5, 35)
+    
+    assert window.data.shape == (50 + 100 + 100,)
+    assert window.start == ph5_tools.epoch_to_date_time(5)
+    assert window.sampling_rate == 10
+    assert [(ph5_tools.to_epoch(start), seconds) 
+            for start, seconds in window.gaps] == [(20., 5.)]
+    assert reader.read_window('mt01', 'ex', 0, 20).gaps == []
+    assert reader.read_window('mt01', 'ex', 500, 600) is None
+    
+def test_read_window_mixed_sources(tmp_path):
+    reader = make_window_reader(tmp_path, [('ZEN_024', 4, 0, 10, 100),
+                                           ('ZEN_024', 4, 10, 256, 100)])
+    with pytest.raises(ValueError):
+        reader.read_window('mt01', 'ex', 0, 20)
+        
+    reader = make_window_reader(tmp_path, [('ZEN_024', 4, 0, 10, 100),
+                                           ('ZEN_025', 4, 10, 10, 100)])
+    with pytest.raises(ValueError):
+        reader.read_window('mt01', 'ex', 0, 20)
+    assert reader.read_window('mt01', 'ex', 0, 5).serial == 'ZEN_024'